@@ -0,0 +1,58 @@
+"""
+ASGI handler of the REST API of the players (/api/).
+
+Django 3.2 has no asynchronous ORM and runs every synchronous view (the
+viewsets of restServer) in a single thread shared by all the requests of the
+process, which the synchronous middleware (WhiteNoise) also holds while the
+rest of the request is handled. So the requests of thousands of players
+joining, guessing and polling the state of a game are handled one at a time.
+
+The requests to the API are handled instead by APIHandler: the connection is
+still served by the event loop, but the middleware and the view run in a
+pool of threads, so many requests are handled at once, each with its own
+database connection. The rest of the site is handled by the Django
+application as usual.
+"""
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+
+API_PATH = '/api/'
+
+
+class APIHandler(ASGIHandler):
+    ''' ASGI handler that runs the synchronous middleware and views in a pool
+    of threads instead of the single thread of the Django application.'''
+
+    def load_middleware(self, is_async=False):
+        # the whole chain runs in the same thread, without adapters
+        super().load_middleware(is_async=False)
+
+    async def get_response_async(self, request):
+        return await sync_to_async(
+            self._get_response_in_thread, thread_sensitive=False)(request)
+
+    def _get_response_in_thread(self, request):
+        # the database connections of the threads of the pool are managed
+        # as those of a WSGI worker in each request
+        close_old_connections()
+        try:
+            return self.get_response(request)
+        finally:
+            close_old_connections()
+
+
+def with_api_handler(django_application):
+    ''' Returns an ASGI application that passes the requests to the API to
+    APIHandler and any other request to the Django application.'''
+    api_application = APIHandler()
+
+    async def application(scope, receive, send):
+        if (scope['type'] == 'http'
+                and scope['path'].startswith(API_PATH)):
+            await api_application(scope, receive, send)
+        else:
+            await django_application(scope, receive, send)
+
+    return application
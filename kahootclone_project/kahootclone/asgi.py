@@ -2,6 +2,9 @@
 ASGI config for kahootclone project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Besides the Django application, it serves the push channel of the games
+(see push.py), and the REST API of the players is handled in a pool of
+threads (see api.py).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -13,4 +16,10 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kahootclone.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once django is set up, as it uses the models
+from .api import with_api_handler  # noqa: E402
+from .push import with_push_channel  # noqa: E402
+
+application = with_push_channel(with_api_handler(django_application))
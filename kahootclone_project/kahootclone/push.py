@@ -0,0 +1,217 @@
+"""
+Push channel of the games, served as server-sent events.
+
+GET /events/<publicId>/ keeps the connection open and streams the events of
+the game (see models/events.py) as they are published:
+
+    event: state        data: {"state": .., "questionNo": .., ...}
+    event: join/leave   data: {"alias": ..}
+    event: answered     data: {"answered": .., "participants": ..}
+
+The current state of the game is sent as soon as the client connects.
+
+Clients that cannot keep a stream open (e.g. behind proxies that buffer
+responses) long-poll instead: GET /api/games/<publicId>/?since_state=<s>,
+where s is the state received in the last response (header X-Game-State),
+is held while the game is in that state (players joining or guessing do not
+count), until it moves to another state or question or LONG_POLL_TIMEOUT
+seconds pass, and then it is answered by the Django application as usual,
+with the header X-Long-Poll: held. Waiting is a coroutine of the event loop,
+not a thread, so many players can be parked at once.
+
+Any other request is handled by the Django application.
+"""
+
+import asyncio
+import re
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from models import events, livestate
+
+EVENTS_PATH = re.compile(r'^/events/(?P<publicId>\d+)/?$')
+GAME_PATH = re.compile(r'^/api/games/(?P<publicId>\d+)/?$')
+
+''' Seconds without events after which a comment is sent to keep the
+    connection open through proxies '''
+KEEPALIVE = 15
+
+''' Seconds a long poll is held if the state of the game does not change
+    (less than the usual timeout of proxies) '''
+LONG_POLL_TIMEOUT = 25
+
+''' Seconds between checks of the live state during a long poll, as the
+    changes made by other processes are not published to this one '''
+LONG_POLL_CHECK = 1
+
+''' Header of the responses to the long polls that were held '''
+HELD_HEADER = (b'x-long-poll', b'held')
+
+
+def _cors_headers(scope):
+    origin = dict(scope['headers']).get(b'origin', b'').decode()
+    if origin in settings.CORS_ORIGIN_WHITELIST:
+        return [(b'access-control-allow-origin', origin.encode())]
+    return []
+
+
+async def stream_events(scope, receive, send, publicId):
+    ''' Streams the events of the game until the client disconnects.'''
+    game = await sync_to_async(livestate.get)(publicId)
+    if game is None:
+        await send({'type': 'http.response.start', 'status': 404,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Not found'})
+        return
+
+    with events.subscribe(game.publicId) as queue:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ] + _cors_headers(scope),
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': events.format_event(
+                'state', events.state_data(game)).encode(),
+            'more_body': True,
+        })
+
+        async def wait_for_disconnect():
+            # the body of the request comes first
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            while True:
+                next_event = asyncio.ensure_future(queue.get())
+                await asyncio.wait(
+                    {next_event, disconnected},
+                    timeout=KEEPALIVE,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if disconnected.done():
+                    next_event.cancel()
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+                if next_event.done():
+                    message = next_event.result()
+                else:
+                    next_event.cancel()
+                    message = ': keepalive\n\n'
+                await send({
+                    'type': 'http.response.body',
+                    'body': message.encode(),
+                    'more_body': True,
+                })
+        finally:
+            disconnected.cancel()
+
+
+def _state_token(publicId):
+    game = livestate.get(publicId)
+    return None if game is None else events.state_token(game)
+
+
+async def wait_for_state_change(publicId, since_state, disconnected):
+    ''' Waits while since_state is the state of the game until it changes,
+    the client disconnects or LONG_POLL_TIMEOUT passes.
+    Output: whether the request was held (False if the client is out of
+    date).'''
+    state = await sync_to_async(_state_token)(publicId)
+    if state is None or state != since_state:
+        return False
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LONG_POLL_TIMEOUT
+    with events.subscribe(publicId) as queue:
+        while True:
+            timeout = min(LONG_POLL_CHECK, deadline - loop.time())
+            if timeout <= 0:
+                return True
+            next_event = asyncio.ensure_future(queue.get())
+            await asyncio.wait({next_event, disconnected}, timeout=timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if next_event.done():
+                if next_event.result().startswith('event: state'):
+                    return True
+                continue
+            next_event.cancel()
+            if disconnected.done():
+                return True
+            # changed by another process
+            if await sync_to_async(_state_token)(publicId) != state:
+                return True
+
+
+async def long_poll(scope, receive, send, publicId, since_state,
+                    django_application):
+    ''' Holds the request (see wait_for_state_change) and then passes it
+    to the Django application, marking its response with HELD_HEADER if it
+    was held.'''
+    # the messages received while waiting are passed on to the application
+    received = []
+
+    async def receive_until_disconnected():
+        while True:
+            message = await receive()
+            received.append(message)
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def receive_again():
+        if received:
+            return received.pop(0)
+        return await receive()
+
+    async def send_held(message):
+        if message['type'] == 'http.response.start':
+            message = dict(
+                message, headers=list(message['headers']) + [HELD_HEADER])
+        await send(message)
+
+    disconnected = asyncio.ensure_future(receive_until_disconnected())
+    try:
+        held = await wait_for_state_change(
+            publicId, since_state, disconnected)
+    finally:
+        disconnected.cancel()
+    if received and received[-1]['type'] == 'http.disconnect':
+        return
+    await django_application(
+        scope, receive_again, send_held if held else send)
+
+
+def with_push_channel(django_application):
+    ''' Returns an ASGI application that serves the push channel and the
+    long polls of the games and passes any other request to the Django
+    application.'''
+
+    async def application(scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            await django_application(scope, receive, send)
+            return
+
+        match = EVENTS_PATH.match(scope['path'])
+        if match:
+            await stream_events(
+                scope, receive, send, int(match.group('publicId')))
+            return
+
+        match = GAME_PATH.match(scope['path'])
+        since_state = parse_qs(
+            scope.get('query_string', b'').decode()).get('since_state')
+        if match and since_state:
+            await long_poll(scope, receive, send, int(match.group('publicId')),
+                            since_state[0], django_application)
+        else:
+            await django_application(scope, receive, send)
+
+    return application
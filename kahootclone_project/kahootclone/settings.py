@@ -116,6 +116,70 @@ db_from_env = dj_database_url.config(
 )
 DATABASES['default'].update(db_from_env)
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# It keeps the live state of the games (see models/livestate.py). The local
+# memory cache is only shared by the threads of a process, so if the
+# application runs with several processes a memcached server has to be given
+# with the environment variable MEMCACHED_LOCATION (requires pymemcache).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+if os.environ.get('MEMCACHED_LOCATION'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': os.environ.get('MEMCACHED_LOCATION'),
+    }
+
+# The state of the games, the rounds, the question indexes, the versions of
+# the games and the leaderboards (see models/) are only kept in the cache if
+# it is shared by every process: with the local memory cache the changes made
+# by a process would not be seen by the others, so they are read from the
+# database instead.
+
+CACHE_GAME_STATE = bool(os.environ.get('MEMCACHED_LOCATION'))
+
+# Sessions
+# https://docs.djangoproject.com/en/3.2/topics/http/sessions/
+# The session of the host (the game it plays, see services/views.py) is read
+# in every poll of its pages: with memcached, shared by every process, it is
+# kept in the cache too, so the database is only read when it is not there
+# and only written when it changes. The local memory cache is not shared, so
+# the copies of other processes would be out of date.
+
+SESSION_ENGINE = (
+    'django.contrib.sessions.backends.cached_db'
+    if os.environ.get('MEMCACHED_LOCATION')
+    else 'django.contrib.sessions.backends.db')
+
+# Scoring of the guesses (see models/scoring.py): one point per correct
+# guess, or points weighted by the time taken to answer if the environment
+# variable SPEED_WEIGHTED_SCORING is set.
+
+SCORING_ENGINE = (
+    'models.scoring.speed_weighted' if os.environ.get(
+        'SPEED_WEIGHTED_SCORING', '0').lower() in ['true', 't', '1']
+    else 'models.scoring.binary')
+
+# Write-behind mode of the guesses (see models/guessbuffer.py): the guesses
+# are acknowledged at once and stored in batches every GUESS_FLUSH_INTERVAL
+# seconds. Enabled with the environment variable GUESS_WRITE_BEHIND.
+
+GUESS_WRITE_BEHIND = os.environ.get(
+    'GUESS_WRITE_BEHIND', '0').lower() in ['true', 't', '1']
+GUESS_FLUSH_INTERVAL = 1
+
+# End of the questions (see models/scheduler.py): the games are moved to
+# ANSWER by the server when the time to answer is over. Enabled with the
+# environment variable QUESTION_SCHEDULER (the tests provided move the games
+# themselves).
+
+QUESTION_SCHEDULER = os.environ.get(
+    'QUESTION_SCHEDULER', '0').lower() in ['true', 't', '1']
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -188,6 +252,8 @@ CORS_ORIGIN_WHITELIST = [
     'http://localhost:3000',
     'https://kahootcloneczclient.onrender.com'
 ]
+# read by the players to wait for the next state of the game
+CORS_EXPOSE_HEADERS = ['X-Game-State', 'X-Long-Poll']
 
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
@@ -2,7 +2,8 @@ from django.contrib import admin
 
 
 from .models import (
-    User, Questionnaire, Question, Answer, Game, Participant, Guess
+    User, Questionnaire, Question, Answer, Game, GameCounter, Participant,
+    Guess
 )
 
 admin.site.register(User)
@@ -12,6 +13,7 @@ admin.site.register(Participant)
 admin.site.register(Answer)
 admin.site.register(Game)
 admin.site.register(Guess)
+admin.site.register(GameCounter)
 
 
 # class QuestionnaireDetailsAdmin(admin.ModelAdmin):
@@ -0,0 +1,103 @@
+''' Events of the games pushed to the clients.
+
+The changes of a game (state transitions, participants joining or leaving
+and new guesses) are published here and delivered to every client
+subscribed to that game through the push channel (see kahootclone/push.py),
+so clients do not have to poll the server to find out.
+
+Events are delivered to the subscribers of the same process only: the push
+channel has to be served by the same (ASGI) process that handles the
+requests of the game.
+'''
+# Author: Álvaro Zamanillo Sáez
+import asyncio
+import json
+import threading
+from contextlib import contextmanager
+
+''' Events waiting to be sent to a slow client before the oldest ones
+    are dropped '''
+MAX_PENDING_EVENTS = 100
+
+_subscribers = {}
+_lock = threading.Lock()
+
+
+def _deliver(queue, message):
+    # runs in the event loop of the subscriber
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+def state_data(game):
+    ''' Data of the "state" event of a game.'''
+    # Author: Álvaro Zamanillo Sáez
+    return {
+        'publicId': game.publicId,
+        'state': game.state,
+        'questionNo': game.questionNo,
+        'countdownTime': game.countdownTime,
+    }
+
+
+def state_token(game):
+    ''' Token of the state of a game, which only changes when the game moves
+    to another state or question (not when players join or guess).'''
+    # Author: Álvaro Zamanillo Sáez
+    return f'{game.state}-{game.questionNo}'
+
+
+def format_event(event, data):
+    ''' Formats an event as a server-sent event.'''
+    # Author: Álvaro Zamanillo Sáez
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def publish(publicId, event, data):
+    ''' Sends an event to every client subscribed to the game. It may be
+    called from any thread.
+    Input: publicId of the game, name of the event and its data (it has to
+    be serializable as json).'''
+    # Author: Álvaro Zamanillo Sáez
+    with _lock:
+        subscribers = list(_subscribers.get(publicId, ()))
+    if not subscribers:
+        return
+
+    message = format_event(event, data)
+    for loop, queue in subscribers:
+        try:
+            loop.call_soon_threadsafe(_deliver, queue, message)
+        except RuntimeError:  # the loop of the subscriber is closed
+            pass
+
+
+def has_subscribers(publicId):
+    ''' Returns True if some client of this process is subscribed to the
+    game, so that events which are expensive to compute can be skipped.'''
+    # Author: Álvaro Zamanillo Sáez
+    return publicId in _subscribers
+
+
+@contextmanager
+def subscribe(publicId):
+    ''' Subscribes to the events of a game while the context is active.
+    It has to be used inside an event loop.
+    Output: asyncio.Queue where the events (already formatted as
+    server-sent events) are received.'''
+    # Author: Álvaro Zamanillo Sáez
+    subscriber = (
+        asyncio.get_running_loop(),
+        asyncio.Queue(maxsize=MAX_PENDING_EVENTS),
+    )
+    with _lock:
+        _subscribers.setdefault(publicId, set()).add(subscriber)
+    try:
+        yield subscriber[1]
+    finally:
+        with _lock:
+            subscribers = _subscribers.get(publicId, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                _subscribers.pop(publicId, None)
@@ -0,0 +1,75 @@
+''' Version of the games.
+
+Players and hosts poll the state of their game, its participants and its
+guesses, which rarely change between two polls. Every change of them (see
+Game.save, Participant.save and delete, Guess.save and bulk_save) increments
+a version of the game kept in the cache, and the polled views send it as the
+ETag of their responses, so a poll of a client that already has the current
+version is answered with 304 Not Modified without building the response.
+
+The version is incremented after the change is committed: a poll in between
+gets the new content with the previous version, which is only sent again in
+full the next time.
+
+The versions are only kept if settings.CACHE_GAME_STATE is set (see
+models/livestate.py): a version known by a single process would answer 304
+to the changes made by the others. Otherwise no version is known and every
+poll is answered in full.
+'''
+# Author: Álvaro Zamanillo Sáez
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+
+''' Seconds the version of a game is kept in the cache since its creation '''
+VERSION_TIMEOUT = 24 * 60 * 60
+
+
+def _key(publicId):
+    return f'version:{publicId}'
+
+
+def get(publicId):
+    ''' Returns the version of the game, or None if it is not known.'''
+    # Author: Álvaro Zamanillo Sáez
+    if not settings.CACHE_GAME_STATE:
+        return None
+    return cache.get(_key(publicId))
+
+
+def current(publicId):
+    ''' Returns the version of an existing game, starting a new one if it is
+    not known (None if the versions are not kept).'''
+    # Author: Álvaro Zamanillo Sáez
+    version = get(publicId)
+    if version is None and settings.CACHE_GAME_STATE:
+        _start(publicId)
+        version = get(publicId)
+    return version
+
+
+def _start(publicId):
+    # random, so that it does not match the version of a previous entry
+    cache.add(_key(publicId), random.getrandbits(48), VERSION_TIMEOUT)
+
+
+def bump(publicId):
+    ''' Increments the version of the game. It has to be called after every
+    change of the game, its participants or its guesses.'''
+    # Author: Álvaro Zamanillo Sáez
+    if not settings.CACHE_GAME_STATE:
+        return
+    try:
+        cache.incr(_key(publicId))
+    except ValueError:  # the version is not in the cache
+        _start(publicId)
+        cache.incr(_key(publicId))
+
+
+def etag(publicId):
+    ''' Returns the ETag of the responses about the game, or None if its
+    version is not known.'''
+    # Author: Álvaro Zamanillo Sáez
+    version = get(publicId)
+    return None if version is None else f'{publicId}-{version}'
@@ -0,0 +1,162 @@
+''' Write-behind buffer of the guesses.
+
+When a question closes nearly every player sends their guess at once. If
+settings.GUESS_WRITE_BEHIND is set, the guesses received by GuessViewSet are
+validated against the live state of the game (see models/livestate.py),
+acknowledged at once and kept in memory, and they are stored in batches with
+Guess.bulk_save every GUESS_FLUSH_INTERVAL seconds and when the game leaves
+the question (Game.update_state).
+
+Guarantees:
+    - A guess is only acknowledged while its question is shown, with a valid
+      participant and answer, and if the participant has no other guess of
+      that question pending in this process.
+    - The guesses of a question received by the process that moves the game
+      to ANSWER are stored before the new state is saved, so the answer
+      screen, the points and the counters include them. Guesses received by
+      other processes are stored by their timer, at most GUESS_FLUSH_INTERVAL
+      seconds later.
+    - If a participant already had a guess of the question stored (e.g. by
+      another process), the stored one is kept and the pending one is
+      discarded when flushing: a guess is never changed.
+    - The guesses of the participants that left the game are discarded,
+      and the batches that could not be stored are kept to be stored in the
+      next flush.
+    - The guesses pending in a process are lost if it dies before flushing
+      them, so the mode trades durability of the last GUESS_FLUSH_INTERVAL
+      seconds for throughput.
+'''
+# Author: Álvaro Zamanillo Sáez
+import logging
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.forms import ValidationError
+
+from . import events, livestate
+from .constants import QUESTION
+
+logger = logging.getLogger(__name__)
+
+# (publicId, questionNo) -> guesses waiting to be stored
+_pending = {}
+# (publicId, questionNo) -> ids of the participants with a guess accepted
+_accepted = {}
+_lock = threading.Lock()
+_timer = None
+
+
+def enabled():
+    ''' Returns True if the guesses are buffered.'''
+    # Author: Álvaro Zamanillo Sáez
+    return settings.GUESS_WRITE_BEHIND
+
+
+def add(game, guess):
+    ''' Accepts a guess of the current question of the game (as given by
+    livestate.get) to be stored later. Raises ValidationError like
+    Guess.save if it is not valid.'''
+    # Author: Álvaro Zamanillo Sáez
+    if game.state != QUESTION:
+        raise ValidationError("Wait until the question is shown")
+
+    key = (game.publicId, game.questionNo)
+    with _lock:
+        accepted = _accepted.setdefault(key, set())
+        if guess.participant_id in accepted:
+            raise ValidationError(
+                f"You may not edit an existing {guess._meta.model_name}")
+        accepted.add(guess.participant_id)
+        _pending.setdefault(key, []).append(guess)
+    _start_timer()
+    return guess
+
+
+def flush(publicId):
+    ''' Stores the pending guesses of a game.
+    Output: number of guesses stored.'''
+    # Author: Álvaro Zamanillo Sáez
+    Game = apps.get_model('models', 'Game')
+    Guess = apps.get_model('models', 'Guess')
+
+    with _lock:
+        batches = [(key, _pending.pop(key)) for key in list(_pending)
+                   if key[0] == publicId]
+    if not batches:
+        return 0
+
+    game = Game.objects.filter(publicId=publicId).first()
+    if game is None:  # the game was deleted
+        return 0
+
+    n_stored = 0
+    for n, ((_, questionNo), guesses) in enumerate(batches):
+        try:
+            try:
+                n_stored += len(Guess.bulk_save(game, guesses, questionNo))
+            except ValidationError:
+                # another process stored some of them at the same time: the
+                # guesses already stored are skipped in the second try
+                n_stored += len(Guess.bulk_save(game, guesses, questionNo))
+        except Exception:
+            # the batches not stored are kept for the next flush
+            with _lock:
+                for key, unstored in batches[n:]:
+                    _pending[key] = unstored + _pending.get(key, [])
+            raise
+
+    if n_stored and events.has_subscribers(publicId):
+        n_guesses, n_participants = game.answered_count()
+        events.publish(publicId, 'answered', {
+            'answered': n_guesses, 'participants': n_participants})
+    return n_stored
+
+
+def flush_all():
+    ''' Stores the pending guesses of every game and forgets the accepted
+    guesses of the questions that are no longer shown.'''
+    # Author: Álvaro Zamanillo Sáez
+    with _lock:
+        publicIds = {publicId for publicId, _ in _pending}
+    for publicId in publicIds:
+        try:
+            flush(publicId)
+        except Exception:  # kept to be stored in the next flush
+            logger.exception(
+                'The pending guesses of game %s could not be stored',
+                publicId)
+
+    with _lock:
+        keys = list(_accepted)
+    for publicId, questionNo in keys:
+        game = livestate.get(publicId)
+        if (game is None or game.state != QUESTION
+                or game.questionNo != questionNo):
+            with _lock:
+                _accepted.pop((publicId, questionNo), None)
+
+
+def _flush_periodically(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            flush_all()
+        except Exception:  # keep flushing in the next interval
+            logger.exception('The pending guesses could not be flushed')
+        finally:
+            connection.close()
+
+
+def _start_timer():
+    global _timer
+    interval = settings.GUESS_FLUSH_INTERVAL
+    if _timer is not None or not interval:
+        return
+    with _lock:
+        if _timer is None:
+            _timer = threading.Thread(
+                target=_flush_periodically, args=(interval,), daemon=True)
+            _timer.start()
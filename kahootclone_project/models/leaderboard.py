@@ -0,0 +1,230 @@
+''' Leaderboard of the games.
+
+The participants of each game are kept sorted as in the leaderboard
+(Participant.Meta.ordering) in the memory of the process, and the structure
+is updated each time a participant joins or leaves the game or is awarded
+points, so the top of the leaderboard and the rank of a participant are
+read without querying the database. The position of a participant is found
+by binary search, in O(log n), and moving it after scoring is a binary search
+and a shift of the list (a memmove, negligible even for 10^4 players).
+
+Each process keeps its own copy, so every change (see changing) increments a
+version of the leaderboard of the game stored in the cache, before changing
+the database and again once the change is committed: a copy loaded by any
+process in between, which may miss the change, is left out of date. A
+process only applies a change to its copy if it was up to date (nobody else
+changed the leaderboard meanwhile); otherwise its copy is discarded and
+loaded again from the database (a single query) the next time it is read.
+Each game has its own lock, so only the readers of the leaderboard being
+loaded wait for it.
+
+The versions are only seen by every process if the cache is shared by all of
+them, so the copies are only kept if settings.CACHE_GAME_STATE is set (see
+models/livestate.py); otherwise the leaderboard is loaded in each read.
+'''
+# Author: Pablo Cuesta Sierra
+import bisect
+import random
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+''' Games whose leaderboard is kept in the memory of each process '''
+MAX_GAMES = 100
+
+''' Seconds the version of a leaderboard is kept in the cache '''
+VERSION_TIMEOUT = 24 * 60 * 60
+
+Entry = namedtuple('Entry', 'rank alias points')
+
+# publicId -> (version, Leaderboard), the least recently used first
+_boards = OrderedDict()
+# publicId -> lock of the copy of its leaderboard
+_locks = {}
+# lock of _boards and _locks, only held to look them up
+_lock = threading.Lock()
+
+
+class Leaderboard:
+    ''' Participants of a game sorted by points (descending) and alias.'''
+    # Author: Pablo Cuesta Sierra
+
+    def __init__(self, participants):
+        ''' participants: iterable of (id, uuidP, alias, points)'''
+        self.keys = []
+        self.participants = {}
+        self.ids = {}
+        for participant in participants:
+            self.add(*participant)
+        self.keys.sort()
+
+    @staticmethod
+    def key(id, alias, points):
+        return (-points, alias, id)
+
+    def add(self, id, uuidP, alias, points, keep_sorted=False):
+        key = self.key(id, alias, points)
+        self.participants[id] = (uuidP, alias, points)
+        self.ids[str(uuidP)] = id
+        if keep_sorted:
+            bisect.insort(self.keys, key)
+        else:
+            self.keys.append(key)
+
+    def remove(self, id):
+        uuidP, alias, points = self.participants.pop(id)
+        del self.ids[str(uuidP)]
+        key = self.key(id, alias, points)
+        del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def add_points(self, id, points):
+        uuidP, alias, old_points = self.participants[id]
+        self.remove(id)
+        self.add(id, uuidP, alias, old_points + points, keep_sorted=True)
+
+    def entry(self, position):
+        points, alias, _ = self.keys[position]
+        return Entry(position + 1, alias, -points)
+
+    def top(self, k):
+        return [self.entry(position)
+                for position in range(min(k, len(self.keys)))]
+
+    def rank_of(self, uuidP):
+        id = self.ids.get(str(uuidP))
+        if id is None:
+            return None
+        _, alias, points = self.participants[id]
+        return self.entry(
+            bisect.bisect_left(self.keys, self.key(id, alias, points)))
+
+
+def _key(publicId):
+    return f'leaderboard:{publicId}'
+
+
+def _version(publicId):
+    version = cache.get(_key(publicId))
+    if version is None:
+        # random, so that it does not match an old copy of a process
+        cache.add(_key(publicId), random.getrandbits(48), VERSION_TIMEOUT)
+        version = cache.get(_key(publicId))
+    return version
+
+
+def _load(publicId):
+    Participant = apps.get_model('models', 'Participant')
+    return Leaderboard(Participant.objects.filter(game=publicId).values_list(
+        'id', 'uuidP', 'alias', 'points'))
+
+
+def _game_lock(publicId):
+    with _lock:
+        return _locks.setdefault(publicId, threading.Lock())
+
+
+def _keep(publicId, cached):
+    # called with the lock of the game held
+    with _lock:
+        _boards[publicId] = cached
+        _boards.move_to_end(publicId)
+        if len(_boards) > MAX_GAMES:
+            oldest, _ = _boards.popitem(last=False)
+            _locks.pop(oldest, None)
+
+
+@contextmanager
+def _board(publicId):
+    # the up to date copy of the leaderboard, with the lock of the game held
+    if not settings.CACHE_GAME_STATE:
+        yield _load(publicId)
+        return
+    with _game_lock(publicId):
+        version = _version(publicId)
+        with _lock:
+            cached = _boards.get(publicId)
+        if cached is None or cached[0] != version:
+            cached = (version, _load(publicId))
+        _keep(publicId, cached)
+        yield cached[1]
+
+
+def _incr(publicId):
+    try:
+        return cache.incr(_key(publicId))
+    except ValueError:  # the version is not in the cache
+        _version(publicId)
+        return cache.incr(_key(publicId))
+
+
+@contextmanager
+def changing(publicId):
+    ''' Context of a change of the participants (or their points) of a game
+    in the database. It yields a function that receives the same change as a
+    function of the Leaderboard, which is applied to the copy of this process
+    once the change is committed.'''
+    # Author: Pablo Cuesta Sierra
+    if not settings.CACHE_GAME_STATE:
+        yield lambda change: None  # there are no copies
+        return
+    # the copies are out of date from now on, until the change is committed
+    version = _incr(publicId)
+
+    changes = []
+    yield changes.append
+
+    def committed():
+        # the copies loaded before the commit (of any process) are discarded
+        committed_version = _incr(publicId)
+        with _game_lock(publicId):
+            with _lock:
+                cached = _boards.pop(publicId, None)
+            if cached is None or cached[0] != version - 1 or \
+                    committed_version != version + 1:
+                return  # the copy was out of date
+            try:
+                for change in changes:
+                    change(cached[1])
+            except KeyError:  # participants added without changing
+                return
+            _keep(publicId, (committed_version, cached[1]))
+
+    # at once if there is no transaction
+    transaction.on_commit(committed)
+
+
+def top(publicId, k):
+    ''' Returns the first k entries (rank, alias and points) of the
+    leaderboard of the game.'''
+    # Author: Pablo Cuesta Sierra
+    with _board(publicId) as board:
+        return board.top(k)
+
+
+def rank_of(publicId, uuidP):
+    ''' Returns the entry (rank, alias and points) of the participant in the
+    leaderboard of the game, or None if it is not a participant.'''
+    # Author: Pablo Cuesta Sierra
+    with _board(publicId) as board:
+        return board.rank_of(uuidP)
+
+
+def forget(publicId):
+    ''' Discards every copy of the leaderboard of the game. It has to be
+    called after changing its participants in any other way.'''
+    # Author: Pablo Cuesta Sierra
+    cache.delete(_key(publicId))
+    with _lock:
+        _boards.pop(publicId, None)
+
+
+@receiver(post_delete, sender='models.Game')
+def _game_deleted(sender, instance, **kwargs):
+    forget(instance.publicId)
@@ -0,0 +1,74 @@
+''' Live state of the games.
+
+Players poll the state of their game every second, so the fields of every
+active game are kept in the cache and written through each time the game is
+saved (see Game.save). A poll is answered from the cache and only reaches the
+database the first time a game is requested by a process (or after the entry
+expires).
+
+The changes are only seen by every worker process if the cache is shared by
+all of them, so the games are only kept in the cache if
+settings.CACHE_GAME_STATE is set (see settings.CACHES); otherwise they are
+read from the database.
+'''
+# Author: Álvaro Zamanillo Sáez
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+''' Seconds a game is kept in the cache since its last update '''
+LIVE_TIMEOUT = 2 * 60 * 60
+
+
+def _key(publicId):
+    return f'game:{publicId}'
+
+
+def store(game):
+    ''' Writes the current fields of the game in the cache.'''
+    # Author: Álvaro Zamanillo Sáez
+    if not settings.CACHE_GAME_STATE:
+        return
+    fields = {
+        field.attname: getattr(game, field.attname)
+        for field in game._meta.concrete_fields
+    }
+    cache.set(_key(game.publicId), fields, LIVE_TIMEOUT)
+
+
+def forget(publicId):
+    ''' Removes a game from the cache.'''
+    # Author: Álvaro Zamanillo Sáez
+    cache.delete(_key(publicId))
+
+
+def get(publicId):
+    ''' Returns the game with the given publicId as stored in the cache,
+    loading it from the database if it is not cached. Returns None if the game
+    does not exist.
+    The returned object must only be read: saving it would overwrite changes
+    made by other processes.'''
+    # Author: Álvaro Zamanillo Sáez
+    Game = apps.get_model('models', 'Game')
+    try:
+        publicId = int(publicId)
+    except (TypeError, ValueError):
+        return None
+
+    fields = (cache.get(_key(publicId)) if settings.CACHE_GAME_STATE
+              else None)
+    if fields is None:
+        game = Game.objects.filter(publicId=publicId).first()
+        if game is not None:
+            store(game)
+        return game
+
+    return Game.from_db(None, list(fields), list(fields.values()))
+
+
+@receiver(post_delete, sender='models.Game')
+def _game_deleted(sender, instance, **kwargs):
+    # also called when the game is deleted in cascade
+    forget(instance.publicId)
@@ -0,0 +1,51 @@
+''' Changes of the participants of the games shown in the lobby of the host.
+
+The lobby is refreshed with the participants that joined or left since the
+last refresh (see GameUpdateParticipant), so its traffic depends on the
+changes and not on the number of participants. The participants that joined
+are the ones with an id greater than the last one seen; the aliases of the
+participants removed are logged here, in the cache, in order. The log is
+only kept if settings.CACHE_GAME_STATE is set (see models/livestate.py);
+otherwise the whole lobby is sent in each refresh.
+'''
+# Author: Álvaro Zamanillo Sáez
+from django.conf import settings
+from django.core.cache import cache
+
+''' Seconds the log of a game is kept in the cache since its last removal '''
+LOG_TIMEOUT = 2 * 60 * 60
+
+
+def _key(publicId):
+    return f'lobby:{publicId}:removed'
+
+
+def log_removal(publicId, alias):
+    ''' Logs that the participant with this alias left the game.'''
+    # Author: Álvaro Zamanillo Sáez
+    if not settings.CACHE_GAME_STATE:
+        return
+    # participants are only removed by the host, one by one
+    removed = cache.get(_key(publicId), [])
+    removed.append(alias)
+    cache.set(_key(publicId), removed, LOG_TIMEOUT)
+
+
+def removed_since(publicId, n_seen):
+    ''' Returns the aliases removed from the game after the first n_seen
+    removals, and the total number of removals. If less than n_seen
+    removals are logged (the log expired) None is returned instead of the
+    aliases (always if the log is not kept).'''
+    # Author: Álvaro Zamanillo Sáez
+    if not settings.CACHE_GAME_STATE:
+        return None, 0
+    removed = cache.get(_key(publicId), [])
+    if n_seen > len(removed):
+        return None, len(removed)
+    return removed[n_seen:], len(removed)
+
+
+def forget(publicId):
+    ''' Removes the log of a game.'''
+    # Author: Álvaro Zamanillo Sáez
+    cache.delete(_key(publicId))
@@ -0,0 +1,230 @@
+import random
+import time
+from importlib import import_module
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.forms import ValidationError
+from rest_framework.renderers import JSONRenderer
+
+from models import leaderboard
+from models.models import (
+    Answer, Game, Guess, Participant, Question, Questionnaire, User,
+    MAX_PUBLICID)
+from restServer import serializer
+
+
+class Command(BaseCommand):
+    # Author: Álvaro Zamanillo Sáez
+    help = """Measure the latency of the game hot paths. Every row created
+           by a benchmark is rolled back when it finishes, so it can be run
+           against a database with real data."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'target',
+            choices=self.targets(),
+            help='hot path to measure',
+        )
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[0, 1000, 10000, 100000],
+            help='table sizes (or number of players) to measure with',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=100,
+            help='number of operations measured for each size',
+        )
+
+    @classmethod
+    def targets(cls):
+        return [name[len('bench_'):] for name in dir(cls)
+                if name.startswith('bench_')]
+
+    def handle(self, *args, **kwargs):
+        """this function will be executed by default"""
+        self.sizes = kwargs.get('sizes')
+        self.repeat = kwargs.get('repeat')
+
+        # a single process: the state of the games can be kept in its cache
+        with override_settings(CACHE_GAME_STATE=True), transaction.atomic():
+            self.user = User.objects.create_user(username='__benchmark')
+            self.questionnaire = Questionnaire.objects.create(
+                title='__benchmark', user=self.user)
+            getattr(self, 'bench_' + kwargs.get('target'))()
+            # undo every change made by the benchmark
+            transaction.set_rollback(True)
+
+    def report(self, label, timings):
+        ''' Prints the mean and percentiles (in ms) of a list of timings
+        (in seconds).'''
+        timings = sorted(timings)
+        n = len(timings)
+        self.stdout.write(
+            f'{label:>30}: '
+            f'mean={1000 * sum(timings) / n:8.3f}ms '
+            f'p50={1000 * timings[n // 2]:8.3f}ms '
+            f'p99={1000 * timings[min(n - 1, n * 99 // 100)]:8.3f}ms '
+            f'(n={n})'
+        )
+
+    def bench_publicid(self):
+        ''' Latency of the creation of a game depending on the number of
+        games already stored.'''
+        for size in self.sizes:
+            size = min(size, MAX_PUBLICID - self.repeat)
+            stored = Game.objects.count()
+            if size > stored:
+                publicIds = set(Game.objects.values_list(
+                    'publicId', flat=True))
+                new = set()
+                while len(new) < size - stored:
+                    publicId = random.randint(1, MAX_PUBLICID)
+                    if publicId not in publicIds:
+                        new.add(publicId)
+                Game.objects.bulk_create(
+                    [Game(publicId=publicId,
+                          questionnaire=self.questionnaire)
+                     for publicId in new],
+                    batch_size=5000,
+                )
+
+            label = f'{Game.objects.count()} games stored'
+            timings = []
+            for _ in range(self.repeat):
+                start = time.perf_counter()
+                Game.objects.create(questionnaire=self.questionnaire)
+                timings.append(time.perf_counter() - start)
+
+            self.report(label, timings)
+
+    def bench_join(self):
+        ''' Latency of a participant joining a game depending on the number
+        of participants already in it, with a free alias and with a taken
+        alias replaced by a suggestion.'''
+        for size in self.sizes:
+            game = Game.objects.create(questionnaire=self.questionnaire)
+            Participant.objects.bulk_create(
+                [Participant(game=game, alias=f'player{n}')
+                 for n in range(size)],
+                batch_size=5000,
+            )
+
+            timings = []
+            for n in range(self.repeat):
+                start = time.perf_counter()
+                Participant.objects.create(game=game, alias=f'new{n}')
+                timings.append(time.perf_counter() - start)
+            self.report(f'{size} players, free alias', timings)
+
+            timings = []
+            for n in range(self.repeat):
+                start = time.perf_counter()
+                try:
+                    Participant.objects.create(game=game, alias=f'new{n}')
+                except ValidationError:
+                    Participant.objects.create(
+                        game=game,
+                        alias=Participant.suggest_alias(game, f'new{n}'))
+                timings.append(time.perf_counter() - start)
+            self.report(f'{size} players, taken alias', timings)
+
+    def bench_leaderboard(self):
+        ''' Latency of the reads of the leaderboard and of moving a
+        participant in it after scoring, depending on the number of
+        participants of the game.'''
+        for size in self.sizes:
+            game = Game.objects.create(questionnaire=self.questionnaire)
+            Participant.objects.bulk_create(
+                [Participant(game=game, alias=f'player{n}', points=n % 1000)
+                 for n in range(size)],
+                batch_size=5000,
+            )
+            leaderboard.forget(game.publicId)
+            participants = list(Participant.objects.filter(game=game)
+                                .values_list('id', 'uuidP')[:self.repeat])
+            if not participants:
+                continue
+
+            start = time.perf_counter()
+            leaderboard.top(game.publicId, 1)
+            self.report(f'{size} players, load', [time.perf_counter() - start])
+
+            timings = []
+            for id, uuidP in participants:
+                start = time.perf_counter()
+                # the copy is changed when the change is committed: the
+                # benchmark is rolled back, so it is done at once
+                with TestCase.captureOnCommitCallbacks(execute=True), \
+                        leaderboard.changing(game.publicId) as change:
+                    change(lambda board: board.add_points(id, 500))
+                leaderboard.rank_of(game.publicId, uuidP)
+                leaderboard.top(game.publicId, 10)
+                timings.append(time.perf_counter() - start)
+            self.report(f'{size} players, score+read', timings)
+
+    def bench_serializers(self):
+        ''' CPU time of building the json responses of the endpoints polled
+        by the players with the model serializers and by hand (see
+        restServer/serializer.py).'''
+        question = Question.objects.create(
+            question='__benchmark', questionnaire=self.questionnaire)
+        answer = Answer.objects.create(answer='__benchmark', question=question)
+        game = Game.objects.create(questionnaire=self.questionnaire)
+        participant = Participant.objects.create(game=game, alias='player')
+        guess = Guess(game=game, participant=participant, question=question,
+                      answer=answer)
+        renderer = JSONRenderer()
+
+        for label, instance, model_serializer, data in (
+            ('game', game, serializer.GameSerializer, serializer.game_data),
+            ('participant', participant, serializer.ParticipantSerializer,
+             serializer.participant_data),
+            ('guess', guess, serializer.GuessSerializer,
+             serializer.guess_data),
+        ):
+            for kind, build in (
+                ('serializer', lambda: model_serializer(instance).data),
+                ('by hand', lambda: data(instance)),
+            ):
+                timings = []
+                for _ in range(self.repeat):
+                    start = time.process_time()
+                    renderer.render(build())
+                    timings.append(time.process_time() - start)
+                self.report(f'{label}, {kind}', timings)
+
+    def bench_sessions(self):
+        ''' Latency and queries of reading the session of the host in each of
+        its polls (see services/views.py), with the sessions stored in the
+        database and with the sessions kept in the cache too (see
+        settings.SESSION_ENGINE).'''
+        game = Game.objects.create(questionnaire=self.questionnaire)
+        for engine in ('db', 'cached_db'):
+            SessionStore = import_module(
+                f'django.contrib.sessions.backends.{engine}').SessionStore
+            session = SessionStore()
+            session['publicId'] = game.publicId
+            session['started'] = True
+            session.save()
+
+            timings = []
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(self.repeat):
+                    start = time.perf_counter()
+                    # as SessionMiddleware does in each request
+                    polled = SessionStore(session.session_key)
+                    polled['publicId'], polled['started']
+                    if polled.modified:
+                        polled.save()
+                    timings.append(time.perf_counter() - start)
+            self.report(f'{engine}, '
+                        f'{len(queries) / self.repeat:.1f} queries/poll',
+                        timings)
+            session.delete()
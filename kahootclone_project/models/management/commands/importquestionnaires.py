@@ -0,0 +1,50 @@
+import codecs
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.forms import ValidationError
+
+from models import questionnairefile
+from models.models import User
+
+
+class Command(BaseCommand):
+    # Author: Pablo Cuesta Sierra
+    help = """Create questionnaires of a user from files in the formats of
+           models/questionnairefile.py (.csv, or .json with a question per
+           line). Each questionnaire is titled as its file."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'username',
+            help='owner of the questionnaires',
+        )
+        parser.add_argument(
+            'files',
+            nargs='+',
+            help='files of the questionnaires',
+        )
+
+    def handle(self, *args, **kwargs):
+        """this function will be executed by default"""
+        user = User.objects.filter(username=kwargs.get('username')).first()
+        if user is None:
+            raise CommandError('The user does not exist')
+
+        n_failed = 0
+        for path in kwargs.get('files'):
+            title = os.path.splitext(os.path.basename(path))[0][:100]
+            try:
+                with open(path, 'rb') as file:
+                    questionnaire = questionnairefile.import_questionnaire(
+                        user, title, codecs.iterdecode(file, 'utf-8-sig'),
+                        questionnairefile.format_of(path))
+            except (OSError, ValidationError) as e:
+                n_failed += 1
+                self.stderr.write(f'{path}: {e}')
+                continue
+            self.stdout.write(
+                f'{path}: questionnaire {questionnaire.id} with '
+                f'{questionnaire.question_set.count()} questions')
+        if n_failed:
+            raise CommandError(f'{n_failed} files were not imported')
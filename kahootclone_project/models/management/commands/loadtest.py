@@ -0,0 +1,213 @@
+import asyncio
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from models.models import (
+    Answer, Game, Participant, Question, Questionnaire, User)
+
+''' ASGI applications compared: the Django application alone, where the
+    viewsets run in its single thread, and the application served (see
+    kahootclone/asgi.py), where the API is handled in a pool of threads '''
+APPLICATIONS = {
+    'django': 'kahootclone.asgi:django_application',
+    'asgi': 'kahootclone.asgi:application',
+}
+
+
+async def http_request(reader, writer, method, path, data=None):
+    ''' Sends a request through an open HTTP/1.1 connection and returns the
+    status code and the body of the response.'''
+    # Author: Álvaro Zamanillo Sáez
+    body = b'' if data is None else json.dumps(data).encode()
+    writer.write(
+        f'{method} {path} HTTP/1.1\r\nHost: localhost\r\n'
+        f'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length, chunked = 0, False
+    while True:
+        line = (await reader.readline()).decode()
+        if line in ('\r\n', ''):
+            break
+        name, _, value = line.partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+        elif name.lower() == 'transfer-encoding':
+            chunked = 'chunked' in value
+
+    if not chunked:
+        return status, await reader.readexactly(length)
+    body = b''
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        chunk = await reader.readexactly(size + 2)
+        if not size:
+            return status, body
+        body += chunk[:-2]
+
+
+class Command(BaseCommand):
+    # Author: Álvaro Zamanillo Sáez
+    help = """Measure the throughput and latency of the endpoints of the
+           players (join, guess and game state) served by uvicorn with many
+           concurrent clients, for each ASGI application. The rows created
+           are deleted when it finishes."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--players',
+            type=int,
+            default=1000,
+            help='players that join and guess',
+        )
+        parser.add_argument(
+            '--polls',
+            type=int,
+            default=5000,
+            help='requests of the state of the game',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=100,
+            help='clients sending requests at once',
+        )
+        parser.add_argument(
+            '--applications',
+            nargs='+',
+            choices=list(APPLICATIONS),
+            default=list(APPLICATIONS),
+            help='ASGI applications to compare',
+        )
+
+    def handle(self, *args, **kwargs):
+        """this function will be executed by default"""
+        self.players = kwargs.get('players')
+        self.polls = kwargs.get('polls')
+        self.concurrency = kwargs.get('concurrency')
+        if importlib.util.find_spec('uvicorn') is None:
+            raise CommandError(
+                'The applications are served with uvicorn: install it with '
+                'pip install -r requirements.txt')
+
+        User.objects.filter(username='__loadtest').delete()
+        user = User.objects.create_user(username='__loadtest')
+        try:
+            questionnaire = Questionnaire.objects.create(
+                title='__loadtest', user=user)
+            question = Question.objects.create(
+                question='__loadtest', questionnaire=questionnaire,
+                answerTime=3600)
+            for n in range(2):
+                Answer.objects.create(
+                    answer=f'answer{n}', question=question, correct=n == 0)
+            self.waiting = Game.objects.create(questionnaire=questionnaire)
+            self.playing = Game.objects.create(questionnaire=questionnaire)
+            self.playing.update_state()
+
+            for name in kwargs.get('applications'):
+                self.measure(name)
+        finally:
+            user.delete()
+
+    def measure(self, name):
+        ''' Measures every endpoint served with the ASGI application.'''
+        guessing = Participant.objects.bulk_create(
+            [Participant(game=self.playing, alias=f'{name}{n}')
+             for n in range(self.players)],
+            batch_size=5000,
+        )
+        endpoints = {
+            'join': ('POST', '/api/participant/', 201, [
+                {'game': self.waiting.publicId, 'alias': f'{name}{n}'}
+                for n in range(self.players)]),
+            'state': ('GET', f'/api/games/{self.playing.publicId}/', 200,
+                      [None] * self.polls),
+            'guess': ('POST', '/api/guess/', 201, [
+                {'game': self.playing.publicId, 'uuidp': str(p.uuidP),
+                 'answer': 0} for p in guessing]),
+        }
+
+        with socket.socket() as sock:  # a free port
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', APPLICATIONS[name],
+             '--port', str(port), '--log-level', 'warning',
+             '--no-access-log', '--lifespan', 'off'],
+            cwd=settings.BASE_DIR, env=os.environ.copy())
+        try:
+            self.wait_for_server(port)
+            for endpoint, (method, path, expected, data) in endpoints.items():
+                self.report(f'{name} {endpoint}', *asyncio.run(
+                    self.load(port, method, path, expected, data)))
+        finally:
+            server.terminate()
+            server.wait()
+
+    @staticmethod
+    def wait_for_server(port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    async def load(self, port, method, path, expected, data):
+        ''' Sends a request for each item of data from concurrent clients.
+        Output: elapsed seconds, latencies (in seconds) of the successful
+        requests and number of errors.'''
+        pending = list(reversed(data))
+        timings = []
+        errors = 0
+
+        async def client():
+            nonlocal errors
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            while pending:
+                item = pending.pop()
+                start = time.perf_counter()
+                try:
+                    status, _ = await http_request(
+                        reader, writer, method, path, item)
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    errors += 1
+                    writer.close()
+                    reader, writer = await asyncio.open_connection(
+                        '127.0.0.1', port)
+                    continue
+                if status == expected:
+                    timings.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+            writer.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(self.concurrency)))
+        return time.perf_counter() - start, timings, errors
+
+    def report(self, label, elapsed, timings, errors):
+        ''' Prints the throughput and the latency percentiles (in ms).'''
+        timings = sorted(timings) or [0]
+        n = len(timings)
+        self.stdout.write(
+            f'{label:>15}: '
+            f'{(n + errors) / elapsed:8.1f} req/s '
+            f'p50={1000 * timings[n // 2]:8.3f}ms '
+            f'p99={1000 * timings[min(n - 1, n * 99 // 100)]:8.3f}ms '
+            f'errors={errors}'
+        )
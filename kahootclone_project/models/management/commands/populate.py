@@ -6,77 +6,127 @@
 # that is, populate.py.
 #
 # execute python manage.py  populate
+# (python manage.py populate --help shows the sizes that can be given)
 #
 # use module Faker generator to generate data
 # (https://zetcode.com/python/faker/)
-import os
+import random
+from itertools import islice
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
 from models.models import Questionnaire as Questionnaire
 from models.models import Question as Question
 from models.models import Answer as Answer
 from models.models import Game as Game
+from models.models import GameCounter as GameCounter
 from models.models import Participant as Participant
 from models.models import Guess as Guess
+from models.models import MAX_PUBLICID
+from models import leaderboard, lobby
+from models.constants import WAITING, LEADERBOARD
 
 from faker import Faker
 
-from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 
 User = get_user_model()
 
+''' Rows inserted by each query '''
+CHUNK_SIZE = 5000
+
 
 # The name of this class is not optional must be Command
 # otherwise manage.py will not process it properly
 class Command(BaseCommand):
     # helps and arguments shown when command python manage.py help populate
     # is executed.
-    help = """populate kahootclone database
+    help = """populate kahootclone database. The rows are inserted in
+           chunks with explicit ids, so that large datasets (e.g. a million
+           guesses) can be generated for benchmarking.
            """
-    # if you want to pass an argument to the function
-    # uncomment this line
-    # def add_arguments(self, parser):
-    #    parser.add_argument('publicId',
-    #        type=int,
-    #        help='game the participants will join to')
-    #    parser.add_argument('sleep',
-    #        type=float,
-    #        default=2.,
-    #        help='wait this seconds until inserting next participant')
-
-    def __init__(self, sneaky=True, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # "if 'RENDER'" allows you to deal with different
-        # behaviour in render.com and locally
-        # That is, we check a variable ('RENDER')
-        # that is only defined in render.com
-        if 'RENDER' in os.environ:
-            pass
-        else:
-            pass
-
-        self.NUMBERUSERS = 4
-        self.NUMBERQESTIONARIES = 30
-        self.NUMBERQUESTIONS = 100
-        self.NUMBERPARTICIPANTS = 20
-        self.NUMBERANSWERPERQUESTION = 4
-        self.NUMBERGAMES = 4
+
+    def add_arguments(self, parser):
+        for name, default, help in (
+            ('users', 4, 'users created'),
+            ('questionnaires', 30, 'questionnaires, of random users'),
+            ('questions', 100, 'questions, of random questionnaires'),
+            ('answers', 4, 'answers of each question (at most 4)'),
+            ('games', 4, 'games, of random questionnaires'),
+            ('participants', 20, 'participants of each game'),
+            ('guesses', 0, 'guesses, spread over the participants'),
+        ):
+            parser.add_argument(
+                f'--{name}', type=int, default=default, help=help)
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=None,
+            help='seed of the random data',
+        )
 
     # handle is another compulsory name, do not change it"
     # handle function will be executed by 'manage populate'
     def handle(self, *args, **kwargs):
         "this function will be executed by default"
+        self.NUMBERUSERS = kwargs.get('users')
+        self.NUMBERQESTIONARIES = kwargs.get('questionnaires')
+        self.NUMBERQUESTIONS = kwargs.get('questions')
+        self.NUMBERANSWERPERQUESTION = kwargs.get('answers')
+        self.NUMBERGAMES = kwargs.get('games')
+        self.NUMBERPARTICIPANTS = kwargs.get('participants')
+        self.NUMBERGUESSES = kwargs.get('guesses')
+        if not 1 <= self.NUMBERANSWERPERQUESTION <= 4:
+            raise CommandError('A question has from 1 to 4 answers')
+        if self.NUMBERGAMES > MAX_PUBLICID:
+            raise CommandError(f'There can only be {MAX_PUBLICID} games')
+        if self.NUMBERQESTIONARIES and not self.NUMBERUSERS:
+            raise CommandError('The questionnaires need users')
+        if ((self.NUMBERQUESTIONS or self.NUMBERGAMES)
+                and not self.NUMBERQESTIONARIES):
+            raise CommandError('The questions and games need questionnaires')
 
         self.cleanDataBase()   # clean database
         # The faker.Faker() creates and initializes a faker generator,
         self.faker = Faker()
-        self.user()  # create users
-        self.questionnaire()  # create questionaries
-        self.question()  # create questions
-        self.answer()  # create answers
-        self.game()  # create games
+        self.random = random.Random(kwargs.get('seed'))
+        self.faker.seed_instance(kwargs.get('seed'))
+        with transaction.atomic():
+            self.user()  # create users
+            self.questionnaire()  # create questionaries
+            self.question()  # create questions
+            self.answer()  # create answers
+            self.game()  # create games
+            self.participant()  # create participants and their guesses
+            self.resetSequences()
+
+    def insert(self, model, objects):
+        ''' Inserts the objects (an iterable) in chunks of CHUNK_SIZE.
+        Output: number of objects inserted.'''
+        # Author: Pablo Cuesta Sierra
+        objects = iter(objects)
+        n_inserted = 0
+        while True:
+            chunk = list(islice(objects, CHUNK_SIZE))
+            if not chunk:
+                return n_inserted
+            model.objects.bulk_create(chunk)
+            n_inserted += len(chunk)
+
+    def resetSequences(self):
+        ''' The ids are given explicitly (the tables are empty), so the
+        sequences of the ids have to be moved after them.'''
+        # Author: Pablo Cuesta Sierra
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [User, Questionnaire, Question, Answer,
+                                 Participant, Guess]):
+                cursor.execute(sql)
 
     def cleanDataBase(self):
         # Author: Álvaro Zamanillo Sáez
@@ -99,85 +149,203 @@ class Command(BaseCommand):
         # create user
         print("Users")
 
-        for _ in range(self.NUMBERUSERS):
-            username = self.faker.user_name()
-            password = self.faker.password()
-            # we log the users and passwords created
-            # so that they can be later used
-            # (they are encrypted in the database)
+        # hashing a password is slow on purpose: all the users share one
+        password = self.faker.password()
+        hashed = make_password(password)
+        usernames = [f'{self.faker.user_name()}{id}'
+                     for id in range(1, self.NUMBERUSERS + 1)]
+        # we log the users and passwords created
+        # so that they can be later used
+        # (they are encrypted in the database)
+        for username in usernames[:10]:
             print((
                 '[populate.py]: Creating user with'
                 f' username="{username}"'
                 f' and password="{password}"'))
-            User.objects.create_user(
-                username=username,
-                email=self.faker.email(),
-                password=password
-            )
+        if len(usernames) > 10:
+            print(f'[populate.py]: and {len(usernames) - 10} more users '
+                  'with the same password')
+        self.insert(User, (
+            User(id=id, username=username, password=hashed,
+                 email=self.faker.email())
+            for id, username in enumerate(usernames, 1)
+        ))
 
     def questionnaire(self):
         "insert questionnaires"
         # Author: Álvaro Zamanillo Sáez
         print("questionnaire")
 
-        for _ in range(self.NUMBERQESTIONARIES):
-            q = Questionnaire()
-            q.title = self.faker.word()
-            q.created_at = self.faker.date_time_this_decade(
-                tzinfo=timezone.get_current_timezone())
-            q.updated_at = self.faker.date_time_this_decade(
-                tzinfo=timezone.get_current_timezone())
-            q.user = User.objects.order_by('?').first()
-            q.save()
+        self.insert(Questionnaire, (
+            Questionnaire(
+                id=id,
+                title=self.faker.word(),
+                user_id=self.random.randint(1, self.NUMBERUSERS),
+            )
+            for id in range(1, self.NUMBERQESTIONARIES + 1)
+        ))
 
     def question(self):
         " insert questions, assign randomly to questionnaires"
         # Author: Álvaro Zamanillo Sáez
         print("Question")
 
-        for _ in range(self.NUMBERQUESTIONS):
-            q = Question()
-            q.question = self.faker.sentence()
-            q.created_at = self.faker.date_time_this_decade(
-                tzinfo=timezone.get_current_timezone())
-            q.updated_at = self.faker.date_time_this_decade(
-                tzinfo=timezone.get_current_timezone())
-            q.answerTime = self.faker.random_int(min=1, max=10)
-            q.questionnaire = Questionnaire.objects.order_by('?').first()
-            q.save()
+        # questions of each questionnaire, as (id, answerTime), in order
+        self.questions = {}
+        for id in range(1, self.NUMBERQUESTIONS + 1):
+            self.questions.setdefault(
+                self.random.randint(1, self.NUMBERQESTIONARIES), []).append(
+                (id, self.random.randint(1, 10)))
+        self.insert(Question, (
+            Question(id=id, question=self.faker.sentence()[:100],
+                     questionnaire_id=questionnaire, answerTime=answerTime)
+            for questionnaire, questions in self.questions.items()
+            for id, answerTime in questions
+        ))
 
     def answer(self):
         "insert answers, one of them must be the correct one"
         # Author: Álvaro Zamanillo Sáez
         print("Answer")
-        # your code goes here
         # assign answer randomly to the questions
         # maximum number of answers per question is four
         # one of them must be the correct one
+        # (the answers of question q have ids from
+        # (q - 1) * NUMBERANSWERPERQUESTION + 1)
 
-        for q in Question.objects.all():
-            for _ in range(self.NUMBERANSWERPERQUESTION):
-                a = Answer()
-                a.answer = self.faker.sentence()
-                a.correct = False
-                a.question = q
-                a.save()
-
-            a = Answer.objects.filter(question=q).order_by('?').first()
-            a.correct = True
-            a.save()
+        # position of the correct answer of each question
+        self.correct = [self.random.randrange(self.NUMBERANSWERPERQUESTION)
+                        for _ in range(self.NUMBERQUESTIONS + 1)]
+        self.insert(Answer, (
+            Answer(id=(question - 1) * self.NUMBERANSWERPERQUESTION + n + 1,
+                   answer=self.faker.sentence()[:100],
+                   question_id=question,
+                   correct=n == self.correct[question])
+            for question in range(1, self.NUMBERQUESTIONS + 1)
+            for n in range(self.NUMBERANSWERPERQUESTION)
+        ))
 
     def game(self):
         "insert some games"
         # Author: Álvaro Zamanillo Sáez
         print("Game")
-        # your code goes here
         # choose at random the questionnaries
+        # each participant guesses the first questions of its game, as many
+        # as needed to make the guesses asked for
+
+        self.games = [
+            (publicId, self.random.randint(1, self.NUMBERQESTIONARIES))
+            for publicId in self.random.sample(
+                range(1, MAX_PUBLICID + 1), self.NUMBERGAMES)
+        ]
+        self.guessesPerParticipant = self.spreadGuesses()
+
+        games, counters = [], []
+        for (publicId, questionnaire), quotas in zip(
+                self.games, self.guessesPerParticipant):
+            guessed = max(quotas, default=0)
+            # the games with guesses are over
+            games.append(Game(
+                publicId=publicId,
+                questionnaire_id=questionnaire,
+                countdownTime=self.random.randint(1, 10),
+                state=LEADERBOARD if guessed else WAITING,
+                questionNo=guessed,
+            ))
+            counters.append(GameCounter(
+                game_id=publicId,
+                participants=self.NUMBERPARTICIPANTS,
+                questionNo=max(guessed - 1, 0),
+                answered=quotas.count(guessed) if guessed else 0,
+            ))
+        self.insert(Game, games)
+        self.insert(GameCounter, counters)
+        for publicId, _ in self.games:
+            # as in Game.save, the publicId may have been used before
+            leaderboard.forget(publicId)
+            lobby.forget(publicId)
+
+    def spreadGuesses(self):
+        ''' Spreads the guesses asked for over the participants as evenly as
+        the questions of their games allow (a participant guesses each
+        question once at most).
+        Output: list with the number of guesses of each participant of each
+        game.'''
+        # Author: Pablo Cuesta Sierra
+        sizes = [len(self.questions.get(questionnaire, []))
+                 for _, questionnaire in self.games]
+        n_guesses = self.NUMBERGUESSES
+        capacity = self.NUMBERPARTICIPANTS * sum(sizes)
+        if n_guesses > capacity:
+            self.stderr.write(
+                f'Only {capacity} guesses fit in the questions of the games '
+                f'({n_guesses} asked for)')
+            n_guesses = capacity
+
+        def spread(share):
+            return self.NUMBERPARTICIPANTS * sum(
+                min(share, size) for size in sizes)
+
+        # largest share of guesses that every participant can take (or as
+        # many as the questions of its game), by binary search
+        low, high = 0, max(sizes, default=0)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if spread(middle) <= n_guesses:
+                low = middle
+            else:
+                high = middle - 1
+        # the rest, one more to the participants with questions left
+        remainder = n_guesses - spread(low)
+        quotas = []
+        for size in sizes:
+            quotas.append([])
+            for _ in range(self.NUMBERPARTICIPANTS):
+                extra = 1 if remainder and size > low else 0
+                remainder -= extra
+                quotas[-1].append(min(low, size) + extra)
+        return quotas
+
+    def participant(self):
+        "insert the participants of the games and their guesses"
+        # Author: Pablo Cuesta Sierra
+        print("Participant and Guess")
+
+        score = import_string(settings.SCORING_ENGINE)
+        participants, guesses = [], []
+        n_participants = n_guesses = 0
+
+        def flush():
+            # the participants are inserted before their guesses
+            self.insert(Participant, participants)
+            self.insert(Guess, guesses)
+            participants.clear()
+            guesses.clear()
 
-        for _ in range(self.NUMBERGAMES):
-            g = Game()
-            g.created_at = self.faker.date_time_this_decade(
-                tzinfo=timezone.get_current_timezone())
-            g.questionnaire = Questionnaire.objects.order_by('?').first()
-            g.countdownTime = self.faker.random_int(min=1, max=10)
-            g.save()
+        for (publicId, questionnaire), quotas in zip(
+                self.games, self.guessesPerParticipant):
+            questions = self.questions.get(questionnaire, [])
+            for n, quota in enumerate(quotas):
+                n_participants += 1
+                points = 0
+                for question, answerTime in questions[:quota]:
+                    n_guesses += 1
+                    answer = self.random.randrange(
+                        self.NUMBERANSWERPERQUESTION)
+                    elapsed = self.random.randint(0, 1000 * answerTime)
+                    correct = answer == self.correct[question]
+                    points += score(correct, elapsed, answerTime)
+                    guesses.append(Guess(
+                        id=n_guesses, participant_id=n_participants,
+                        game_id=publicId, question_id=question,
+                        answer_id=(question - 1)
+                        * self.NUMBERANSWERPERQUESTION + answer + 1,
+                        responseTime=elapsed,
+                    ))
+                participants.append(Participant(
+                    id=n_participants, game_id=publicId, alias=f'player{n}',
+                    points=points))
+                if max(len(participants), len(guesses)) >= CHUNK_SIZE:
+                    flush()
+        flush()
+        print(f'{n_participants} participants, {n_guesses} guesses')
@@ -0,0 +1,267 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+from django.forms import ValidationError
+from django.utils import timezone
+
+from models import guessbuffer, livestate, rounds, scoring
+from models.constants import ANSWER, LEADERBOARD, QUESTION, WAITING
+from models.models import (
+    Answer, Game, GameCounter, Guess, Participant, Question, Questionnaire,
+    User)
+
+''' Distributions of the think time of the players, given its mean (in
+    seconds) '''
+THINK_TIMES = {
+    'constant': lambda rng, mean: mean,
+    'uniform': lambda rng, mean: rng.uniform(0, 2 * mean),
+    'exponential': lambda rng, mean: rng.expovariate(1 / mean) if mean else 0,
+}
+
+
+class Command(BaseCommand):
+    # Author: Pablo Cuesta Sierra
+    help = """Simulate a whole game played by many concurrent players: they
+           join, wait for each question and guess it after a think time,
+           running in a pool of threads against the ORM while the host moves
+           the game. It reports the throughput, the latency of each
+           operation and the updates lost (joins, guesses or points
+           acknowledged but not stored). The rows created are deleted when
+           it finishes."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--players',
+            type=int,
+            default=100,
+            help='players that join the game',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=32,
+            help='threads running the operations of the players',
+        )
+        parser.add_argument(
+            '--questions',
+            type=int,
+            default=5,
+            help='questions of the game',
+        )
+        parser.add_argument(
+            '--answer-time',
+            type=int,
+            default=10,
+            help='seconds to answer each question',
+        )
+        parser.add_argument(
+            '--think',
+            choices=list(THINK_TIMES),
+            default='exponential',
+            help='distribution of the think time of the players',
+        )
+        parser.add_argument(
+            '--think-mean',
+            type=float,
+            default=2,
+            help='mean think time (in seconds) before joining and guessing',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=None,
+            help='seed of the think times and answers',
+        )
+
+    def handle(self, *args, **kwargs):
+        """this function will be executed by default"""
+        self.players = kwargs.get('players')
+        self.n_questions = kwargs.get('questions')
+        self.answer_time = kwargs.get('answer_time')
+        self.random = random.Random(kwargs.get('seed'))
+        think, mean = THINK_TIMES[kwargs.get('think')], kwargs.get(
+            'think_mean')
+        self.think = lambda: think(self.random, mean)
+
+        # latencies (in seconds) and errors of each operation
+        self.timings = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+        User.objects.filter(username='__simulation').delete()
+        user = User.objects.create_user(username='__simulation')
+        try:
+            self.create_questionnaire(user)
+            with ThreadPoolExecutor(kwargs.get('workers')) as pool:
+                self.play(pool)
+            self.report()
+        finally:
+            user.delete()
+
+    def create_questionnaire(self, user):
+        questionnaire = Questionnaire.objects.create(
+            title='__simulation', user=user)
+        for n in range(self.n_questions):
+            question = Question.objects.create(
+                question=f'question{n}', questionnaire=questionnaire,
+                answerTime=self.answer_time)
+            for a in range(4):
+                Answer.objects.create(
+                    answer=f'answer{a}', question=question, correct=a == 0)
+        self.questionnaire = questionnaire
+
+    def measure(self, operation, function, *args):
+        ''' Runs an operation of a player, keeping its latency if it
+        succeeds and counting it as an error (by kind) otherwise.
+        Output: the result of the function, or None if it failed.'''
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+        except ValidationError as e:
+            error = e.messages[0]
+        except DatabaseError as e:
+            error = type(e).__name__
+        else:
+            with self.lock:
+                self.timings.setdefault(operation, []).append(
+                    time.perf_counter() - start)
+            return result
+        with self.lock:
+            errors = self.errors.setdefault(operation, {})
+            errors[error] = errors.get(error, 0) + 1
+        return None
+
+    def dispatch(self, pool, tasks, until=None):
+        ''' Submits each task to the pool when its think time has passed.
+        Input: list of (seconds, operation, function, *args); the tasks
+        due after until seconds are not run (the player did not answer in
+        time).
+        Output: the futures of the tasks.'''
+        start = time.monotonic()
+        futures = []
+        for delay, operation, function, *args in sorted(
+                tasks, key=lambda t: t[0]):
+            if until is not None and delay > until:
+                with self.lock:
+                    errors = self.errors.setdefault(operation, {})
+                    errors['no answer'] = errors.get('no answer', 0) + 1
+                continue
+            remaining = start + delay - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            futures.append(pool.submit(
+                self.measure, operation, function, *args))
+        return futures
+
+    def play(self, pool):
+        ''' Plays the game as its host: the players join while it waits, and
+        then each question is shown until every player has answered or its
+        time is over.'''
+        self.game = Game.objects.create(questionnaire=self.questionnaire)
+        publicId = self.game.publicId
+        start = time.perf_counter()
+
+        futures = self.dispatch(pool, [
+            (self.think(), 'join', self.join, n)
+            for n in range(self.players)])
+        wait(futures)
+        participants = [f.result() for f in futures if f.result()]
+
+        state, questionNo = WAITING, 0
+        while state != LEADERBOARD:
+            Game.advance(publicId, state, questionNo)
+            state, questionNo = Game.objects.filter(
+                publicId=publicId).values_list('state', 'questionNo').get()
+            if state != QUESTION:
+                continue
+            shown = time.monotonic()
+            time_over = self.answer_time + rounds.DEADLINE_MARGIN
+            futures = self.dispatch(pool, [
+                (self.think(), 'guess', self.guess, participant, questionNo,
+                 self.random.randrange(4))
+                for participant in participants], until=time_over)
+            wait(futures, timeout=max(
+                shown + time_over - time.monotonic(), 0))
+            self.measure('host poll', self.all_answered, publicId)
+            # the scheduler may have moved the game to ANSWER already
+            Game.advance(publicId, QUESTION, questionNo)
+            state = ANSWER
+        self.elapsed = time.perf_counter() - start
+
+    def join(self, n):
+        return Participant.objects.create(game=self.game, alias=f'player{n}')
+
+    def guess(self, participant, questionNo, answer):
+        ''' Guesses the question questionNo as the REST API does: the state
+        of the game is read first.'''
+        received = timezone.now()
+        game = self.measure('state', livestate.get, self.game.publicId)
+        manifest = rounds.get(game) if game else None
+        if manifest is None or manifest.questionNo != questionNo:
+            raise ValidationError("The time to answer is over")
+        guess = Guess(
+            game=game, participant=participant,
+            question_id=manifest.question,
+            answer_id=manifest.answers[answer],
+            responseTime=game.elapsed_time(received),
+        )
+        if guessbuffer.enabled():
+            return guessbuffer.add(game, guess)
+        guess.save(force_insert=True)
+        return guess
+
+    def all_answered(self, publicId):
+        return livestate.get(publicId).all_participants_answered()
+
+    def lost_updates(self):
+        ''' Compares what was acknowledged to the players with what was
+        stored. Output: {update: number lost}.'''
+        publicId = self.game.publicId
+        counter = GameCounter.objects.get(game=publicId)
+        stored = Participant.objects.filter(game=publicId).count()
+        expected_points = {}
+        for participant, correct, responseTime, answerTime in \
+                Guess.objects.filter(game=publicId).values_list(
+                    'participant', 'answer__correct', 'responseTime',
+                    'question__answerTime'):
+            expected_points[participant] = expected_points.get(
+                participant, 0) + scoring.score(
+                correct, responseTime, answerTime)
+        return {
+            'joins': self.joined - stored,
+            'guesses': self.guessed - Guess.objects.filter(
+                game=publicId).count(),
+            'points': sum(
+                1 for id, points in Participant.objects.filter(
+                    game=publicId).values_list('id', 'points')
+                if points != expected_points.get(id, 0)),
+            'participant counter': abs(counter.participants - stored),
+        }
+
+    def report(self):
+        ''' Prints the throughput, the latency percentiles (in ms) and the
+        errors of each operation, and the updates lost.'''
+        # the operations that succeeded were acknowledged to the players
+        self.joined = len(self.timings.get('join', []))
+        self.guessed = len(self.timings.get('guess', []))
+        n_operations = sum(len(t) for t in self.timings.values()) + sum(
+            sum(e.values()) for e in self.errors.values())
+        self.stdout.write(
+            f'{self.players} players, {self.joined} joined, '
+            f'{self.guessed} guesses in {self.elapsed:.1f}s '
+            f'({n_operations / self.elapsed:.1f} operations/s)')
+        for operation in ('join', 'state', 'guess', 'host poll'):
+            timings = sorted(self.timings.get(operation, [])) or [0]
+            n = len(timings)
+            self.stdout.write(
+                f'{operation:>10}: n={len(self.timings.get(operation, []))} '
+                f'p50={1000 * timings[n // 2]:8.3f}ms '
+                f'p95={1000 * timings[min(n - 1, n * 95 // 100)]:8.3f}ms '
+                f'p99={1000 * timings[min(n - 1, n * 99 // 100)]:8.3f}ms '
+                f'max={1000 * timings[-1]:8.3f}ms '
+                f'errors={self.errors.get(operation, {})}')
+        self.stdout.write(f'lost updates: {self.lost_updates()}')
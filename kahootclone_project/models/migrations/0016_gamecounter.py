@@ -0,0 +1,48 @@
+# Generated by Django 3.2.1 on 2026-10-18 17:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_counters(apps, schema_editor):
+    ''' Creates the counters of the games that already exist'''
+    Game = apps.get_model('models', 'Game')
+    GameCounter = apps.get_model('models', 'GameCounter')
+    Guess = apps.get_model('models', 'Guess')
+
+    counters = []
+    for game in Game.objects.annotate(
+            n_participants=models.Count('participant')):
+        current_question = (
+            game.questionnaire.question_set.order_by('id')[
+                game.questionNo:game.questionNo + 1].first()
+            if game.questionNo is not None else None
+        )
+        counters.append(GameCounter(
+            game=game,
+            participants=game.n_participants,
+            questionNo=game.questionNo or 0,
+            answered=Guess.objects.filter(
+                game=game, question=current_question).count(),
+        ))
+    GameCounter.objects.bulk_create(counters)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0015_alter_guess_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameCounter',
+            fields=[
+                ('game', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='models.game')),
+                ('participants', models.IntegerField(default=0)),
+                ('questionNo', models.IntegerField(default=0)),
+                ('answered', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_counters, migrations.RunPython.noop),
+    ]
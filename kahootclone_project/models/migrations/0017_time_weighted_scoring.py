@@ -0,0 +1,23 @@
+# Generated by Django 3.2.1 on 2026-10-18 17:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0016_gamecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='questionStart',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='guess',
+            name='responseTime',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.1 on 2026-10-18 17:57
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('models', '0017_time_weighted_scoring'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='participant',
+            name='uuidP',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['state', 'created_at'], name='game_recycling'),
+        ),
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['game', 'question', 'answer'], name='guess_distribution'),
+        ),
+        migrations.AddIndex(
+            model_name='participant',
+            index=models.Index(fields=['game', '-points', 'alias'], name='participant_leaderboard'),
+        ),
+        migrations.AddConstraint(
+            model_name='participant',
+            constraint=models.UniqueConstraint(fields=('game', 'alias'), name='unique_alias_per_game'),
+        ),
+    ]
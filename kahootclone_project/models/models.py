@@ -1,10 +1,11 @@
 import uuid
-import random
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.forms import ValidationError
 from django.urls import reverse
+from django.utils import timezone
 
 from .constants import (
     WAITING,
@@ -12,11 +13,17 @@ from .constants import (
     ANSWER,
     LEADERBOARD
 )
+from . import (
+    events, gameversion, guessbuffer, leaderboard, livestate, lobby,
+    publicid, questionindex, rounds, scheduler, scoring,
+)
 import os
 
 MAX_PUBLICID = (
     10**6 if 'TESTING' not in os.environ else 5)
 COUNTDOWN_TIME = 5
+# aliases checked at once by Participant.suggest_alias
+ALIAS_SUGGESTIONS = 10
 
 
 class User(AbstractUser):
@@ -46,6 +53,59 @@ class Questionnaire(models.Model):
     def get_owner(self):
         return self.user
 
+    def clone(self, user=None, title=None):
+        '''Creates a copy of the questionnaire with all its questions and
+        answers, owned by user (by default, the same) and titled title (by
+        default, the same as a copy). The rows are copied by the database,
+        with the same number of queries whatever the size of the
+        questionnaire.
+        Output: the new Questionnaire.'''
+        # Author: Pablo Cuesta Sierra
+        qn = connection.ops.quote_name
+        question_table = qn(Question._meta.db_table)
+        answer_table = qn(Answer._meta.db_table)
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        with transaction.atomic():
+            questionnaire = Questionnaire.objects.create(
+                user=user or self.user,
+                title=title or f'{self.title} (copy)'[:100],
+            )
+            with connection.cursor() as cursor:
+                # the questions are inserted in order, so the new ones get
+                # their ids in the same order as the copied ones
+                cursor.execute(
+                    f'''INSERT INTO {question_table} ("question",
+                        "questionnaire_id", "created_at", "updated_at",
+                        "answerTime")
+                    SELECT "question", %s, %s, %s, "answerTime"
+                    FROM {question_table} WHERE "questionnaire_id" = %s
+                    ORDER BY "id"''',
+                    [questionnaire.id, now, now, self.id])
+                # each answer goes to the new question in the same position:
+                # sorted by position, each copied question is followed by
+                # its new one
+                cursor.execute(
+                    f'''INSERT INTO {answer_table} ("answer", "question_id",
+                        "correct")
+                    SELECT a."answer", pairs."new_id", a."correct"
+                    FROM {answer_table} a JOIN (
+                        SELECT "id", "questionnaire_id", LEAD("id") OVER (
+                            ORDER BY "position", "questionnaire_id" = %s
+                        ) AS "new_id"
+                        FROM (
+                            SELECT "id", "questionnaire_id", ROW_NUMBER()
+                                OVER (PARTITION BY "questionnaire_id"
+                                      ORDER BY "id") AS "position"
+                            FROM {question_table}
+                            WHERE "questionnaire_id" IN (%s, %s)
+                        ) ranked
+                    ) pairs ON a."question_id" = pairs."id"
+                    WHERE pairs."questionnaire_id" = %s
+                    ORDER BY a."id"''',
+                    [questionnaire.id, self.id, questionnaire.id, self.id])
+        questionindex.forget(questionnaire.id)
+        return questionnaire
+
     class Meta:
         ordering = ['-id']
 
@@ -156,38 +216,70 @@ class Game(models.Model):
         validators=[MinValueValidator(1)],
     )
     questionNo = models.IntegerField(default=0, null=True)
+    # time when the current question was shown
+    questionStart = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.questionnaire.title}(id={self.publicId})"
 
+    class Meta:
+        indexes = [
+            # oldest finished games, whose publicId is reused
+            models.Index(fields=['state', 'created_at'],
+                         name='game_recycling'),
+        ]
+
     def save(self, *args, **kwargs):
         # Author: Álvaro Zamanillo Sáez
-        if not self.pk:  # only on creation
-            # generate a key in range [1,10^6] until is unique
-            keys = Game.objects.values_list("publicId", flat=True)
-            publicId_minus_one = random.randint(0, MAX_PUBLICID - 1)
-
-            if len(keys) == MAX_PUBLICID:
-                raise ValidationError(
-                    "Could not generate a unique publicID")
-
-            while publicId_minus_one + 1 in keys:
-                publicId_minus_one = (publicId_minus_one + 1) % MAX_PUBLICID
-
-            self.publicId = publicId_minus_one + 1
-
-        super(Game, self).save(*args, **kwargs)
+        creation = self._state.adding
+        with transaction.atomic():
+            if self.pk:
+                super(Game, self).save(*args, **kwargs)
+            else:  # only on creation
+                self._create(*args, **kwargs)
+
+            if creation:
+                GameCounter.objects.get_or_create(game=self)
+
+        # players read the game from the live state, keep it up to date
+        livestate.store(self)
+        rounds.store(self)
+        gameversion.bump(self.publicId)
+        if creation:  # the publicId may have been used by a deleted game
+            leaderboard.forget(self.publicId)
+            lobby.forget(self.publicId)
+
+    def _create(self, *args, **kwargs):
+        ''' Inserts the game with a random key in range [1,10^6], trying
+        another one while the key is already used (see publicid.py)'''
+        # Author: Álvaro Zamanillo Sáez
+        kwargs['force_insert'] = True
+        for publicId in publicid.candidates(Game, MAX_PUBLICID):
+            self.publicId = publicId
+            try:
+                with transaction.atomic():
+                    super(Game, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                # the error is not a key collision, do not hide it
+                if not Game.objects.filter(publicId=publicId).exists():
+                    self.publicId = None
+                    raise
+
+        self.publicId = None
+        raise ValidationError("Could not generate a unique publicID")
 
     def update_state_next_question(self):
         ''' Updates the state of the game to the next question or to the state
         Leaderboard if there are no more questions'''
         # Author: Pablo Cuesta Sierra
-        if self.questionNo >= self.questionnaire.question_set.count():
+        questions = questionindex.questions(self.questionnaire_id)
+        if self.questionNo >= len(questions):
             self.state = LEADERBOARD
         else:
             self.state = QUESTION
-            self.countdownTime = self.questionnaire.question_set.all()[
-                self.questionNo].answerTime
+            self.countdownTime = questions[self.questionNo].answerTime
+            self.questionStart = timezone.now()
 
     def update_state(self):
         ''' Updates the state of the game to the next state'''
@@ -195,29 +287,139 @@ class Game(models.Model):
         if self.state == WAITING:
             self.update_state_next_question()
         elif self.state == QUESTION:
+            # the guesses accepted by the write-behind buffer are stored
+            # before the answer is shown
+            guessbuffer.flush(self.publicId)
             self.state = ANSWER
         elif self.state == ANSWER:
             self.questionNo += 1
             self.update_state_next_question()
 
         self.save()
+        events.publish(self.publicId, 'state', events.state_data(self))
+        if self.state == QUESTION:
+            # the server moves the game to ANSWER when the time is over
+            scheduler.schedule(self)
+
+    @classmethod
+    def advance(cls, publicId, state, questionNo):
+        ''' Moves the game to its next state only if it is still in the given
+        state and question (e.g. the ones shown to the host), so a game is
+        not moved twice when the host and the scheduler (see
+        models/scheduler.py) move it at the same time.
+        Output: True if the game was moved.'''
+        # Author: Pablo Cuesta Sierra
+        with transaction.atomic():
+            game = cls.objects.select_for_update().filter(
+                publicId=publicId).first()
+            if (game is None or game.state != state
+                    or game.questionNo != questionNo):
+                return False
+            game.update_state()
+        return True
+
+    def elapsed_time(self, when=None):
+        '''Returns the milliseconds elapsed from the moment the current
+        question was shown until when (by default, now), or None if it is not
+        known.'''
+        # Author: Pablo Cuesta Sierra
+        if self.questionStart is None:
+            return None
+        elapsed = (when or timezone.now()) - self.questionStart
+        # the clocks of different servers may not be exactly in sync
+        return max(round(elapsed.total_seconds() * 1000), 0)
 
     def get_owner(self):
         '''Returns the owner of the questionnaire that this game belongs to.'''
         return self.questionnaire.user
 
+    def guess_distribution(self, question):
+        '''
+        Returns a dictionary with the number of guesses of each answer
+        (by id) of the given question in this game, using a single query.
+        '''
+        # Author: Álvaro Zamanillo Sáez
+        return dict(
+            Guess.objects.filter(game=self, question=question)
+            .values_list('answer')
+            .annotate(n_guesses=models.Count('id'))
+        )
+
+    def answered_count(self):
+        '''
+        Returns the number of participants that have answered the current
+        question and the total number of participants.
+        '''
+        # Author: Álvaro Zamanillo Sáez
+        counter = GameCounter.objects.filter(game=self).values_list(
+            'questionNo', 'answered', 'participants').first()
+
+        if counter is None:  # games inserted without Game.save
+            current_question = questionindex.questions(
+                self.questionnaire_id)[self.questionNo]
+            n_guesses = Guess.objects.filter(
+                question=current_question.id, game=self).count()
+            return n_guesses, self.participant_set.count()
+
+        questionNo, n_guesses, n_participants = counter
+        # nobody has answered yet if the counter is from a previous question
+        return (
+            n_guesses if questionNo == self.questionNo else 0,
+            n_participants
+        )
+
     def all_participants_answered(self):
         '''
         Returns True if all participants have answered the current question.
         '''
 
         # Author: Álvaro Zamanillo Sáez
-        current_question = \
-            self.questionnaire.question_set.all()[self.questionNo]
-        n_guesses = \
-            Guess.objects.filter(question=current_question, game=self).count()
+        n_guesses, n_participants = self.answered_count()
+
+        return n_guesses == n_participants
+
+
+class GameCounter(models.Model):
+    '''Counters of a game updated each time a participant joins or leaves
+    the game and each time a guess is made, so that checking if all the
+    participants have answered does not need to count rows.
+    The counter of guesses refers to the question questionNo and it is moved
+    to a new question by the first guess of that question.'''
+    # Author: Álvaro Zamanillo Sáez
+    game = models.OneToOneField(
+        Game, primary_key=True, on_delete=models.CASCADE)
+    participants = models.IntegerField(default=0)
+    questionNo = models.IntegerField(default=0)
+    answered = models.IntegerField(default=0)
+
+    def __str__(self):
+        return (f"{self.game_id}: {self.answered}/{self.participants} "
+                f"(question {self.questionNo})")
+
+    @classmethod
+    def add_participants(cls, game_id, n_participants=1, n_answered=0):
+        '''Atomically adds (or substracts if negative) participants and
+        guesses of the current question to the counters of a game.'''
+        # Author: Álvaro Zamanillo Sáez
+        cls.objects.filter(game_id=game_id).update(
+            participants=F('participants') + n_participants,
+            answered=F('answered') + n_answered,
+        )
 
-        return n_guesses == self.participant_set.count()
+    @classmethod
+    def add_guess(cls, game_id, questionNo, n_guesses=1):
+        '''Atomically counts new guesses of the question questionNo.'''
+        # Author: Álvaro Zamanillo Sáez
+        counters = cls.objects.filter(game_id=game_id)
+        # if two first guesses of a question are concurrent, the counter is
+        # moved by one of them and the other one increments it (2nd try)
+        for _ in range(2):
+            if counters.filter(questionNo=questionNo).update(
+                    answered=F('answered') + n_guesses):
+                return
+            if counters.filter(questionNo__lt=questionNo).update(
+                    questionNo=questionNo, answered=n_guesses):
+                return
 
 
 class Participant(models.Model):
@@ -226,24 +428,94 @@ class Participant(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
     alias = models.CharField(max_length=50)
     points = models.IntegerField(default=0)
-    uuidP = models.UUIDField(default=uuid.uuid4, editable=False)
+    uuidP = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
 
     def __str__(self):
         return self.alias
 
     class Meta:  # ordenados por puntos para el leaderboard
         ordering = ['-points', 'alias']
+        constraints = [
+            models.UniqueConstraint(fields=['game', 'alias'],
+                                    name='unique_alias_per_game'),
+        ]
+        indexes = [
+            models.Index(fields=['game', '-points', 'alias'],
+                         name='participant_leaderboard'),
+        ]
 
     def save(self, *args, **kwargs):
         # Author: Álvaro Zamanillo Sáez
         if not self.pk:
-            # check if alias is repeated for the same game
-            names = Participant.objects.filter(game=self.game).values_list(
-                "alias", flat=True)
-            if self.alias in names:
-                raise ValidationError(
-                    f'Participant already exists in the game: "{self.alias}"')
+            with leaderboard.changing(self.game_id) as change:
+                # the repeated aliases are rejected by the unique constraint
+                try:
+                    with transaction.atomic():
+                        super(Participant, self).save(*args, **kwargs)
+                        GameCounter.add_participants(self.game_id)
+                except IntegrityError:
+                    if Participant.objects.filter(
+                            game=self.game_id, alias=self.alias).exists():
+                        raise ValidationError(
+                            'Participant already exists in the game: '
+                            f'"{self.alias}"')
+                    raise
+                change(lambda board: board.add(
+                    self.id, self.uuidP, self.alias, self.points,
+                    keep_sorted=True))
+            gameversion.bump(self.game_id)
+            return
+
         super(Participant, self).save(*args, **kwargs)
+        leaderboard.forget(self.game_id)
+        gameversion.bump(self.game_id)
+
+    @classmethod
+    def suggest_alias(cls, game_id, alias):
+        '''Returns the alias followed by the lowest number that is not taken
+        in the game (e.g. pepe2). The numbers are checked in groups of
+        ALIAS_SUGGESTIONS with a single query each.'''
+        # Author: Pablo Cuesta Sierra
+        max_length = cls._meta.get_field('alias').max_length
+        first = 2
+        while True:
+            suggestions = [
+                alias[:max_length - len(str(n))] + str(n)
+                for n in range(first, first + ALIAS_SUGGESTIONS)
+            ]
+            taken = set(cls.objects.filter(
+                game=game_id, alias__in=suggestions
+            ).values_list('alias', flat=True))
+            for suggestion in suggestions:
+                if suggestion not in taken:
+                    return suggestion
+            first += ALIAS_SUGGESTIONS
+
+    def delete(self, *args, **kwargs):
+        # Author: Álvaro Zamanillo Sáez
+        id = self.id
+        with leaderboard.changing(self.game_id) as change, \
+                transaction.atomic():
+            change(lambda board: board.remove(id))
+            counter = GameCounter.objects.filter(game=self.game_id).first()
+            if counter is not None:
+                # the guess of the current question is deleted too
+                questions = questionindex.questions(
+                    self.game.questionnaire_id)
+                answered = (
+                    counter.questionNo < len(questions)
+                    and Guess.objects.filter(
+                        participant=self,
+                        question=questions[counter.questionNo].id,
+                    ).exists()
+                )
+                GameCounter.add_participants(
+                    self.game_id, -1, -1 if answered else 0)
+
+            deleted = super(Participant, self).delete(*args, **kwargs)
+        lobby.log_removal(self.game_id, self.alias)
+        gameversion.bump(self.game_id)
+        return deleted
 
 
 class Guess(models.Model):
@@ -254,6 +526,9 @@ class Guess(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     answer = models.ForeignKey(Answer, on_delete=models.CASCADE)
+    # milliseconds from the moment the question was shown until the guess
+    # was received
+    responseTime = models.IntegerField(null=True, blank=True)
 
     def __str__(self):
         return str(
@@ -262,15 +537,20 @@ class Guess(models.Model):
 
     class Meta:
         unique_together = ('participant', 'question', 'game')
+        indexes = [
+            # answers chosen in a question (see Game.guess_distribution)
+            models.Index(fields=['game', 'question', 'answer'],
+                         name='guess_distribution'),
+        ]
 
     def save(self, *args, **kwargs):
         # Author: Álvaro Zamanillo Sáez
         if (
             self.pk or
             Guess.objects.filter(
-                participant=self.participant,
-                question=self.question,
-                game=self.game
+                participant=self.participant_id,
+                question=self.question_id,
+                game=self.game_id
             ).exists()
         ):
             raise ValidationError(
@@ -283,24 +563,130 @@ class Guess(models.Model):
         #         f"Participant {self.participant} "
         #         f"does not belong to the game {self.game}")
 
-        # try:
-            # here we should use self.game.questionnaire but test07_guess
-            # has incompatible data
-        question_idx = list(
-            self.question.questionnaire.question_set.all()
-        ).index(self.question)
-
-        # except ValueError:
-        #     # this is never catched, because the question is always in the
-        #     # questionnaire, as commented above
-        #     raise ValidationError((
-        #         f"Question {self.answer.question} "
-        #         "does not belong to the game"))
+        # the question is looked up in the game's questionnaire, but
+        # test07_guess has incompatible data, so if it is not found there the
+        # question's own questionnaire is used
+        index = questionindex.get(self.game.questionnaire_id)
+        if self.question_id not in index.positions:
+            index = questionindex.get(self.question.questionnaire_id)
+        question_idx = index.positions[self.question_id]
 
         if question_idx < self.game.questionNo or self.game.state != QUESTION:
             raise ValidationError("Wait until the question is shown")
 
-        if self.answer.correct:
-            self.participant.points += 1
-            self.participant.save()
-        super(Guess, self).save(*args, **kwargs)
+        question = index.questions[question_idx]
+        answer = question.get_answer(self.answer_id)
+        # (the answer may belong to another question in test07_guess)
+        correct = answer.correct if answer else self.answer.correct
+
+        if question_idx == self.game.questionNo:
+            if self.responseTime is None:
+                self.responseTime = self.game.elapsed_time()
+            if rounds.is_late(self.responseTime, question.answerTime):
+                raise ValidationError("The time to answer is over")
+        points = scoring.score(correct, self.responseTime, question.answerTime)
+
+        try:
+            with leaderboard.changing(self.game_id) as change, \
+                    transaction.atomic():
+                super(Guess, self).save(*args, **kwargs)
+                if points:
+                    change(lambda board: board.add_points(
+                        self.participant_id, points))
+                    # the points are added by the database, so concurrent
+                    # guesses (or other writes) of the participant are not
+                    # lost
+                    Participant.objects.filter(pk=self.participant_id) \
+                        .update(points=F('points') + points)
+                GameCounter.add_guess(self.game_id, question_idx)
+        except IntegrityError:
+            # the same guess was stored by a concurrent request
+            self.pk = None
+            raise ValidationError(
+                f"You may not edit an existing {self._meta.model_name}")
+        gameversion.bump(self.game_id)
+
+        if points and Guess.participant.is_cached(self):
+            self.participant.points += points
+
+    @classmethod
+    def bulk_save(cls, game, guesses, questionNo=None):
+        '''Stores many guesses of the current question of the game with a
+        constant number of queries: the guesses are inserted at once and the
+        points of all the participants are added with a single update.
+        Input: unsaved guesses with participant (of the game) and answer.
+        questionNo is only given for guesses accepted while that question
+        was shown (see models/guessbuffer.py).
+        Guesses already stored, repeated, received after the deadline (see
+        models/rounds.py), with an answer of another question or of
+        participants no longer in the game are skipped.
+        Output: list of the guesses stored.'''
+        # Author: Álvaro Zamanillo Sáez
+        if questionNo is None:
+            if game.state != QUESTION:
+                raise ValidationError("Wait until the question is shown")
+            questionNo = game.questionNo
+
+        question = questionindex.questions(game.questionnaire_id)[questionNo]
+        responseTime = game.elapsed_time()
+        participant_ids = [guess.participant_id for guess in guesses]
+        answered = set(cls.objects.filter(
+            game=game,
+            question=question.id,
+            participant__in=participant_ids,
+        ).values_list('participant', flat=True))
+        # the participants may have left since their guesses were accepted
+        # (see models/guessbuffer.py)
+        present = set(Participant.objects.filter(
+            game=game, pk__in=participant_ids).values_list('id', flat=True))
+
+        new_guesses = []
+        participants_by_points = {}
+        for guess in guesses:
+            answer = question.get_answer(guess.answer_id)
+            if (answer is None or guess.participant_id in answered
+                    or guess.participant_id not in present):
+                continue
+            if guess.responseTime is None:
+                guess.responseTime = responseTime
+            if rounds.is_late(guess.responseTime, question.answerTime):
+                continue
+            answered.add(guess.participant_id)
+
+            guess.game = game
+            guess.question_id = question.id
+            points = scoring.score(
+                answer.correct, guess.responseTime, question.answerTime)
+            if points:
+                participants_by_points.setdefault(points, []).append(
+                    guess.participant_id)
+            new_guesses.append(guess)
+
+        if not new_guesses:
+            return new_guesses
+        try:
+            with leaderboard.changing(game.publicId) as change, \
+                    transaction.atomic():
+                cls.objects.bulk_create(new_guesses)
+                if participants_by_points:
+                    change(lambda board: [
+                        board.add_points(pk, points)
+                        for points, pks in participants_by_points.items()
+                        for pk in pks
+                    ])
+                    Participant.objects.filter(
+                        pk__in=[pk for pks in participants_by_points.values()
+                                for pk in pks]
+                    ).update(points=F('points') + models.Case(
+                        *(models.When(pk__in=pks, then=points)
+                          for points, pks in participants_by_points.items()),
+                        default=0,
+                    ))
+                GameCounter.add_guess(
+                    game.publicId, questionNo, len(new_guesses))
+        except IntegrityError:
+            # some of the guesses were stored by a concurrent request
+            raise ValidationError(
+                f"You may not edit an existing {cls._meta.model_name}")
+        gameversion.bump(game.publicId)
+        return new_guesses
@@ -0,0 +1,74 @@
+''' Allocation of the publicId of new games.
+
+The publicId is the primary key of Game, so its uniqueness is already
+guaranteed by the database. Instead of loading every existing key to find a
+free one, a random key is inserted directly and a new one is tried when the
+insert collides. With the table far from full this takes one insert on
+average, no matter how many games are stored.
+
+Only when every random probe collides (the range of keys is almost full) the
+free keys are searched for in the database, and as a last resort the key of
+the oldest finished game (LEADERBOARD) is recycled.
+'''
+# Author: Álvaro Zamanillo Sáez
+import random
+
+from django.db.models import Exists, F, OuterRef
+
+from .constants import LEADERBOARD
+
+''' Number of random keys tried before searching the database for a free
+    one. The probability of needing the search is (used/max)^RANDOM_PROBES '''
+RANDOM_PROBES = 8
+
+
+def candidates(model, max_publicid):
+    ''' Yields, in order, the publicIds to try for a new game. The database
+    is only queried if the random probes are exhausted.'''
+    # Author: Álvaro Zamanillo Sáez
+    for _ in range(RANDOM_PROBES):
+        yield random.randint(1, max_publicid)
+
+    yield from free_publicids(model, max_publicid)
+
+    recycled = recycle_publicid(model)
+    if recycled is not None:
+        yield recycled
+
+
+def free_publicids(model, max_publicid):
+    ''' Yields free publicIds found by the database: the first one and the
+    first key right after a used one which is not used itself.'''
+    # Author: Álvaro Zamanillo Sáez
+    if not model.objects.filter(publicId=1).exists():
+        yield 1
+
+    gap = (
+        model.objects
+        .annotate(next_publicId=F('publicId') + 1)
+        .filter(
+            ~Exists(model.objects.filter(
+                publicId=OuterRef('publicId') + 1)),
+            next_publicId__lte=max_publicid,
+        )
+        .order_by('publicId')
+        .values_list('next_publicId', flat=True)
+        .first()
+    )
+    if gap is not None:
+        yield gap
+
+
+def recycle_publicid(model):
+    ''' Deletes the oldest finished game and returns its publicId so that it
+    can be reused. Returns None if there are no finished games.'''
+    # Author: Álvaro Zamanillo Sáez
+    game = (
+        model.objects.filter(state=LEADERBOARD).order_by('created_at').first()
+    )
+    if game is None:
+        return None
+
+    publicId = game.publicId
+    game.delete()
+    return publicId
@@ -0,0 +1,137 @@
+''' Ordered index of the questions (and their answers) of a questionnaire.
+
+During a game the questions are accessed by their position in the
+questionnaire (Game.questionNo) and the position of a question is needed to
+validate every guess. The questions of each questionnaire, with their
+answers, are kept in the cache as an immutable tuple, so both lookups are
+O(1) and do not query the database while playing.
+
+The index is built with two queries the first time it is needed and it is
+removed from the cache each time a questionnaire, question or answer is
+saved or deleted. It is only kept in the cache if settings.CACHE_GAME_STATE
+is set (see models/livestate.py); otherwise it is built each time.
+'''
+# Author: Pablo Cuesta Sierra
+from collections import namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+''' Seconds the index of a questionnaire is kept in the cache '''
+INDEX_TIMEOUT = 24 * 60 * 60
+
+
+class IndexedAnswer(namedtuple('IndexedAnswer', 'id answer correct')):
+    ''' Answer of an indexed question. It can be used in the templates as an
+    Answer object.'''
+    __slots__ = ()
+
+    def __str__(self):
+        return self.answer
+
+
+class IndexedQuestion(namedtuple(
+        'IndexedQuestion', 'id question answerTime answers')):
+    ''' Question of the index. answers is a tuple of IndexedAnswer in the
+    same order as question.answer_set.all()'''
+    __slots__ = ()
+
+    def __str__(self):
+        return self.question
+
+    def get_answer(self, answer_id):
+        ''' Returns the answer with the given id, or None if it is not an
+        answer of this question.'''
+        return next(
+            (answer for answer in self.answers if answer.id == answer_id),
+            None)
+
+
+QuestionnaireIndex = namedtuple('QuestionnaireIndex', 'questions positions')
+
+
+def _key(questionnaire_id):
+    return f'questionnaire:{questionnaire_id}'
+
+
+def _build(questionnaire_id):
+    # Author: Pablo Cuesta Sierra
+    Question = apps.get_model('models', 'Question')
+    Answer = apps.get_model('models', 'Answer')
+
+    answers = {}
+    for question_id, *answer in Answer.objects.filter(
+            question__questionnaire=questionnaire_id).order_by('id') \
+            .values_list('question', 'id', 'answer', 'correct'):
+        answers.setdefault(question_id, []).append(IndexedAnswer(*answer))
+
+    questions = tuple(
+        IndexedQuestion(id, question, answerTime, tuple(answers.get(id, ())))
+        for id, question, answerTime in Question.objects.filter(
+            questionnaire=questionnaire_id).order_by('id')
+        .values_list('id', 'question', 'answerTime')
+    )
+    return QuestionnaireIndex(
+        questions,
+        {question.id: position for position, question in enumerate(questions)}
+    )
+
+
+def get(questionnaire_id):
+    ''' Returns the index of the questionnaire: questions is the tuple of
+    IndexedQuestion in order and positions maps the id of each question to
+    its position.'''
+    # Author: Pablo Cuesta Sierra
+    if not settings.CACHE_GAME_STATE:
+        return _build(questionnaire_id)
+    index = cache.get(_key(questionnaire_id))
+    if index is None:
+        index = _build(questionnaire_id)
+        cache.set(_key(questionnaire_id), index, INDEX_TIMEOUT)
+    return index
+
+
+def questions(questionnaire_id):
+    ''' Returns the tuple of questions of the questionnaire, in order.'''
+    # Author: Pablo Cuesta Sierra
+    return get(questionnaire_id).questions
+
+
+def position(questionnaire_id, question_id):
+    ''' Returns the position of the question in the questionnaire, or None if
+    it does not belong to it.'''
+    # Author: Pablo Cuesta Sierra
+    return get(questionnaire_id).positions.get(question_id)
+
+
+def forget(questionnaire_id):
+    ''' Removes the index of the questionnaire from the cache. It has to be
+    called after changing its questions or answers without saving them one
+    by one (e.g. bulk_create).'''
+    # Author: Pablo Cuesta Sierra
+    cache.delete(_key(questionnaire_id))
+
+
+@receiver(post_save, sender='models.Questionnaire')
+@receiver(post_delete, sender='models.Questionnaire')
+def _questionnaire_changed(sender, instance, **kwargs):
+    forget(instance.id)
+
+
+@receiver(post_save, sender='models.Question')
+@receiver(post_delete, sender='models.Question')
+def _question_changed(sender, instance, **kwargs):
+    forget(instance.questionnaire_id)
+
+
+@receiver(post_save, sender='models.Answer')
+@receiver(post_delete, sender='models.Answer')
+def _answer_changed(sender, instance, **kwargs):
+    try:
+        forget(instance.question.questionnaire_id)
+    except ObjectDoesNotExist:  # the question has already been deleted
+        pass
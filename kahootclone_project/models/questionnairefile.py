@@ -0,0 +1,207 @@
+''' Import and export of whole questionnaires.
+
+A questionnaire is written as a file with a line per question, so files with
+hundreds of questions are read and written as a stream, without building
+them whole in memory:
+- json: a JSON object per line (JSON Lines), as {"question": str,
+  "answerTime": int, "answers": [{"answer": str, "correct": bool}, ...]}
+- csv: a header (CSV_HEADER) and a row per question: its text, its answer
+  time, its answers (empty columns if it has less than MAX_ANSWERS) and the
+  position (from 1) of the correct one, empty if none is.
+
+An imported file is validated in memory and stored in a single transaction,
+with one insertion of all the questions and one of all the answers, instead
+of saving (and validating against the database) each of them.
+'''
+# Author: Pablo Cuesta Sierra
+import csv
+import json
+from collections import namedtuple
+
+from django.apps import apps
+from django.db import transaction
+from django.forms import ValidationError
+
+from . import questionindex
+
+FORMATS = ('json', 'csv')
+MAX_ANSWERS = 4
+MAX_LENGTH = 100
+CSV_HEADER = (['question', 'answerTime']
+              + [f'answer{n}' for n in range(1, MAX_ANSWERS + 1)]
+              + ['correct'])
+''' Errors reported of an invalid file '''
+MAX_ERRORS = 10
+
+ImportedQuestion = namedtuple(
+    'ImportedQuestion', 'question answerTime answers')
+
+
+def format_of(filename):
+    ''' Returns the format of a file given its name.'''
+    # Author: Pablo Cuesta Sierra
+    return 'csv' if filename.lower().endswith('.csv') else 'json'
+
+
+def _text(value, what):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'the {what} is empty')
+    if len(value) > MAX_LENGTH:
+        raise ValueError(f'the {what} is longer than {MAX_LENGTH} characters')
+    return value.strip()
+
+
+def _question(question, answerTime, answers):
+    ''' Validates a question read from a file.
+    Input: answers, list of (answer, correct).
+    Output: ImportedQuestion.'''
+    # Author: Pablo Cuesta Sierra
+    if answerTime in (None, ''):
+        answerTime = 20
+    try:
+        answerTime = int(answerTime)
+    except (TypeError, ValueError):
+        raise ValueError('the answer time is not a number')
+    if answerTime < 1:
+        raise ValueError('the answer time must be at least 1 second')
+    if len(answers) > MAX_ANSWERS:
+        raise ValueError(f'a question can only have {MAX_ANSWERS} answers')
+    if sum(bool(correct) for _, correct in answers) > 1:
+        raise ValueError('there can only be one correct answer per question')
+    return ImportedQuestion(
+        _text(question, 'question'),
+        answerTime,
+        tuple((_text(answer, 'answer'), bool(correct))
+              for answer, correct in answers),
+    )
+
+
+def _json_questions(lines):
+    for n, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            yield n, (data.get('question'), data.get('answerTime'),
+                      [(answer['answer'], answer.get('correct', False))
+                       for answer in data.get('answers', [])])
+        except (ValueError, TypeError, AttributeError, KeyError):
+            yield n, 'it is not a valid question'
+
+
+def _csv_questions(lines):
+    reader = csv.reader(lines)
+    if [name.strip() for name in next(reader, [])] != CSV_HEADER:
+        yield 1, 'the header must be ' + ','.join(CSV_HEADER)
+        return
+    for row in reader:
+        if not any(row):
+            continue
+        n = reader.line_num
+        if len(row) != len(CSV_HEADER):
+            yield n, f'it must have {len(CSV_HEADER)} columns'
+            continue
+        question, answerTime, *answers, correct = row
+        try:
+            correct = int(correct) if correct.strip() else None
+        except ValueError:
+            yield n, 'the correct answer is not a number'
+            continue
+        if correct is not None and not (
+                1 <= correct <= MAX_ANSWERS and answers[correct - 1].strip()):
+            yield n, 'the correct answer does not exist'
+            continue
+        yield n, (question, answerTime,
+                  [(answer, position == correct)
+                   for position, answer in enumerate(answers, 1)
+                   if answer.strip()])
+
+
+def parse(lines, format):
+    ''' Reads and validates the questions of a questionnaire file.
+    Input: lines of the file (e.g. an open file) and its format.
+    Output: list of ImportedQuestion. Raises ValidationError with the errors
+    found if the file is not valid.'''
+    # Author: Pablo Cuesta Sierra
+    questions, errors = [], []
+    read = _csv_questions if format == 'csv' else _json_questions
+    try:
+        # each line is either the fields of a question or an error
+        for n, fields in read(lines):
+            try:
+                if isinstance(fields, str):
+                    raise ValueError(fields)
+                questions.append(_question(*fields))
+            except ValueError as e:
+                errors.append(f'Line {n}: {e}')
+    except (UnicodeDecodeError, csv.Error):
+        errors.append('The file is not a valid text file')
+    if not questions and not errors:
+        errors.append('The file has no questions')
+    if errors:
+        raise ValidationError(errors[:MAX_ERRORS])
+    return questions
+
+
+def import_questionnaire(user, title, lines, format):
+    ''' Creates a questionnaire of the user with the questions of a file.
+    Output: the Questionnaire. Raises ValidationError if the file is not
+    valid (nothing is stored then).'''
+    # Author: Pablo Cuesta Sierra
+    Questionnaire = apps.get_model('models', 'Questionnaire')
+    Question = apps.get_model('models', 'Question')
+    Answer = apps.get_model('models', 'Answer')
+
+    imported = parse(lines, format)
+    with transaction.atomic():
+        questionnaire = Questionnaire.objects.create(title=title, user=user)
+        Question.objects.bulk_create([
+            Question(questionnaire=questionnaire, question=question.question,
+                     answerTime=question.answerTime)
+            for question in imported
+        ])
+        # the ids are not returned by every database: the questionnaire is
+        # new, so they are those of its questions in order
+        ids = Question.objects.filter(
+            questionnaire=questionnaire).order_by('id').values_list(
+            'id', flat=True)
+        Answer.objects.bulk_create([
+            Answer(question_id=id, answer=answer, correct=correct)
+            for id, question in zip(ids, imported)
+            for answer, correct in question.answers
+        ])
+    questionindex.forget(questionnaire.id)
+    return questionnaire
+
+
+class _Echo:
+    ''' File-like object that returns what is written to it, to build the
+    rows of a csv file one by one.'''
+
+    def write(self, value):
+        return value
+
+
+def export_lines(questionnaire_id, format):
+    ''' Returns an iterator over the lines of the file of a questionnaire in
+    the given format.'''
+    # Author: Pablo Cuesta Sierra
+    questions = questionindex.questions(questionnaire_id)
+    if format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(CSV_HEADER)
+        for question in questions:
+            answers = [answer.answer for answer in question.answers]
+            correct = next((position for position, answer in enumerate(
+                question.answers, 1) if answer.correct), '')
+            yield writer.writerow(
+                [question.question, question.answerTime] + answers
+                + [''] * (MAX_ANSWERS - len(answers)) + [correct])
+        return
+    for question in questions:
+        yield json.dumps({
+            'question': question.question,
+            'answerTime': question.answerTime,
+            'answers': [{'answer': answer.answer, 'correct': answer.correct}
+                        for answer in question.answers],
+        }) + '\n'
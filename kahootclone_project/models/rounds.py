@@ -0,0 +1,108 @@
+''' Manifest of the round (the question shown) of each game.
+
+When a game shows a question the data needed to answer it is computed once
+and kept in the cache, written through each time the game is saved (see
+Game.save): the question, the ids of its answers in the order they are
+shown to the players and the deadline to answer. It is served to the players
+(GameView.get_round) and each guess is validated against it with a lookup,
+without reading the game or the question from the database.
+
+The deadline is set by the server: guesses received later are rejected (see
+is_late) and the game is moved to ANSWER when it passes (see
+models/scheduler.py).
+
+As the games (see models/livestate.py), the manifests are only kept in the
+cache if settings.CACHE_GAME_STATE is set; otherwise they are computed
+each time.
+'''
+# Author: Pablo Cuesta Sierra
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import questionindex
+from .constants import QUESTION
+
+''' Seconds a manifest is kept in the cache '''
+ROUND_TIMEOUT = 2 * 60 * 60
+
+''' Seconds a guess is still accepted after the deadline, for the delays of
+    the network '''
+DEADLINE_MARGIN = 1
+
+Round = namedtuple('Round', 'questionNo question answers deadline')
+
+
+def _key(publicId):
+    return f'round:{publicId}'
+
+
+def store(game):
+    ''' Computes the manifest of the question shown in the game and writes
+    it in the cache (or removes it if no question is shown).
+    Output: the Round, or None.'''
+    # Author: Pablo Cuesta Sierra
+    question = None
+    if game.state == QUESTION:
+        questions = questionindex.questions(game.questionnaire_id)
+        if 0 <= game.questionNo < len(questions):
+            question = questions[game.questionNo]
+    if question is None:
+        if settings.CACHE_GAME_STATE:
+            cache.delete(_key(game.publicId))
+        return None
+
+    manifest = Round(
+        game.questionNo,
+        question.id,
+        tuple(answer.id for answer in question.answers),
+        game.questionStart + timedelta(seconds=question.answerTime)
+        if game.questionStart else None,
+    )
+    if settings.CACHE_GAME_STATE:
+        cache.set(_key(game.publicId), manifest, ROUND_TIMEOUT)
+    return manifest
+
+
+def get(game):
+    ''' Returns the manifest of the question shown in the game (e.g. as given
+    by livestate.get), or None if no question is shown.'''
+    # Author: Pablo Cuesta Sierra
+    if game.state != QUESTION:
+        return None
+    manifest = (cache.get(_key(game.publicId))
+                if settings.CACHE_GAME_STATE else None)
+    if manifest is None or manifest.questionNo != game.questionNo:
+        manifest = store(game)
+    return manifest
+
+
+def data(manifest):
+    ''' Manifest as sent to the players.'''
+    # Author: Pablo Cuesta Sierra
+    return {
+        'questionNo': manifest.questionNo,
+        'question': manifest.question,
+        'answers': list(manifest.answers),
+        'deadline': (manifest.deadline.isoformat()
+                     if manifest.deadline else None),
+    }
+
+
+def is_late(responseTime, answerTime):
+    ''' Returns True if a guess received responseTime milliseconds after the
+    question was shown missed the deadline of a question with the given
+    answer time (in seconds).'''
+    # Author: Pablo Cuesta Sierra
+    return (responseTime is not None
+            and responseTime > 1000 * (answerTime + DEADLINE_MARGIN))
+
+
+def is_over(manifest, when):
+    ''' Returns True if the deadline of the manifest had passed at the
+    given time.'''
+    # Author: Pablo Cuesta Sierra
+    return (manifest.deadline is not None
+            and when > manifest.deadline + timedelta(seconds=DEADLINE_MARGIN))
@@ -0,0 +1,110 @@
+''' Scheduler of the end of the questions.
+
+When a game shows a question (Game.update_state) its deadline (see
+models/rounds.py) is scheduled, and a background thread of the process moves
+the game to ANSWER when it passes, so the game does not depend on the page of
+the host to go on. The page of the host still moves the game at the end of
+its countdown: both use Game.advance, so the game is only moved once.
+
+The deadlines are kept in the memory of the process that showed the
+question: if it ends before a deadline, the game is moved by the host as
+before. Enabled with settings.QUESTION_SCHEDULER.
+'''
+# Author: Pablo Cuesta Sierra
+import heapq
+import logging
+import threading
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from . import rounds
+from .constants import QUESTION
+
+logger = logging.getLogger(__name__)
+
+''' Seconds after which moving a game is tried again if it failed '''
+RETRY_DELAY = 1
+
+# heap of (deadline, publicId, questionNo)
+_deadlines = []
+_condition = threading.Condition()
+_thread = None
+
+
+def enabled():
+    ''' Returns True if the games are moved to ANSWER by the server.'''
+    # Author: Pablo Cuesta Sierra
+    return settings.QUESTION_SCHEDULER
+
+
+def schedule(game):
+    ''' Schedules the end of the question shown in the game.'''
+    # Author: Pablo Cuesta Sierra
+    manifest = rounds.get(game)
+    if not enabled() or manifest is None or manifest.deadline is None:
+        return
+    # the guesses received within the margin are accepted too
+    deadline = manifest.deadline + timedelta(seconds=rounds.DEADLINE_MARGIN)
+    with _condition:
+        heapq.heappush(_deadlines, (deadline, game.publicId, game.questionNo))
+        _condition.notify()
+    _start()
+
+
+def advance_due(when=None):
+    ''' Moves to ANSWER the games whose deadline passed at the given time (by
+    default, now) if they are still in the question scheduled. The games
+    that could not be moved are scheduled again RETRY_DELAY seconds later.
+    Output: number of games moved.'''
+    # Author: Pablo Cuesta Sierra
+    Game = apps.get_model('models', 'Game')
+    when = when or timezone.now()
+    with _condition:
+        due = []
+        while _deadlines and _deadlines[0][0] <= when:
+            due.append(heapq.heappop(_deadlines))
+
+    n_moved = 0
+    for _, publicId, questionNo in due:
+        try:
+            n_moved += Game.advance(publicId, QUESTION, questionNo)
+        except Exception:  # keep moving the other games
+            logger.exception(
+                'Game %s could not be moved to ANSWER, it is tried again '
+                'in %s seconds', publicId, RETRY_DELAY)
+            with _condition:
+                heapq.heappush(_deadlines, (
+                    when + timedelta(seconds=RETRY_DELAY),
+                    publicId, questionNo))
+                _condition.notify()
+    return n_moved
+
+
+def _run():
+    while True:
+        with _condition:
+            while not _deadlines:
+                _condition.wait()
+            wait = (_deadlines[0][0] - timezone.now()).total_seconds()
+            if wait > 0:
+                # woken up earlier if a sooner deadline is scheduled
+                _condition.wait(wait)
+                continue
+        try:
+            advance_due()
+        finally:
+            connection.close()
+
+
+def _start():
+    global _thread
+    if _thread is not None:
+        return
+    with _condition:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, daemon=True)
+            _thread.start()
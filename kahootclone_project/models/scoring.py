@@ -0,0 +1,43 @@
+''' Scoring engines of the guesses.
+
+A scoring engine is a function that receives whether the guess is correct,
+the milliseconds elapsed since the question was shown (None if unknown) and
+the answer time of the question (in seconds), and returns the points awarded
+to the participant. It is computed in O(1) with data already loaded by
+Guess.save, so scoring does not query the database.
+
+The engine used is set with the dotted path settings.SCORING_ENGINE.
+'''
+# Author: Pablo Cuesta Sierra
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+''' Points of a correct guess made as soon as the question is shown '''
+MAX_POINTS = 1000
+
+
+def binary(correct, elapsed, answerTime):
+    ''' One point per correct guess.'''
+    # Author: Pablo Cuesta Sierra
+    return 1 if correct else 0
+
+
+def speed_weighted(correct, elapsed, answerTime):
+    ''' A correct guess is awarded from MAX_POINTS (answered at once) down to
+    half of MAX_POINTS (answered when the time is over). If the time is not
+    known the minimum is awarded.'''
+    # Author: Pablo Cuesta Sierra
+    if not correct:
+        return 0
+    if elapsed is None:
+        fraction = 1
+    else:
+        fraction = min(max(elapsed / (1000 * answerTime), 0), 1)
+    return round(MAX_POINTS * (1 - fraction / 2))
+
+
+def score(correct, elapsed, answerTime):
+    ''' Points awarded to a guess by the engine of the settings.'''
+    # Author: Pablo Cuesta Sierra
+    return import_string(settings.SCORING_ENGINE)(
+        correct, elapsed, answerTime)
@@ -1,12 +1,26 @@
-from django.test import TestCase
+import io
+import threading
+from contextlib import redirect_stdout
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection, models
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.forms import ValidationError
 from django.urls import reverse
+from django.utils import timezone
 
 ###################
 from .models import (
     User, Questionnaire, Question, Answer, Game, Participant, Guess
 )
 from .models import MAX_PUBLICID
+from . import (
+    gameversion, leaderboard, livestate, questionindex, rounds, scheduler,
+    scoring,
+)
 from .constants import (WAITING, QUESTION, ANSWER, LEADERBOARD)
 
 ###################
@@ -16,6 +30,8 @@ USER_SESSION_ID = "_auth_user_id"
 HOME_PAGE = "home"
 
 
+# the state of the games is kept in the cache, as with memcached
+@override_settings(CACHE_GAME_STATE=True)
 class ModelAdditionalTests(TestCase):
     """Test the models"""
     # Author: Pablo Cuesta Sierra
@@ -84,6 +100,38 @@ class ModelAdditionalTests(TestCase):
         for _ in range(create_num):
             Game.objects.last().delete()
 
+    def test_publicid_recycling(self):
+        # Author: Álvaro Zamanillo Sáez
+        print("test publicid_recycling")
+
+        # fill the range of keys, the oldest game has already finished
+        for _ in range(MAX_PUBLICID - Game.objects.count()):
+            Game.objects.create(questionnaire=self.questionnaire)
+        self.game.state = LEADERBOARD
+        self.game.save()
+
+        # the key of the finished game is reused for the new one
+        game = Game.objects.create(questionnaire=self.questionnaire)
+        self.assertEqual(game.publicId, self.game.publicId)
+        self.assertEqual(Game.objects.count(), MAX_PUBLICID)
+        self.assertEqual(
+            Game.objects.get(publicId=game.publicId).state, WAITING)
+
+    def test_publicid_free_search(self):
+        # Author: Álvaro Zamanillo Sáez
+        print("test publicid_free_search")
+
+        # leave a single free key in the middle of the range
+        Game.objects.all().delete()
+        free_publicId = MAX_PUBLICID // 2 + 1
+        Game.objects.bulk_create([
+            Game(publicId=i, questionnaire=self.questionnaire)
+            for i in range(1, MAX_PUBLICID + 1) if i != free_publicId
+        ])
+
+        game = Game.objects.create(questionnaire=self.questionnaire)
+        self.assertEqual(game.publicId, free_publicId)
+
     def test_game_state(self):
         # Author: Pablo Cuesta Sierra
         print("test game_state")
@@ -269,6 +317,380 @@ class ModelAdditionalTests(TestCase):
 
         self.assertTrue(self.game.all_participants_answered())
 
+    def test_game_counter(self):
+        # Author: Álvaro Zamanillo Sáez
+        print("test game_counter")
+
+        p1 = Participant.objects.create(game=self.game, alias="__alias1")
+        p2 = Participant.objects.create(game=self.game, alias="__alias2")
+        p3 = Participant.objects.create(game=self.game, alias="__alias3")
+        self.game.state = QUESTION
+        self.game.save()
+
+        Guess.objects.create(participant=p1, question=self.question,
+                             answer=self.answer, game=self.game)
+        Guess.objects.create(participant=p2, question=self.question,
+                             answer=self.answer, game=self.game)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.game.answered_count(), (2, 3))
+
+        # a participant that has answered leaves the game
+        p1.delete()
+        self.assertEqual(self.game.answered_count(), (1, 2))
+        Guess.objects.create(participant=p3, question=self.question,
+                             answer=self.answer, game=self.game)
+        self.assertTrue(self.game.all_participants_answered())
+
+        # the counter starts again with the next question
+        self.game.update_state()
+        self.game.update_state()
+        self.assertEqual(self.game.questionNo, 1)
+        self.assertEqual(self.game.answered_count(), (0, 2))
+        Guess.objects.create(participant=p2, question=self.question2,
+                             answer=self.answer, game=self.game)
+        self.assertEqual(self.game.answered_count(), (1, 2))
+
+    def test_question_index(self):
+        # Author: Pablo Cuesta Sierra
+        print("test question_index")
+
+        questionindex.get(self.questionnaire.id)
+        with self.assertNumQueries(0):
+            questions = questionindex.questions(self.questionnaire.id)
+            self.assertEqual(
+                [question.id for question in questions],
+                [self.question.id, self.question2.id])
+            self.assertEqual(questions[0].answerTime, 10)
+            self.assertEqual(questions[0].get_answer(self.answer.id),
+                             (self.answer.id, self.answer.answer, True))
+            self.assertEqual(questionindex.position(
+                self.questionnaire.id, self.question2.id), 1)
+
+        # the index is rebuilt after the questions or answers change
+        answer = Answer.objects.create(
+            answer="__test_additional2", question=self.question2)
+        self.assertEqual(
+            questionindex.questions(self.questionnaire.id)[1].answers,
+            ((answer.id, answer.answer, False),))
+        self.question.delete()
+        self.assertEqual(questionindex.position(
+            self.questionnaire.id, self.question2.id), 0)
+
+    def test_game_state_not_cached(self):
+        # Author: Álvaro Zamanillo Sáez
+        print("test game_state_not_cached")
+        livestate.get(self.game.publicId)
+        with override_settings(CACHE_GAME_STATE=False):
+            # without a shared cache the changes of other processes (made
+            # without going through this one) are seen at once
+            Game.objects.filter(publicId=self.game.publicId).update(
+                state=QUESTION)
+            self.assertEqual(
+                livestate.get(self.game.publicId).state, QUESTION)
+            self.assertIsNone(gameversion.etag(self.game.publicId))
+            self.assertEqual(rounds.get(
+                livestate.get(self.game.publicId)).question, self.question.id)
+            Question.objects.filter(pk=self.question.pk).update(
+                answerTime=30)
+            self.assertEqual(questionindex.questions(
+                self.questionnaire.id)[0].answerTime, 30)
+            participant = Participant.objects.create(
+                game=self.game, alias="__alias")
+            Participant.objects.filter(pk=participant.pk).update(points=7)
+            self.assertEqual(leaderboard.top(self.game.publicId, 1)[0],
+                             (1, "__alias", 7))
+
+    @override_settings(SCORING_ENGINE='models.scoring.speed_weighted')
+    def test_speed_weighted_scoring(self):
+        # Author: Pablo Cuesta Sierra
+        print("test speed_weighted_scoring")
+        self.assertEqual(scoring.speed_weighted(True, 0, 10), 1000)
+        self.assertEqual(scoring.speed_weighted(True, 2500, 10), 875)
+        self.assertEqual(scoring.speed_weighted(True, 60000, 10), 500)
+        self.assertEqual(scoring.speed_weighted(True, None, 10), 500)
+        self.assertEqual(scoring.speed_weighted(False, 0, 10), 0)
+
+        # the question start is set when the game enters QUESTION
+        self.game.update_state()
+        self.assertEqual(self.game.state, QUESTION)
+        self.assertIsNotNone(self.game.questionStart)
+        self.game.questionStart -= timedelta(seconds=5)
+        self.game.save()
+
+        fast = Participant.objects.create(game=self.game, alias="fast")
+        slow = Participant.objects.create(game=self.game, alias="slow")
+        guess = Guess.objects.create(
+            game=self.game, participant=fast,
+            question=self.question, answer=self.answer)
+        self.assertTrue(5000 <= guess.responseTime < 6000)
+        Guess.objects.create(
+            game=self.game, participant=slow, question=self.question,
+            answer=self.answer, responseTime=7500)
+
+        fast.refresh_from_db()
+        slow.refresh_from_db()
+        self.assertEqual(fast.points, guess.participant.points)
+        self.assertTrue(fast.points > slow.points)
+        self.assertEqual(slow.points, 625)
+
+    def assertUsesIndex(self, queryset, index=None):
+        ''' Checks with EXPLAIN that the query is answered with an index (the
+        one given, if any) and not scanning the whole table.'''
+        # Author: Pablo Cuesta Sierra
+        if connection.vendor == 'postgresql':
+            # the tables of the tests are so small that a sequential scan
+            # would be chosen anyway
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan TO off')
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql':
+            self.assertNotIn('Seq Scan', plan)
+            self.assertIn('Index', plan)
+        else:
+            self.assertIn('USING', plan)
+            self.assertNotIn('USE TEMP B-TREE', plan)
+        if index:
+            self.assertIn(index, plan)
+
+    def test_hot_queries_use_indexes(self):
+        # Author: Pablo Cuesta Sierra
+        print("test hot_queries_use_indexes")
+        participant = Participant.objects.create(
+            game=self.game, alias="__test_additional")
+
+        # participant of a guess
+        self.assertUsesIndex(
+            Participant.objects.filter(uuidP=participant.uuidP))
+        # repeated alias and removal of a participant (the index of the
+        # unique constraint is named by SQLite)
+        self.assertUsesIndex(
+            Participant.objects.filter(game=self.game, alias="a"))
+        # leaderboard
+        self.assertUsesIndex(
+            Participant.objects.filter(game=self.game)
+            .order_by('-points', 'alias'),
+            'participant_leaderboard')
+        # answer screen
+        self.assertUsesIndex(
+            Guess.objects.filter(game=self.game, question=self.question)
+            .values_list('answer').annotate(n=models.Count('id')),
+            'guess_distribution')
+        # publicId recycling
+        self.assertUsesIndex(
+            Game.objects.filter(state=LEADERBOARD).order_by('created_at'),
+            'game_recycling')
+
+    def test_leaderboard(self):
+        # Author: Pablo Cuesta Sierra
+        print("test leaderboard")
+
+        def check():
+            expected = [
+                (rank, participant.alias, participant.points)
+                for rank, participant in enumerate(
+                    self.game.participant_set.all(), 1)
+            ]
+            self.assertEqual(leaderboard.top(self.game.publicId, 1000),
+                             expected)
+            for participant in self.game.participant_set.all()[::7]:
+                self.assertEqual(leaderboard.rank_of(
+                    self.game.publicId, participant.uuidP),
+                    expected[[entry[1] for entry in expected].index(
+                        participant.alias)])
+
+        def committed(function, *args, **kwargs):
+            # the copy of the process is changed once the change is
+            # committed (the test runs in a transaction)
+            with self.captureOnCommitCallbacks(execute=True):
+                return function(*args, **kwargs)
+
+        participants = [
+            committed(Participant.objects.create,
+                      game=self.game, alias=f"p{n}", points=n % 5)
+            for n in range(100)
+        ]
+        check()
+
+        # scoring moves the participants in the leaderboard
+        self.game.state = QUESTION
+        self.game.save()
+        for participant in participants[::3]:
+            committed(Guess.objects.create,
+                      game=self.game, participant=participant,
+                      question=self.question, answer=self.answer)
+        committed(participants[0].delete)
+        with self.assertNumQueries(0):
+            check_top = leaderboard.top(self.game.publicId, 3)
+        check()
+        self.assertEqual(check_top[0].points, 5)
+        self.assertIsNone(
+            leaderboard.rank_of(self.game.publicId, participants[0].uuidP))
+
+        # a leaderboard being loaded only delays the readers of its game
+        other = Game.objects.create(questionnaire=self.questionnaire)
+        leaderboard.top(other.publicId, 1)
+        leaderboard.forget(self.game.publicId)
+        loading, loaded = threading.Event(), threading.Event()
+
+        def slow_load(publicId):
+            loading.set()
+            loaded.wait(5)
+            return leaderboard.Leaderboard([])
+        with mock.patch.object(leaderboard, '_load', slow_load):
+            reader = threading.Thread(
+                target=leaderboard.top, args=(self.game.publicId, 1))
+            reader.start()
+            loading.wait(5)
+            with self.assertNumQueries(0):
+                leaderboard.top(other.publicId, 1)
+            self.assertTrue(reader.is_alive())
+            loaded.set()
+            reader.join(5)
+
+        # a copy loaded (by any process) before the change is committed is
+        # out of date afterwards
+        with self.captureOnCommitCallbacks(execute=True):
+            with leaderboard.changing(self.game.publicId):
+                loaded = leaderboard._version(self.game.publicId)
+            self.assertEqual(
+                leaderboard._version(self.game.publicId), loaded)
+        self.assertNotEqual(leaderboard._version(self.game.publicId), loaded)
+
+    def test_question_deadline(self):
+        # Author: Pablo Cuesta Sierra
+        print("test question_deadline")
+        participant = Participant.objects.create(
+            game=self.game, alias="__alias")
+        self.game.update_state()
+        late = 1000 * (self.question.answerTime + rounds.DEADLINE_MARGIN + 1)
+
+        # a guess received after the deadline is rejected
+        self.assertRaises(
+            ValidationError,
+            Guess.objects.create,
+            game=self.game, participant=participant,
+            question=self.question, answer=self.answer, responseTime=late)
+        self.assertEqual(Guess.bulk_save(self.game, [Guess(
+            game=self.game, participant=participant, question=self.question,
+            answer=self.answer, responseTime=late)]), [])
+        self.assertFalse(Guess.objects.filter(game=self.game).exists())
+
+        # the server moves the game to ANSWER when the deadline passes
+        self.game.state = WAITING
+        self.game.save()
+        with override_settings(QUESTION_SCHEDULER=True), \
+                mock.patch.object(scheduler, '_start'):
+            self.game.update_state()
+            deadline = rounds.get(self.game).deadline
+            self.assertEqual(scheduler.advance_due(deadline), 0)
+            over = deadline + timedelta(seconds=rounds.DEADLINE_MARGIN)
+            # a game that could not be moved is logged and tried again
+            with mock.patch.object(Game, 'advance',
+                                   side_effect=RuntimeError), \
+                    self.assertLogs('models.scheduler', 'ERROR'):
+                self.assertEqual(scheduler.advance_due(over), 0)
+            self.assertEqual(scheduler.advance_due(over), 0)
+            self.assertEqual(scheduler.advance_due(
+                over + timedelta(seconds=scheduler.RETRY_DELAY)), 1)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.state, ANSWER)
+        self.assertEqual(scheduler.advance_due(
+            timezone.now() + timedelta(days=1)), 0)
+
+        # and the host does not move it again from the question shown
+        self.assertFalse(Game.advance(self.game.publicId, QUESTION, 0))
+        self.assertTrue(Game.advance(self.game.publicId, ANSWER, 0))
+        self.game.refresh_from_db()
+        self.assertEqual((self.game.state, self.game.questionNo),
+                         (QUESTION, 1))
+
+    def test_clone_questionnaire(self):
+        # Author: Pablo Cuesta Sierra
+        print("test clone_questionnaire")
+
+        def create(n_questions):
+            questionnaire = Questionnaire.objects.create(
+                title=f"__clone{n_questions}", user=self.user)
+            Question.objects.bulk_create([
+                Question(question=f"q{n}", questionnaire=questionnaire,
+                         answerTime=n + 1)
+                for n in range(n_questions)])
+            Answer.objects.bulk_create([
+                Answer(answer=f"a{n}", question=question,
+                       correct=n == question.answerTime % 4)
+                for question in questionnaire.question_set.all()
+                for n in range(4)])
+            return questionnaire
+
+        def contents(questionnaire):
+            return list(questionnaire.question_set.values_list(
+                'question', 'answerTime', 'answer__answer', 'answer__correct'))
+
+        # the number of queries does not depend on the size
+        n_queries = []
+        for n_questions in (10, 1000):
+            questionnaire = create(n_questions)
+            with CaptureQueriesContext(connection) as queries:
+                copy = questionnaire.clone()
+            n_queries.append(len(queries))
+            self.assertEqual(copy.title, f"__clone{n_questions} (copy)")
+            self.assertEqual(copy.user, self.user)
+            self.assertEqual(contents(copy), contents(questionnaire))
+        self.assertEqual(n_queries[0], n_queries[1])
+
+        # the copy is independent of the original
+        other = User.objects.create(username="__other")
+        copy = self.questionnaire.clone(other, "__copy")
+        self.assertEqual((copy.title, copy.user), ("__copy", other))
+        copy.question_set.first().answer_set.all().delete()
+        self.assertEqual(self.question.answer_set.count(), 1)
+        self.assertEqual(len(questionindex.questions(copy.id)), 2)
+
+    @override_settings(SCORING_ENGINE='models.scoring.binary')
+    def test_populate(self):
+        # Author: Pablo Cuesta Sierra
+        print("test populate")
+        with redirect_stdout(io.StringIO()):
+            call_command('populate', users=3, questionnaires=4, questions=30,
+                         answers=3, games=5, participants=10, guesses=123,
+                         seed=1)
+        self.assertEqual(User.objects.count(), 3)
+        self.assertEqual(Questionnaire.objects.count(), 4)
+        self.assertEqual(Question.objects.count(), 30)
+        self.assertEqual(Game.objects.count(), 5)
+        self.assertEqual(Participant.objects.count(), 50)
+        # the guesses asked for, even if they are not a multiple of the
+        # participants
+        self.assertEqual(Guess.objects.count(), 123)
+        for question in Question.objects.all():
+            self.assertEqual(
+                list(question.answer_set.values_list('correct', flat=True))
+                .count(True), 1)
+            self.assertEqual(question.answer_set.count(), 3)
+        for guess in Guess.objects.select_related('answer', 'question',
+                                                  'game', 'participant'):
+            self.assertEqual(guess.answer.question_id, guess.question_id)
+            self.assertEqual(guess.game.questionnaire_id,
+                             guess.question.questionnaire_id)
+            self.assertEqual(guess.participant.game_id, guess.game_id)
+        # the points are those of the guesses (one per correct guess)
+        for participant in Participant.objects.all():
+            self.assertEqual(participant.points, participant.guess_set.filter(
+                answer__correct=True).count())
+        # new rows get new ids
+        Questionnaire.objects.create(title="__new", user=User.objects.first())
+
+        # at most one guess of each question of the game per participant
+        errors = io.StringIO()
+        with redirect_stdout(io.StringIO()):
+            call_command('populate', users=3, questionnaires=4, questions=30,
+                         answers=3, games=5, participants=10, guesses=10**4,
+                         seed=1, stderr=errors)
+        self.assertIn('Only', errors.getvalue())
+        self.assertEqual(Guess.objects.count(), sum(
+            10 * game.questionnaire.question_set.count()
+            for game in Game.objects.all()))
+
     def test_too_many_answers(self):
         # Author: Pablo Cuesta Sierra
         print("test too_many_answers")
@@ -295,6 +717,29 @@ class ModelAdditionalTests(TestCase):
         )
 
 
+# the state of the games is kept in the cache, as with memcached
+@override_settings(CACHE_GAME_STATE=True)
+class SimulationTests(TransactionTestCase):
+    """Test the simulation of a game with concurrent players"""
+    # Author: Pablo Cuesta Sierra
+
+    def test_simulate_game(self):
+        # Author: Pablo Cuesta Sierra
+        print("test simulate_game")
+        out = io.StringIO()
+        # (the in-memory database of the tests does not take concurrent
+        # writes)
+        call_command('simulategame', players=20, workers=1, questions=2,
+                     answer_time=5, think='constant', think_mean=0, seed=1,
+                     stdout=out)
+        out = out.getvalue()
+        self.assertIn("20 players, 20 joined, 40 guesses", out)
+        self.assertIn("lost updates: {'joins': 0, 'guesses': 0, "
+                      "'points': 0, 'participant counter': 0}", out)
+        # the rows created are deleted
+        self.assertFalse(User.objects.filter(username="__simulation").exists())
+
+
 class ModelViewsAdditionalTests(TestCase):
     # Author: Pablo Cuesta Sierra
     def setUp(self):
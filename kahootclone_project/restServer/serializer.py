@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from models import events
 from models.models import Participant, Game, Guess
 
 
@@ -18,3 +19,34 @@ class GuessSerializer(serializers.ModelSerializer):
     class Meta:
         model = Guess
         fields = '__all__'
+
+
+# The responses of the endpoints polled by every player are built by hand
+# with the fields the players read: a ModelSerializer creates its fields for
+# each response and sends every field of the model.
+
+def game_data(game):
+    ''' Fields of a game read by the players (the same as its state event,
+    see models.events).'''
+    # Author: Álvaro Zamanillo Sáez
+    return events.state_data(game)
+
+
+def participant_data(participant):
+    ''' Fields of a participant read by the players when joining.'''
+    # Author: Álvaro Zamanillo Sáez
+    return {
+        'game': participant.game_id,
+        'alias': participant.alias,
+        'uuidP': str(participant.uuidP),
+    }
+
+
+def guess_data(guess):
+    ''' Fields of a guess returned when it is received.'''
+    # Author: Álvaro Zamanillo Sáez
+    return {
+        'game': guess.game_id,
+        'question': guess.question_id,
+        'answer': guess.answer_id,
+    }
@@ -1,10 +1,25 @@
 # Author: Pablo Cuesta Sierra <pablo.cuestas@estudiante.uam.es>
-
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
 from rest_framework import status
-from rest_framework.test import APITestCase, APIClient
+from django.db import IntegrityError, connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import (
+    APITestCase, APITransactionTestCase, APIClient)
 from models.models import (
     Game, Guess, Participant, User, Questionnaire, Question, Answer)
 from rest_framework.reverse import reverse
+from models import guessbuffer, leaderboard, livestate
+from kahootclone import push
+from kahootclone.asgi import application
 from models.constants import QUESTION, WAITING, ANSWER, LEADERBOARD
 ###################
 # You may modify the following variables
@@ -21,12 +36,15 @@ from models.constants import QUESTION, WAITING, ANSWER, LEADERBOARD
 
 GAME_DETAIL = "game-detail"
 GAME_LIST = "game-list"
+GAME_LEADERBOARD = "game-leaderboard"
+GAME_ROUND = "game-round"
 
 PARTICIPANT_DETAIL = "participant-detail"
 PARTICIPANT_LIST = "participant-list"
 
 GUESS_DETAIL = "guess-detail"
 GUESS_LIST = "guess-list"
+GUESS_BULK = "guess-bulk"
 
 
 # these are the error messages returned by the application in
@@ -46,6 +64,8 @@ GAME_NOT_WAITING_ERROR = "This game is not accepting participants"
 #####################################################
 
 
+# the state of the games is kept in the cache, as with memcached
+@override_settings(CACHE_GAME_STATE=True)
 class RestAdditionalTests(APITestCase):
     """ additional tests for the rest framework seeking full coverage
     """
@@ -180,6 +200,378 @@ class RestAdditionalTests(APITestCase):
              "knowing its pulicId.")
         )
 
+    def test016_get_game_live_state(self):
+        " polling a game is answered without querying the database "
+        # Author: Álvaro Zamanillo Sáez
+
+        url = reverse(GAME_DETAIL, kwargs={'publicId': self.game.publicId})
+
+        with self.assertNumQueries(0):
+            response = self.client.get(path=url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['state'], WAITING)
+
+        # the changes of the game are written through
+        self.game.update_state()
+        with self.assertNumQueries(0):
+            response = self.client.get(path=url, format='json')
+        self.assertEqual(response.data['state'], QUESTION)
+        self.assertEqual(response.data['questionNo'], 0)
+
+        # a game not in the cache is read once from the database
+        livestate.forget(self.game.publicId)
+        with self.assertNumQueries(1):
+            self.client.get(path=url, format='json')
+        with self.assertNumQueries(0):
+            self.client.get(path=url, format='json')
+
+        # deleted games are removed from the cache
+        self.game.delete()
+        response = self.client.get(path=url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test017_push_game_events(self):
+        " the events of a game are pushed to the subscribed clients "
+        # Author: Álvaro Zamanillo Sáez
+
+        scope = {'type': 'http', 'method': 'GET', 'headers': [],
+                 'path': f'/events/{self.game.publicId}/'}
+
+        async def listen(scope, events_expected, action=None):
+            sent = []
+            disconnect = asyncio.Event()
+            # as an ASGI server, the (empty) body of the request comes first
+            messages = [{'type': 'http.request', 'body': b'',
+                         'more_body': False}]
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            task = asyncio.ensure_future(application(scope, receive, send))
+            while len(sent) < 2 and not task.done():
+                await asyncio.sleep(0.01)
+            if action:
+                await sync_to_async(action)()
+            while len(sent) < events_expected and not task.done():
+                await asyncio.sleep(0.01)
+            disconnect.set()
+            await task
+            return sent
+
+        sent = async_to_sync(listen)(scope, 3, self.game.update_state)
+        self.assertEqual(sent[0]['status'], status.HTTP_200_OK)
+        # the current state is sent first, then the new one
+        self.assertIn(b'event: state', sent[1]['body'])
+        self.assertIn(f'"state": {WAITING}'.encode(), sent[1]['body'])
+        self.assertIn(b'event: state', sent[2]['body'])
+        self.assertIn(f'"state": {QUESTION}'.encode(), sent[2]['body'])
+
+        # a game that does not exist
+        self.game.delete()
+        sent = async_to_sync(listen)(scope, 2)
+        self.assertEqual(sent[0]['status'], status.HTTP_404_NOT_FOUND)
+
+    @override_settings(SCORING_ENGINE='models.scoring.binary')
+    def test018_get_game_leaderboard(self):
+        " top of the leaderboard and rank of a participant "
+        # Author: Pablo Cuesta Sierra
+
+        url = reverse(GAME_LEADERBOARD,
+                      kwargs={'publicId': self.game.publicId})
+        for points, alias in ((3, "luis"), (3, "ana"), (0, "zoe")):
+            Participant.objects.create(
+                game=self.game, alias=alias, points=points)
+
+        response = self.client.get(url, {'top': 2, 'uuidp': 'asdf'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['top'], [
+            {'rank': 1, 'alias': "ana", 'points': 3},
+            {'rank': 2, 'alias': "luis", 'points': 3},
+        ])
+        self.assertIsNone(response.data['participant'])
+
+        # the leaderboard is updated when scoring, without reading it again
+        # from the database
+        self.game.state = QUESTION
+        self.game.save()
+        zoe = Participant.objects.get(alias="zoe")
+        for question in (self.question, self.question2):
+            self.set_current_url(reverse(GUESS_LIST))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assert_status_in_creation_request(
+                    msg="The guess should be created",
+                    data={'game': self.game.publicId, 'uuidp': zoe.uuidP,
+                          'answer': 0},
+                    expected_status_code=status.HTTP_201_CREATED)
+            self.game.questionNo += 1
+            self.game.save()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'uuidp': zoe.uuidP})
+        self.assertEqual(response.data['participant'],
+                         {'rank': 3, 'alias': "zoe", 'points': 2})
+        self.assertEqual(len(response.data['top']), 4)
+
+        # a copy out of date is loaded again
+        Participant.objects.filter(alias="zoe").update(points=10)
+        leaderboard.forget(self.game.publicId)
+        response = self.client.get(url, {'uuidp': zoe.uuidP})
+        self.assertEqual(response.data['participant']['rank'], 1)
+
+        response = self.client.get(url, {'top': 'asdf'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(
+            reverse(GAME_LEADERBOARD, kwargs={'publicId': 999999}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test019_get_game_not_modified(self):
+        " polling a game that did not change is answered with 304 "
+        # Author: Álvaro Zamanillo Sáez
+
+        url = reverse(GAME_DETAIL, kwargs={'publicId': self.game.publicId})
+
+        def poll(etag, expected_status_code):
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, expected_status_code)
+            self.assertIn('ETag', response)
+            return response['ETag']
+
+        etag = poll('', status.HTTP_200_OK)
+        self.assertEqual(poll(etag, status.HTTP_304_NOT_MODIFIED), etag)
+
+        # every change of the game, its participants or guesses is a new
+        # version
+        participant = Participant.objects.create(
+            game=self.game, alias="luis")
+        etag = poll(etag, status.HTTP_200_OK)
+        self.game.update_state()
+        etag = poll(etag, status.HTTP_200_OK)
+        Guess.objects.create(participant=participant, game=self.game,
+                             question=self.question, answer=self.answer)
+        etag = poll(etag, status.HTTP_200_OK)
+        participant.delete()
+        etag = poll(etag, status.HTTP_200_OK)
+        self.assertEqual(poll(etag, status.HTTP_304_NOT_MODIFIED), etag)
+
+    def test020_long_poll_game(self):
+        " a long poll is held until the state of the game changes "
+        # Author: Álvaro Zamanillo Sáez
+
+        url = reverse(GAME_DETAIL, kwargs={'publicId': self.game.publicId})
+        state = self.client.get(url)['X-Game-State']
+
+        async def long_poll(since_state, action=None, disconnect=False):
+            scope = {'type': 'http', 'method': 'GET', 'path': url,
+                     'query_string': f'since_state={since_state}'.encode(),
+                     'headers': [(b'host', b'testserver')]}
+            sent = []
+            messages = [{'type': 'http.request', 'body': b''}]
+            disconnected = asyncio.Event()
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            task = asyncio.ensure_future(application(scope, receive, send))
+            await asyncio.sleep(0.1)
+            held = not task.done()
+            if disconnect:
+                disconnected.set()
+            if action:
+                await sync_to_async(action)()
+            await asyncio.wait_for(task, timeout=5)
+            if disconnect:
+                return held, None, None
+            self.assertEqual(sent[0]['status'], status.HTTP_200_OK)
+            headers = dict(sent[0]['headers'])
+            # the client is told whether it was held
+            self.assertEqual(headers.get(b'x-long-poll') == b'held', held)
+            return (held, json.loads(sent[1]['body']),
+                    headers[b'X-Game-State'].decode())
+
+        # the client is out of date
+        held, game, _ = async_to_sync(long_poll)('0-0')
+        self.assertFalse(held)
+        self.assertEqual(game['state'], WAITING)
+
+        # held until the state of the game changes, players joining do not
+        # count
+        def join_and_start():
+            Participant.objects.create(game=self.game, alias="juan")
+            self.game.update_state()
+        held, game, state = async_to_sync(long_poll)(state, join_and_start)
+        self.assertTrue(held)
+        self.assertEqual(game['state'], QUESTION)
+
+        # changed by another process (not published to this one)
+        def change_live_state():
+            self.game.state = ANSWER
+            livestate.store(self.game)
+        with mock.patch.object(push, 'LONG_POLL_CHECK', 0.05):
+            held, game, state = async_to_sync(long_poll)(
+                state, change_live_state)
+        self.assertTrue(held)
+        self.assertEqual(game['state'], ANSWER)
+
+        # or until the timeout passes, other changes do not count: the
+        # client is held again with the same state
+        with mock.patch.object(push, 'LONG_POLL_TIMEOUT', 0.5):
+            start = time.monotonic()
+            held, game, state_after = async_to_sync(long_poll)(
+                state, lambda: Participant.objects.create(
+                    game=self.game, alias="luis"))
+            self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertTrue(held)
+        self.assertEqual(game['state'], ANSWER)
+        self.assertEqual(state_after, state)
+
+        # or the client leaves
+        held, _, _ = async_to_sync(long_poll)(state_after, disconnect=True)
+        self.assertTrue(held)
+
+    def test021_api_requests_in_threads(self):
+        " the requests to the api are handled at once under asgi "
+        # Author: Álvaro Zamanillo Sáez
+
+        url = reverse(GAME_DETAIL, kwargs={'publicId': self.game.publicId})
+        origin = push.settings.CORS_ORIGIN_WHITELIST[0]
+        scope = {'type': 'http', 'method': 'GET', 'path': url,
+                 'query_string': b'',
+                 'headers': [(b'host', b'testserver'),
+                             (b'origin', origin.encode())]}
+
+        async def get():
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                sent.append(message)
+
+            await application(scope, receive, send)
+            return sent[0]['status'], dict(sent[0]['headers'])
+
+        async def get_at_once():
+            return await asyncio.gather(get(), get())
+
+        # each request waits for the other one: they would never meet if
+        # they were handled one after the other
+        barrier = threading.Barrier(2, timeout=5)
+        get_game = livestate.get
+
+        def get_game_at_once(publicId):
+            barrier.wait()
+            return get_game(publicId)
+
+        with mock.patch.object(livestate, 'get', get_game_at_once):
+            responses = async_to_sync(get_at_once)()
+        for status_code, headers in responses:
+            self.assertEqual(status_code, status.HTTP_200_OK)
+            # the middleware is applied too
+            self.assertEqual(
+                headers[b'Access-Control-Allow-Origin'], origin.encode())
+
+    def test022_responses_fields(self):
+        " the responses polled by the players only have the fields read "
+        # Author: Álvaro Zamanillo Sáez
+
+        response = self.client.post(
+            reverse(PARTICIPANT_LIST),
+            {'game': self.game.publicId, 'alias': "luis"}, format='json')
+        participant = Participant.objects.get(alias="luis")
+        self.assertEqual(response.json(), {
+            'game': self.game.publicId, 'alias': "luis",
+            'uuidP': str(participant.uuidP)})
+
+        self.game.update_state()
+        response = self.client.get(
+            reverse(GAME_DETAIL, kwargs={'publicId': self.game.publicId}))
+        self.assertEqual(response.json(), {
+            'publicId': self.game.publicId, 'state': QUESTION,
+            'questionNo': 0, 'countdownTime': self.question.answerTime})
+
+        response = self.client.post(
+            reverse(GUESS_LIST), {'game': self.game.publicId,
+                                  'uuidp': str(participant.uuidP),
+                                  'answer': 0}, format='json')
+        self.assertEqual(response.json(), {
+            'game': self.game.publicId, 'question': self.question.id,
+            'answer': self.answer.id})
+
+    def test023_round_manifest(self):
+        " the question shown is served and guesses are checked against it "
+        # Author: Pablo Cuesta Sierra
+
+        url = reverse(GAME_ROUND, kwargs={'publicId': self.game.publicId})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        participant = Participant.objects.create(game=self.game, alias="luis")
+        self.game.update_state()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        answers = list(self.question.answer_set.order_by('id')
+                       .values_list('id', flat=True))
+        deadline = self.game.questionStart + timedelta(
+            seconds=self.question.answerTime)
+        self.assertEqual(response.json(), {
+            'questionNo': 0, 'question': self.question.id,
+            'answers': answers, 'deadline': deadline.isoformat()})
+
+        # neither the game nor the question are read from the database
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse(GUESS_LIST), {'game': self.game.publicId,
+                                      'uuidp': str(participant.uuidP),
+                                      'answer': len(answers) - 1},
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['answer'], answers[-1])
+        for query in queries.captured_queries:
+            for table in ('models_game', 'models_question', 'models_answer'):
+                self.assertNotIn(f'FROM "{table}"', query['sql'])
+
+        response = self.client.post(
+            reverse(GUESS_LIST), {'game': self.game.publicId,
+                                  'uuidp': str(participant.uuidP),
+                                  'answer': len(answers)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.game.update_state()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test024_late_guess(self):
+        " guesses received after the deadline of the question are rejected "
+        # Author: Pablo Cuesta Sierra
+
+        participant = Participant.objects.create(game=self.game, alias="luis")
+        self.game.update_state()
+        self.game.questionStart -= timedelta(
+            seconds=self.question.answerTime + 2)
+        self.game.save()
+
+        response = self.client.post(
+            reverse(GUESS_LIST), {'game': self.game.publicId,
+                                  'uuidp': str(participant.uuidP),
+                                  'answer': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data, "The time to answer is over")
+        self.assertFalse(participant.guess_set.exists())
+
     # ==== PARTICIPANT ====
     def test025_add_participant_with_missing_values(self):
         " add participant with missing values "
@@ -238,6 +630,48 @@ class RestAdditionalTests(APITestCase):
             expected_status_code=status.HTTP_201_CREATED
         )
 
+    def test027_add_participant_with_taken_alias(self):
+        " a taken alias is rejected, or replaced by a suggestion "
+        # Author: Pablo Cuesta Sierra
+
+        self.set_current_url(reverse(PARTICIPANT_LIST))
+        self.assert_status_in_creation_request(
+            msg="Aliases should be unique in a game",
+            data={'game': self.gameDict['publicId'], 'alias': "pepe"},
+            expected_status_code=status.HTTP_403_FORBIDDEN
+        )
+
+        for suggestion in ("pepe2", "pepe3"):
+            response = self.assert_status_in_creation_request(
+                msg="A free alias should be suggested",
+                data={'game': self.gameDict['publicId'], 'alias': "pepe",
+                      'suggest': True},
+                expected_status_code=status.HTTP_201_CREATED
+            )
+            self.assertEqual(response.data['alias'], suggestion)
+        self.assertEqual(self.game.answered_count()[1], 3)
+
+        # the suggestion fits in the field
+        longAlias = "x" * 50
+        Participant.objects.create(game=self.game, alias=longAlias)
+        response = self.assert_status_in_creation_request(
+            msg="A free alias should be suggested",
+            data={'game': self.gameDict['publicId'], 'alias': longAlias,
+                  'suggest': True},
+            expected_status_code=status.HTTP_201_CREATED
+        )
+        self.assertEqual(response.data['alias'], "x" * 49 + "2")
+
+        # other constraints are reported as a bad request
+        with mock.patch.object(Participant, 'save',
+                               side_effect=IntegrityError("__constraint")):
+            response = self.assert_status_in_creation_request(
+                msg="A violated constraint should be a bad request",
+                data={'game': self.gameDict['publicId'], 'alias': "juan",
+                      'suggest': True},
+            )
+        self.assertEqual(response.data, {'error': "__constraint"})
+
     # ==== GUESS ===
     def test_035_add_guess_with_missing_values(self):
         " add a guess with missing (or invalid) values "
@@ -285,3 +719,240 @@ class RestAdditionalTests(APITestCase):
                   'game': self.gameDict['publicId'],
                   'answer': 0}
         )
+
+    @override_settings(SCORING_ENGINE='models.scoring.binary')
+    def test_037_add_bulk_guesses(self):
+        " add the guesses of many participants in one request "
+        # Author: Álvaro Zamanillo Sáez
+
+        self.set_current_url(reverse(GUESS_BULK))
+
+        # only while a question is shown
+        self.assert_status_in_creation_request(
+            msg="Guesses should not be created in state WAITING",
+            data={'game': self.gameDict['publicId'], 'guesses': []},
+            expected_status_code=status.HTTP_403_FORBIDDEN
+        )
+        self.game.state = QUESTION
+        self.game.save()
+        self.assert_status_in_creation_request(
+            msg="Bulk guess creation should require a valid game id",
+            data={'game': 1, 'guesses': []},
+        )
+
+        def create_participants(n):
+            first = Participant.objects.count()
+            return [Participant.objects.create(game=self.game, alias=f"p{i}")
+                    for i in range(first, first + n)]
+
+        right, wrong, invalid = create_participants(3)
+        response = self.assert_status_in_creation_request(
+            msg="Valid guesses should be created",
+            data={'game': self.gameDict['publicId'], 'guesses': [
+                {'uuidp': str(right.uuidP), 'answer': 0},
+                {'uuidp': str(wrong.uuidP), 'answer': 1},
+                {'uuidp': str(right.uuidP), 'answer': 1},  # repeated
+                {'uuidp': str(self.participant.uuidP), 'answer': 0},
+                {'uuidp': str(invalid.uuidP), 'answer': 5},
+                {'uuidp': 'asdf', 'answer': 0},
+                'asdf',
+            ]},
+            expected_status_code=status.HTTP_201_CREATED
+        )
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(len(response.data['rejected']), 5)
+        self.assertEqual(
+            Guess.objects.get(participant=right).answer, self.answer)
+        self.assertEqual(
+            Guess.objects.get(participant=wrong).answer, self.answer2)
+        right.refresh_from_db()
+        wrong.refresh_from_db()
+        self.assertEqual((right.points, wrong.points), (1, 0))
+        self.assertEqual(self.game.answered_count(), (3, 4))
+
+        # the number of queries does not depend on the number of guesses
+        queries = []
+        for n in (10, 100):
+            participants = create_participants(n)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post(
+                    self.current_url, format='json', data={
+                        'game': self.gameDict['publicId'],
+                        'guesses': [{'uuidp': str(participant.uuidP),
+                                     'answer': 0}
+                                    for participant in participants]})
+            self.assertEqual(response.data['created'], len(participants))
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+        # (including pepe, who guessed in setUp, and right)
+        self.assertEqual(
+            Participant.objects.filter(points=1).count(), 2 + 10 + 100)
+
+    @override_settings(GUESS_WRITE_BEHIND=True, GUESS_FLUSH_INTERVAL=None,
+                       SCORING_ENGINE='models.scoring.binary')
+    def test_038_write_behind_guesses(self):
+        " guesses acknowledged at once and stored when the question ends "
+        # Author: Álvaro Zamanillo Sáez
+        self.addCleanup(guessbuffer.flush_all)
+        self.set_current_url(reverse(GUESS_LIST))
+        self.game.update_state()
+        right = Participant.objects.create(game=self.game, alias="right")
+        wrong = Participant.objects.create(game=self.game, alias="wrong")
+
+        def guess(participant, answer, expected_status_code):
+            self.assert_status_in_creation_request(
+                msg=f"Unexpected status for the guess of {participant}",
+                data={'game': self.gameDict['publicId'],
+                      'uuidp': participant.uuidP,
+                      'answer': answer},
+                expected_status_code=expected_status_code
+            )
+
+        guess(right, 0, status.HTTP_202_ACCEPTED)
+        guess(wrong, 1, status.HTTP_202_ACCEPTED)
+        guess(right, 1, status.HTTP_403_FORBIDDEN)
+        # pepe's guess was already stored, it is kept
+        guess(self.participant, 1, status.HTTP_202_ACCEPTED)
+        self.assertFalse(Guess.objects.filter(
+            participant__in=[right, wrong]).exists())
+
+        # the guesses are stored before the answer is shown
+        self.game.update_state()
+        self.assertEqual(self.game.state, ANSWER)
+        self.assertEqual(self.game.guess_distribution(self.question),
+                         {self.answer.id: 2, self.answer2.id: 1})
+        self.assertEqual(self.game.answered_count(), (3, 3))
+        right.refresh_from_db()
+        self.assertEqual(right.points, 1)
+        self.assertEqual(Guess.objects.get(
+            participant=self.participant).answer, self.answer)
+
+        guess(wrong, 0, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(guessbuffer.flush(self.game.publicId), 0)
+
+    @override_settings(GUESS_WRITE_BEHIND=True, GUESS_FLUSH_INTERVAL=None)
+    def test_039_write_behind_participant_leaves(self):
+        " the guesses buffered are stored if a participant leaves "
+        # Author: Álvaro Zamanillo Sáez
+        self.addCleanup(guessbuffer.flush_all)
+        self.set_current_url(reverse(GUESS_LIST))
+        self.game.update_state()
+        participants = [
+            Participant.objects.create(game=self.game, alias=f"p{n}")
+            for n in range(3)]
+        for participant in participants:
+            self.assert_status_in_creation_request(
+                msg="The guess should be accepted",
+                data={'game': self.gameDict['publicId'],
+                      'uuidp': participant.uuidP, 'answer': 0},
+                expected_status_code=status.HTTP_202_ACCEPTED)
+
+        participants[0].delete()
+        self.game.update_state()
+        self.assertEqual(self.game.state, ANSWER)
+        self.assertEqual(set(Guess.objects.filter(
+            question=self.question).exclude(
+            participant=self.participant).values_list(
+            'participant', flat=True)), {p.id for p in participants[1:]})
+
+        # the batches that could not be stored are kept
+        self.game.state = QUESTION
+        self.game.questionNo = 1
+        self.game.save()
+        guessbuffer.add(self.game, Guess(
+            participant=participants[1], answer=self.answer3))
+        with mock.patch.object(Guess, 'bulk_save',
+                               side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            guessbuffer.flush(self.game.publicId)
+        self.assertEqual(guessbuffer.flush(self.game.publicId), 1)
+
+
+# the state of the games is kept in the cache, as with memcached
+@override_settings(CACHE_GAME_STATE=True)
+class RestConcurrencyTests(APITransactionTestCase):
+    """ guesses sent at the same time by many participants (rows are really
+        committed, so every thread sees them)
+    """
+    N_PARTICIPANTS = 1000
+    N_THREADS = 16
+
+    def setUp(self):
+        # Author: Álvaro Zamanillo Sáez
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # the tables of an in-memory database are locked by each writer
+            self.skipTest('needs a database that accepts concurrent writes')
+        user = User.objects.create_user(username='a', password='a')
+        questionnaire = Questionnaire.objects.create(
+            title='questionnaire_title', user=user)
+        self.questions = [
+            Question.objects.create(
+                question=f'question {n}', questionnaire=questionnaire)
+            for n in range(2)
+        ]
+        self.answers = [
+            [Answer.objects.create(answer='right', question=question,
+                                   correct=True),
+             Answer.objects.create(answer='wrong', question=question,
+                                   correct=False)]
+            for question in self.questions
+        ]
+        self.game = Game.objects.create(
+            questionnaire=questionnaire, state=QUESTION)
+        Participant.objects.bulk_create([
+            Participant(game=self.game, alias=f'player{n}')
+            for n in range(self.N_PARTICIPANTS)
+        ])
+        self.participants = list(Participant.objects.filter(game=self.game))
+
+    def run_in_threads(self, function, arguments):
+        # Author: Álvaro Zamanillo Sáez
+        def task(argument):
+            try:
+                return function(argument)
+            finally:
+                # every thread opens its own connection
+                connection.close()
+
+        with ThreadPoolExecutor(self.N_THREADS) as executor:
+            return list(executor.map(task, arguments))
+
+    @override_settings(SCORING_ENGINE='models.scoring.binary')
+    def test036_concurrent_guesses(self):
+        " parallel guesses (also repeated ones) do not lose any point "
+        # Author: Álvaro Zamanillo Sáez
+        def even(participant):
+            return participant.alias[-1] in '02468'
+
+        def post_guess(participant):
+            # the even participants choose the right answer
+            return APIClient().post(
+                reverse(GUESS_LIST),
+                data={'game': self.game.publicId,
+                      'uuidp': participant.uuidP,
+                      'answer': 0 if even(participant) else 1},
+                format='json').status_code
+
+        def guess_next_question(participant):
+            # at the same time, every participant guesses the next question
+            Guess.objects.create(
+                game=self.game, participant=participant,
+                question=self.questions[1], answer=self.answers[1][0])
+            return status.HTTP_201_CREATED
+
+        work = [(post_guess, participant) for participant in
+                self.participants * 2] + \
+            [(guess_next_question, participant)
+             for participant in self.participants]
+        codes = self.run_in_threads(lambda job: job[0](job[1]), work)
+
+        # each participant guessed the current question exactly once
+        self.assertEqual(
+            codes.count(status.HTTP_201_CREATED), 2 * self.N_PARTICIPANTS)
+        self.assertEqual(
+            codes.count(status.HTTP_403_FORBIDDEN), self.N_PARTICIPANTS)
+        self.assertEqual(Guess.objects.filter(
+            question=self.questions[0]).count(), self.N_PARTICIPANTS)
+
+        for participant in Participant.objects.filter(game=self.game):
+            self.assertEqual(participant.points, 2 if even(participant) else 1)
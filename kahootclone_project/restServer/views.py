@@ -1,15 +1,41 @@
+import uuid
+
+from django.db import IntegrityError
 from django.forms import ValidationError
+from django.http import Http404
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
 from rest_framework.response import Response
 import rest_framework.permissions as permissions
 
-from models.constants import WAITING
+from models import (
+    events, gameversion, guessbuffer, leaderboard, livestate, questionindex,
+    rounds,
+)
+from models.constants import QUESTION, WAITING
 from models.models import Participant, Game, Guess
 from restServer.serializer import (
-    ParticipantSerializer, GameSerializer, GuessSerializer
+    ParticipantSerializer, GameSerializer, GuessSerializer,
+    game_data, guess_data, participant_data,
 )
 
 
+''' Header with the state of the game (see models.events.state_token), to be
+    sent back as since_state to wait for its next state (see
+    kahootclone.push) '''
+STATE_HEADER = 'X-Game-State'
+
+''' Entries of the leaderboard returned by default and at most '''
+LEADERBOARD_TOP = 10
+MAX_LEADERBOARD_TOP = 100
+
+''' Aliases suggested to a participant whose alias is taken before giving
+    up (other participants may take the suggestions at the same time) '''
+MAX_ALIAS_SUGGESTIONS = 3
+
 # ------------------ USEFUL RESPONSES ------------------
 
 RESPONSE_GAME_WAITING = Response(
@@ -17,6 +43,11 @@ RESPONSE_GAME_WAITING = Response(
     status=status.HTTP_403_FORBIDDEN
 )
 
+RESPONSE_TIME_OVER = Response(
+    "The time to answer is over",
+    status=status.HTTP_403_FORBIDDEN
+)
+
 
 def RESPONSE_PARTICIPANT_NONE_VALUES(id, alias, game):
     ''' Response used when the input of a Participant
@@ -85,6 +116,73 @@ class GameView(viewsets.ModelViewSet):
     serializer_class = GameSerializer
     lookup_field = 'publicId'
 
+    @method_decorator(condition(etag_func=lambda request, **kwargs:
+                                gameversion.etag(kwargs['publicId'])))
+    def retrieve(self, request, *args, **kwargs):
+        ''' Returns the game from its live state (see models.livestate), so
+        the polling of the players does not query the database. If the game
+        did not change since the ETag of the player it returns 304 (see
+        models.gameversion). The state of the game is sent in the header
+        STATE_HEADER; with since_state=<state> the request is held until
+        the state changes (see kahootclone.push).'''
+        # Author: Álvaro Zamanillo Sáez
+        game = livestate.get(self.kwargs[self.lookup_field])
+        if game is None:
+            raise Http404
+        # started if not known, so the next polls are sent an ETag
+        gameversion.current(game.publicId)
+
+        return Response(game_data(game),
+                        headers={STATE_HEADER: events.state_token(game)})
+
+    @action(detail=True, methods=['get'], url_path='leaderboard',
+            url_name='leaderboard')
+    def get_leaderboard(self, request, *args, **kwargs):
+        ''' Returns the top of the leaderboard of the game and the entry of a
+            participant (see models.leaderboard).
+            Input: publicId, optional parameters top (number of entries) and
+            uuidp (participant).
+            Output: {top: [{rank, alias, points}, ...],
+                     participant: {rank, alias, points}}
+        '''
+        # Author: Pablo Cuesta Sierra
+        game = livestate.get(self.kwargs[self.lookup_field])
+        if game is None:
+            raise Http404
+        try:
+            top = min(int(request.query_params.get('top', LEADERBOARD_TOP)),
+                      MAX_LEADERBOARD_TOP)
+        except ValueError:
+            return Response("Invalid top", status=status.HTTP_400_BAD_REQUEST)
+
+        data = {'top': [
+            entry._asdict() for entry in leaderboard.top(game.publicId, top)
+        ]}
+        if 'uuidp' in request.query_params:
+            entry = leaderboard.rank_of(
+                game.publicId, request.query_params['uuidp'])
+            data['participant'] = entry._asdict() if entry else None
+        return Response(data)
+
+    @action(detail=True, methods=['get'], url_path='round',
+            url_name='round')
+    def get_round(self, request, *args, **kwargs):
+        ''' Returns the manifest of the question shown in the game (see
+            models.rounds).
+            Input: publicId
+            Output: {questionNo, question, answers: [answer id, ...],
+                     deadline}
+        '''
+        # Author: Pablo Cuesta Sierra
+        game = livestate.get(self.kwargs[self.lookup_field])
+        if game is None:
+            raise Http404
+        manifest = rounds.get(game)
+        if manifest is None:
+            return Response("Wait until the question is shown",
+                            status=status.HTTP_404_NOT_FOUND)
+        return Response(rounds.data(manifest))
+
     def list(self, request, *args, **kwargs):
         # Author: Pablo Cuesta Sierra
         return RESPONSE_METHOD_NOT_ALLOWED((
@@ -106,7 +204,10 @@ class ParticipantViewSet(viewsets.ModelViewSet):
         return [PostPermission()]
 
     def create(self, request, *args, **kwargs):
-        ''' Creates a participant given a publicId and a alias. '''
+        ''' Creates a participant given a publicId and a alias.
+            If 'suggest' is true and the alias is taken, the participant is
+            created with the alias suggested by Participant.suggest_alias.
+        '''
 
         alias = request.data.get('alias', None)
         try:
@@ -122,10 +223,33 @@ class ParticipantViewSet(viewsets.ModelViewSet):
         if game.state != WAITING:
             return RESPONSE_GAME_WAITING
 
-        try:
-            return super().create(request, *args, **kwargs)
-        except ValidationError as e:
-            return Response(e, status=status.HTTP_403_FORBIDDEN)
+        suggest = str(request.data.get('suggest', '')).lower() in [
+            'true', 't', '1']
+        data = request.data.copy()
+        for _ in range(1 + MAX_ALIAS_SUGGESTIONS):
+            serializer = self.get_serializer(data=data)
+            serializer.is_valid(raise_exception=True)
+            try:
+                self.perform_create(serializer)
+                break
+            except ValidationError as e:
+                # the alias is taken (see Participant.save)
+                if not suggest:
+                    return Response(e, status=status.HTTP_403_FORBIDDEN)
+                data['alias'] = Participant.suggest_alias(game, alias)
+            except IntegrityError as e:
+                # any other constraint (the exception cannot be rendered)
+                return Response({'error': str(e)},
+                                status=status.HTTP_400_BAD_REQUEST)
+        else:
+            return Response(
+                f'Participant already exists in the game: "{alias}"',
+                status=status.HTTP_403_FORBIDDEN)
+
+        participant = serializer.instance
+        events.publish(game.publicId, 'join', {'alias': participant.alias})
+        return Response(participant_data(participant),
+                        status=status.HTTP_201_CREATED)
 
 
 class GuessViewSet(viewsets.ModelViewSet):
@@ -143,44 +267,153 @@ class GuessViewSet(viewsets.ModelViewSet):
         return [PostPermission()]
 
     def create(self, request, *args, **kwargs):
+        # the response time of the guess is measured from its arrival
+        received = timezone.now()
 
         # get input data
         gameId = request.data.get('game', None)
         participantId = request.data.get('uuidp', None)
         answerIndex = request.data.get('answer', None)
 
-        try:
-            game = Game.objects.get(publicId=gameId)
-        except Game.DoesNotExist:
-            game = None
+        # the guess is validated against the live state of the game and the
+        # manifest of its current question (see models.rounds)
+        game = livestate.get(gameId)
+        manifest = rounds.get(game) if game else None
+        if manifest and rounds.is_over(manifest, received):
+            return RESPONSE_TIME_OVER
         try:
             participant = Participant.objects.get(uuidP=participantId)
         except (Participant.DoesNotExist, ValidationError):
             participant = None
 
         values = (gameId, participantId, answerIndex, game, participant)
-        if None in values or (participant.game != game):
+        if None in values or (participant.game_id != game.publicId):
             return RESPONSE_GUESS_NONE_VALUES(*values)
 
-        # get the current question of the game
-        question = game.questionnaire.question_set.all()[game.questionNo]
+        if manifest is None:
+            return Response(
+                "Wait until the question is shown",
+                status=status.HTTP_403_FORBIDDEN
+            )
         try:
-            # the guess creation takes care of the repeated guesses validation
-            guess = Guess.objects.create(
+            if int(answerIndex) < 0:
+                raise IndexError(answerIndex)
+            guess = Guess(
                 game=game,
                 participant=participant,
-                question=question,
-                answer=question.answer_set.all()[int(answerIndex)]
+                question_id=manifest.question,
+                answer_id=manifest.answers[int(answerIndex)],
+                responseTime=game.elapsed_time(received),
             )
+            if guessbuffer.enabled():
+                # acknowledged now and stored later
+                guessbuffer.add(game, guess)
+                return Response(guess_data(guess),
+                                status=status.HTTP_202_ACCEPTED)
+            # the guess creation takes care of the repeated guesses validation
+            guess.save(force_insert=True)
         except ValidationError as e:
             return Response(e, status=status.HTTP_403_FORBIDDEN)
-        except IndexError:
+        except (IndexError, ValueError):
             return Response(
                 "Invalid guess", status=status.HTTP_400_BAD_REQUEST
             )
 
-        serialized_guess = self.serializer_class(guess).data
-        return Response(serialized_guess, status=status.HTTP_201_CREATED)
+        if events.has_subscribers(game.publicId):
+            n_guesses, n_participants = game.answered_count()
+            events.publish(game.publicId, 'answered', {
+                'answered': n_guesses, 'participants': n_participants})
+
+        return Response(guess_data(guess), status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def parse_bulk_entry(entry, question):
+        ''' Returns the uuidp of an entry of a bulk creation, the uuid of the
+            participant and the answer chosen of the question (None if they
+            are not valid).
+        '''
+        # Author: Álvaro Zamanillo Sáez
+        uuidp = entry.get('uuidp') if isinstance(entry, dict) else None
+        try:
+            participantId = uuid.UUID(str(uuidp))
+        except ValueError:
+            participantId = None
+        try:
+            answerIndex = int(entry['answer'])
+            if answerIndex < 0:
+                raise IndexError(answerIndex)
+            answer = question.answers[answerIndex]
+        except (IndexError, KeyError, TypeError, ValueError):
+            answer = None
+        return uuidp, participantId, answer
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        ''' Creates the guesses of many participants for the current question
+            of a game at once (e.g. collected by a proxy).
+            Input: {game: int, guesses: [{uuidp: string, answer: int}, ...]}
+            Output: {created: int, rejected: [{uuidp, error}, ...]}
+        '''
+        # Author: Álvaro Zamanillo Sáez
+        received = timezone.now()
+        gameId = request.data.get('game', None)
+        entries = request.data.get('guesses', None)
+        try:
+            game = Game.objects.get(publicId=gameId)
+        except (Game.DoesNotExist, TypeError, ValueError):
+            game = None
+
+        if game is None or not isinstance(entries, list):
+            return Response(
+                f"Invalid guesses for game {gameId}",
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if game.state != QUESTION:
+            return Response(
+                "Wait until the question is shown",
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        question = questionindex.questions(
+            game.questionnaire_id)[game.questionNo]
+        responseTime = game.elapsed_time(received)
+        if rounds.is_late(responseTime, question.answerTime):
+            return RESPONSE_TIME_OVER
+        entries = [self.parse_bulk_entry(entry, question) for entry in entries]
+        participants = dict(Participant.objects.filter(
+            game=game,
+            uuidP__in=[participantId for _, participantId, _ in entries
+                       if participantId is not None],
+        ).values_list('uuidP', 'pk'))
+
+        guesses, rejected = [], []
+        for uuidp, participantId, answer in entries:
+            if participants.get(participantId) is None or answer is None:
+                rejected.append({'uuidp': uuidp, 'error': 'Invalid guess'})
+            else:
+                guesses.append((uuidp, Guess(
+                    participant_id=participants[participantId],
+                    answer_id=answer.id,
+                    responseTime=responseTime,
+                )))
+
+        try:
+            stored = Guess.bulk_save(game, [guess for _, guess in guesses])
+        except ValidationError as e:
+            return Response(e, status=status.HTTP_403_FORBIDDEN)
+        stored = {id(guess) for guess in stored}
+        rejected += [
+            {'uuidp': uuidp, 'error': 'You may not edit an existing guess'}
+            for uuidp, guess in guesses if id(guess) not in stored
+        ]
+
+        if stored and events.has_subscribers(game.publicId):
+            n_guesses, n_participants = game.answered_count()
+            events.publish(game.publicId, 'answered', {
+                'answered': n_guesses, 'participants': n_participants})
+
+        return Response({'created': len(stored), 'rejected': rejected},
+                        status=status.HTTP_201_CREATED)
 
 
 # Create your views here.
@@ -0,0 +1,10 @@
+from django import forms
+
+
+class QuestionnaireImportForm(forms.Form):
+    ''' Form to create a questionnaire from a file (see
+    models/questionnairefile.py)'''
+    # Author: Pablo Cuesta Sierra
+    title = forms.CharField(max_length=100)
+    file = forms.FileField(
+        help_text='A .csv file or a .json file with a question per line')
@@ -5,14 +5,11 @@ $(document).ready(function () {
 
     // Set the date we're counting down to
     var startAt = document.getElementById("cuenta-atras").value;
+    var gameId = document.getElementById("game-id").value;
     var now = 0;
-    //Update the count down every 1 second
-
-
-    var x = setInterval(function () {
 
-
-        //check if all participants have answered
+    //check if all participants have answered
+    function checkAllAnswered() {
         $.ajax({
             url: "/services/checkAllAnswered/",
             success: function (data) {
@@ -23,11 +20,39 @@ $(document).ready(function () {
                 }
             }
         });
-        
-        
+    }
+
+    // the server pushes the number of answers each time a participant
+    // answers. The answers handled by other server processes are not
+    // pushed, so it is still checked every PUSHED_POLL_DELAY seconds; if the
+    // push channel is not available, every second.
+    var PUSHED_POLL_DELAY = 5;
+    var polling = !window.EventSource;
+    checkAllAnswered();
+    if (!polling) {
+        var source = new EventSource("/events/" + gameId + "/");
+        source.addEventListener("answered", function (event) {
+            var data = JSON.parse(event.data);
+            if (data.answered == data.participants) {
+                window.location.href = "/services/gamecountdown";
+            }
+        });
+        source.onerror = function () {
+            source.close();
+            polling = true;
+        };
+    }
+
+    //Update the count down every 1 second
+    var x = setInterval(function () {
+
         // Get today's date and time
         now = now + 1;
 
+        if (polling || now % PUSHED_POLL_DELAY == 0) {
+            checkAllAnswered();
+        }
+
         // Find the distance between now and the count down date
         var distance = startAt - now;
 
@@ -2,20 +2,101 @@
 // participants list.
 
 $(document).ready(function () {
+  var gameId = document.getElementById("game-id").value;
+  // the server only sends the participants that joined or left since the
+  // cursor (an empty cursor asks for the whole list)
+  var cursor = "";
+  var loading = false;
+  var pending = false;
+  // the changes handled by other server processes are not pushed, so the
+  // list is still polled (slowly) while the push channel is open
+  var POLL_DELAY = 2000;
+  var PUSHED_POLL_DELAY = 10000;
+  var delay = POLL_DELAY;
+
+  function participant(alias) {
+    return $('#participants_list').children().filter(function () {
+      return $(this).data("alias") === alias;
+    });
+  }
+
+  function update(data) {
+    if (data.reset) {
+      $('#participants_list').empty();
+    }
+    // removed first: an alias may be removed and then taken again
+    data.removed.forEach(function (alias) {
+      participant(alias).remove();
+    });
+    data.joined.forEach(function (alias) {
+      if (participant(alias).length) {
+        return;
+      }
+      var button = $('<button>')
+        .addClass("alert alert-primary m-1 alias").val(alias).text(alias);
+      $('#participants_list').append($('<div>').data("alias", alias)
+        .append(button));
+    });
+    cursor = data.cursor;
+  }
+
   function refresh() {
+    // a single request at a time, so that the cursor is not used twice
+    if (loading) {
+      pending = true;
+      return;
+    }
+    loading = true;
     $.ajax({
       url: "/services/gameUpdateParticipant/",
-      success: function (data) {
-        // fill the content of the div with the data returned by the server
-        $('#participants_list').html(data);
+      data: { cursor: cursor },
+      dataType: "json",
+      success: update,
+      complete: function () {
+        loading = false;
+        if (pending) {
+          pending = false;
+          refresh();
+        }
       }
     });
-    // call the function again after 2 seconds
-    setTimeout(refresh, 2000);
   }
 
+  function poll() {
+    refresh();
+    // call the function again after the delay
+    setTimeout(poll, delay);
+  }
+
+  $('#participants_list').on('click', 'button.alias', function () {
+    var alias = $(this).val();
+    // hide this element
+    $(this).hide();
+    console.log("Deleting: " + alias);
+    $.ajax({
+      url: "/services/participantremove/" + encodeURIComponent(alias) + "/",
+      success: function (data) {
+        console.log("success deleting participant");
+      }
+    });
+  });
+
   $(function () {
     refresh();
+
+    // the list is refreshed when the server pushes that a participant
+    // joined or left. If the push channel is not available, poll faster.
+    if (window.EventSource) {
+      delay = PUSHED_POLL_DELAY;
+      var source = new EventSource("/events/" + gameId + "/");
+      source.addEventListener("join", refresh);
+      source.addEventListener("leave", refresh);
+      source.onerror = function () {
+        source.close();
+        delay = POLL_DELAY;
+      };
+    }
+    setTimeout(poll, delay);
   });
 
-});
\ No newline at end of file
+});
@@ -1,6 +1,10 @@
 from .test_services import ServiceBaseTest
 
 
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from time import sleep
 
@@ -10,8 +14,10 @@ from models.models import Answer as Answer
 from models.models import Game as Game
 from models.models import Participant as Participant
 from models.models import Guess as Guess
+from models.models import Questionnaire as Questionnaire
+from models.models import User as User
 
-from models.constants import QUESTION, WAITING
+from models.constants import QUESTION, WAITING, ANSWER
 
 # XXX_SERVICE is the alias of the service we want to test
 # XXX_KEY is the key, in the context diccionary, with the information
@@ -25,7 +31,12 @@ QUESTIONNAIRE_LIST_KEY = "questionnaire_list"
 ANSWER_CREATE_SERVICE = "answer-create"
 ANSWER_UPDATE_SERVICE = "answer-update"
 
+QUESTIONNAIRE_IMPORT_SERVICE = "questionnaire-import"
+QUESTIONNAIRE_EXPORT_SERVICE = "questionnaire-export"
+QUESTIONNAIRE_CLONE_SERVICE = "questionnaire-clone"
+
 GAME_CREATE_SERVICE = "game-create"
+GAME_COUNTDOWN_SERVICE = "game-countdown"
 
 LOGIN_SERVICE = "login"
 LOGOUT_SERVICE = "logout"
@@ -36,6 +47,8 @@ GAME_UPDATE_PARTICIPANT_SERVICE = "game-updateparticipant"
 CHECK_ALL_ANSWERED_SERVICE = "check-all-answered"
 
 
+# the state of the games is kept in the cache, as with memcached
+@override_settings(CACHE_GAME_STATE=True)
 class ServiceTests(ServiceBaseTest):
 
     def checkNoLogin(self, SERVICE, KEY, args=None, redirectLoginPage=True):
@@ -271,3 +284,231 @@ class ServiceTests(ServiceBaseTest):
         self.assertFalse(
             self.decode(
                 response.content).find("True"), -1)
+
+    def test_answer_distribution(self):
+        "check the distribution of guesses is computed in one query"
+        # Author: Álvaro Zamanillo Sáez
+        print("test answer_distribution")
+        self.checkLogin(
+            GAME_CREATE_SERVICE, 'DO_NOT_CHECK_KEY',
+            args=[str(self.questionnaire.id)])
+        game = Game.objects.first()
+
+        # countdown and first question
+        self.client1.get(reverse(GAME_COUNTDOWN_SERVICE))
+        self.client1.get(reverse(GAME_COUNTDOWN_SERVICE))
+        game.refresh_from_db()
+        self.assertEqual(game.state, QUESTION)
+
+        answers = [self.answer, self.answer2, self.answer, self.answer]
+        for i, answer in enumerate(answers):
+            Guess.objects.create(
+                participant=Participant.objects.create(
+                    game=game, alias=f"alias_{i}"),
+                question=self.question,
+                game=game,
+                answer=answer)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client1.get(reverse(GAME_COUNTDOWN_SERVICE))
+        guess_queries = [
+            query for query in queries.captured_queries
+            if 'models_guess' in query['sql']]
+        self.assertEqual(len(guess_queries), 1)
+
+        self.assertEqual(response.context['game'].state, ANSWER)
+        self.assertEqual(
+            response.context['correct_answer'].id, self.answer.id)
+        self.assertEqual(response.context['num_total_guesses'], 4)
+        self.assertEqual(response.context['num_correct_guesses'], 3)
+        self.assertEqual(
+            response.context['answers_proportions'], ['75.00%', '25.00%'])
+
+    def test_participants_changes(self):
+        "check the lobby only receives the participants that changed"
+        # Author: Álvaro Zamanillo Sáez
+        print("test participants_changes")
+        self.checkLogin(
+            GAME_CREATE_SERVICE, 'DO_NOT_CHECK_KEY',
+            args=[str(self.questionnaire.id)])
+        game = Game.objects.first()
+
+        def get_changes(cursor):
+            response = self.client1.get(
+                reverse(GAME_UPDATE_PARTICIPANT_SERVICE),
+                {'cursor': cursor})
+            return response.json(), len(response.content)
+
+        # the whole list is sent when there is no cursor yet
+        Participant.objects.bulk_create(
+            Participant(game=game, alias="alias_%04d" % i) for i in range(10))
+        changes, _ = get_changes("")
+        self.assertTrue(changes['reset'])
+        self.assertEqual(changes['joined'],
+                         ["alias_%04d" % i for i in range(10)])
+        self.assertEqual(changes['removed'], [])
+
+        changes, _ = get_changes(changes['cursor'])
+        self.assertFalse(changes['reset'])
+        self.assertEqual(changes['joined'], [])
+
+        # a join and a removal in a room of 10 and of 1000 participants
+        sizes, n_created = [], 10
+        for n, size in enumerate([10, 1000]):
+            Participant.objects.bulk_create(
+                Participant(game=game, alias="alias_%04d" % i)
+                for i in range(n_created, size))
+            n_created = size
+            cursor = get_changes(changes['cursor'])[0]['cursor']
+
+            Participant.objects.create(game=game, alias="new_%04d" % n)
+            self.client1.get(reverse(
+                PARTICIPANT_REMOVE_SERVICE, args=["alias_%04d" % n]))
+            changes, length = get_changes(cursor)
+            self.assertEqual(changes['joined'], ["new_%04d" % n])
+            self.assertEqual(changes['removed'], ["alias_%04d" % n])
+            sizes.append(length)
+
+        # only the cursor (the ids) may be longer
+        self.assertLessEqual(sizes[1] - sizes[0], 4)
+
+        # an unknown cursor asks for the whole list again
+        changes, _ = get_changes("invalid")
+        self.assertTrue(changes['reset'])
+        self.assertEqual(len(changes['joined']), 1000)
+
+    def test_polls_not_modified(self):
+        "check the polls of the host are answered with 304 if nothing changed"
+        # Author: Álvaro Zamanillo Sáez
+        print("test polls_not_modified")
+        self.checkLogin(
+            GAME_CREATE_SERVICE, 'DO_NOT_CHECK_KEY',
+            args=[str(self.questionnaire.id)])
+        game = Game.objects.first()
+
+        for service, params in ((GAME_UPDATE_PARTICIPANT_SERVICE, {}),
+                                (GAME_UPDATE_PARTICIPANT_SERVICE,
+                                 {'cursor': ''}),
+                                (CHECK_ALL_ANSWERED_SERVICE, {})):
+            response = self.client1.get(reverse(service), params)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+
+            response = self.client1.get(
+                reverse(service), params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b"")
+
+            # a participant joins
+            Participant.objects.create(game=game, alias=f"alias_{service}"
+                                       f"_{len(params)}")
+            response = self.client1.get(
+                reverse(service), params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_polls_session_cached(self):
+        "check the polls of the host do not read or write the session table"
+        # Author: Álvaro Zamanillo Sáez
+        print("test polls_session_cached")
+        self.checkLogin(
+            GAME_CREATE_SERVICE, 'DO_NOT_CHECK_KEY',
+            args=[str(self.questionnaire.id)])
+
+        for service, params in ((GAME_UPDATE_PARTICIPANT_SERVICE, {}),
+                                (GAME_UPDATE_PARTICIPANT_SERVICE,
+                                 {'cursor': ''}),
+                                (CHECK_ALL_ANSWERED_SERVICE, {})):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client1.get(reverse(service), params)
+            self.assertEqual(response.status_code, 200)
+            for query in queries.captured_queries:
+                self.assertNotIn('django_session', query['sql'])
+
+    def test_questionnaire_import_export(self):
+        "check whole questionnaires are imported and exported as files"
+        # Author: Pablo Cuesta Sierra
+        print("test questionnaire_import_export")
+        self.client1.post(reverse(LOGIN_SERVICE), self.userDict)
+
+        def csv_file(n_questions):
+            rows = ['question,answerTime,answer1,answer2,answer3,answer4,'
+                    'correct']
+            rows += [f'question {n},{n + 1},a,b,"c, d",e,{n % 4 + 1}'
+                     for n in range(n_questions)]
+            return SimpleUploadedFile(
+                'quiz.csv', '\n'.join(rows).encode())
+
+        def import_file(file, title='__imported'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client1.post(
+                    reverse(QUESTIONNAIRE_IMPORT_SERVICE),
+                    {'title': title, 'file': file})
+            return response, len(queries)
+
+        # the number of queries does not depend on the number of questions
+        _, n_queries = import_file(csv_file(5), '__small')
+        response, n_queries_large = import_file(csv_file(50))
+        self.assertEqual(n_queries, n_queries_large)
+        questionnaire = Questionnaire.objects.get(title='__imported')
+        self.assertRedirects(response, questionnaire.get_absolute_url())
+        questions = list(questionnaire.question_set.all())
+        self.assertEqual(len(questions), 50)
+        self.assertEqual(questions[7].answerTime, 8)
+        self.assertEqual(
+            [(answer.answer, answer.correct)
+             for answer in questions[7].answer_set.all()],
+            [('a', False), ('b', False), ('c, d', False), ('e', True)])
+
+        # exported and imported again, in both formats
+        for format, name in (('json', 'quiz.json'), ('csv', 'quiz.csv')):
+            response = self.client1.get(
+                reverse(QUESTIONNAIRE_EXPORT_SERVICE,
+                        args=[questionnaire.id]), {'format': format})
+            self.assertEqual(response.status_code, 200)
+            content = b''.join(response.streaming_content)
+            import_file(SimpleUploadedFile(name, content), f'__{format}')
+            copy = Questionnaire.objects.get(title=f'__{format}')
+            self.assertEqual(
+                list(copy.question_set.values_list(
+                    'question', 'answerTime', 'answer__answer',
+                    'answer__correct')),
+                list(questionnaire.question_set.values_list(
+                    'question', 'answerTime', 'answer__answer',
+                    'answer__correct')))
+
+        # nothing is stored from an invalid file
+        file = SimpleUploadedFile(
+            'quiz.json', b'{"question": "q", "answers": []}\n'
+            b'{"question": "q", "answers": [{"answer": "a", "correct": true},'
+            b' {"answer": "b", "correct": true}]}\n')
+        response, _ = import_file(file, '__invalid')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Line 2", self.decode(response.content))
+        self.assertFalse(
+            Questionnaire.objects.filter(title='__invalid').exists())
+
+    def test_questionnaire_clone(self):
+        "check a questionnaire is duplicated by its owner only"
+        # Author: Pablo Cuesta Sierra
+        print("test questionnaire_clone")
+        url = reverse(QUESTIONNAIRE_CLONE_SERVICE,
+                      args=[self.questionnaire.id])
+        other = {"username": 'b', "password": 'b'}
+        User.objects.create_user(**other)
+        self.client1.post(reverse(LOGIN_SERVICE), other)
+        response = self.client1.post(url)
+        self.assertEqual(response.status_code, 403)
+
+        self.client1.post(reverse(LOGIN_SERVICE), self.userDict)
+        response = self.client1.post(url)
+        copy = Questionnaire.objects.first()
+        self.assertNotEqual(copy.id, self.questionnaire.id)
+        self.assertRedirects(response, copy.get_absolute_url())
+        self.assertEqual(
+            list(copy.question_set.values_list(
+                'question', 'answer__answer', 'answer__correct')),
+            list(self.questionnaire.question_set.values_list(
+                'question', 'answer__answer', 'answer__correct')))
@@ -30,6 +30,21 @@ urlpatterns = [
         views.QuestionnaireCreate.as_view(),
         name='questionnaire-create'
     ),
+    path(
+        'questionnaireclone/<int:pk>/',
+        views.QuestionnaireClone.as_view(),
+        name='questionnaire-clone'
+    ),
+    path(
+        'questionnaireimport/',
+        views.QuestionnaireImport.as_view(),
+        name='questionnaire-import'
+    ),
+    path(
+        'questionnaireexport/<int:pk>/',
+        views.QuestionnaireExport.as_view(),
+        name='questionnaire-export'
+    ),
 
     # question paths
     path(
@@ -1,21 +1,31 @@
-from django.http import HttpResponse
+import codecs
+
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.mixins import (
     LoginRequiredMixin, UserPassesTestMixin)
 
 from django.http import HttpResponseForbidden, HttpResponseRedirect
 from django.urls import reverse, reverse_lazy
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.forms import ValidationError
 from django.views.generic import (
     TemplateView, DetailView, ListView, CreateView,
-    DeleteView, UpdateView
+    DeleteView, UpdateView, FormView, View
 )
+from django.views.generic.detail import SingleObjectMixin
 
 # Create your views here.
 from models.models import (
-    Answer, Game, Question, Questionnaire, Participant, Guess
+    Answer, Game, Question, Questionnaire, Participant
 )
 
+from models import (
+    events, gameversion, leaderboard, livestate, lobby, questionindex,
+    questionnairefile)
 from models.constants import (
     WAITING, QUESTION, ANSWER, LEADERBOARD,)
+from .forms import QuestionnaireImportForm
 
 state_template = {
     WAITING: 'game_countdown.html',
@@ -26,6 +36,16 @@ state_template = {
 MAX_ANSWERS = 4
 MAX_CORRECT_ANSWERS = 1
 OWNER_ALLOWED = 3
+# participants shown in the answer and leaderboard screens
+LEADERBOARD_SIZE = 50
+
+
+def session_game_etag(request, *args, **kwargs):
+    ''' ETag of the responses about the active game of the session (see
+    models.gameversion).'''
+    # Author: Álvaro Zamanillo Sáez
+    publicId = request.session.get('publicId')
+    return gameversion.etag(publicId) if publicId else None
 
 
 class HomeView(TemplateView):
@@ -127,6 +147,65 @@ class QuestionnaireCreate(LoginRequiredMixin, CreateView):
         return HttpResponseRedirect(self.get_success_url())
 
 
+class QuestionnaireClone(OwnerMixin, SingleObjectMixin, View):
+    ''' Creates a copy of a questionnaire, with all its questions and
+        answers, for the user. On success, the user is redirected to the
+        detail view of the copy.'''
+    # Author: Pablo Cuesta Sierra
+    model = Questionnaire
+
+    def post(self, request, *args, **kwargs):
+        # Author: Pablo Cuesta Sierra
+        copy = self.get_object().clone(request.user)
+        return HttpResponseRedirect(copy.get_absolute_url())
+
+
+class QuestionnaireImport(LoginRequiredMixin, FormView):
+    ''' Creates a questionnaire with the questions of a file (see
+        models/questionnairefile.py). On success, the user is redirected to
+        the detail view of the questionnaire.'''
+    # Author: Pablo Cuesta Sierra
+    form_class = QuestionnaireImportForm
+    template_name = 'models/questionnaire_import.html'
+
+    def form_valid(self, form):
+        # Author: Pablo Cuesta Sierra
+        file = form.cleaned_data['file']
+        try:
+            questionnaire = questionnairefile.import_questionnaire(
+                self.request.user,
+                form.cleaned_data['title'],
+                codecs.iterdecode(file, 'utf-8-sig'),
+                questionnairefile.format_of(file.name),
+            )
+        except ValidationError as e:
+            form.add_error('file', e)
+            return self.form_invalid(form)
+        return HttpResponseRedirect(questionnaire.get_absolute_url())
+
+
+class QuestionnaireExport(OwnerMixin, DetailView):
+    ''' Sends the questionnaire as a file, in the format given by the
+        parameter format (json by default, or csv).'''
+    # Author: Pablo Cuesta Sierra
+    model = Questionnaire
+
+    def get(self, request, *args, **kwargs):
+        # Author: Pablo Cuesta Sierra
+        format = request.GET.get('format', 'json')
+        if format not in questionnairefile.FORMATS:
+            return HttpResponse("Unknown format", status=400)
+        response = StreamingHttpResponse(
+            questionnairefile.export_lines(self.kwargs['pk'], format),
+            content_type=('text/csv' if format == 'csv'
+                          else 'application/x-ndjson'),
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="questionnaire{self.kwargs["pk"]}.'
+            f'{format}"')
+        return response
+
+
 # Question ######################################
 
 
@@ -352,6 +431,7 @@ class GameCreate(OwnerMixin, TemplateView):
 
         self.request.session['publicId'] = game.publicId
         self.request.session['started'] = False
+        self.request.session['shown'] = None
 
         context = super().get_context_data(**kwargs)
         context['publicId'] = game.publicId
@@ -388,6 +468,47 @@ class GameUpdateParticipant(OwnerMixin, ListView):
 
         return super().get_queryset().filter(game=game)
 
+    @method_decorator(condition(etag_func=session_game_etag))
+    def get(self, request, *args, **kwargs):
+        ''' If a cursor is given, returns as json only the changes of the
+        participants since that cursor (see get_changes).'''
+        # Author: Álvaro Zamanillo Sáez
+        if 'cursor' not in request.GET:
+            return super().get(request, *args, **kwargs)
+        return JsonResponse(self.get_changes(request.GET['cursor']))
+
+    def get_changes(self, cursor):
+        '''Returns the aliases of the participants that joined and left the
+        game since the cursor, and the new cursor. If the cursor is empty
+        (or no longer valid) every participant is returned, with reset set.
+        Input: cursor, "<last participant id seen>-<removals seen>".
+        Output: {reset: bool, joined: [alias, ...], removed: [alias, ...],
+                 cursor: string}'''
+        # Author: Álvaro Zamanillo Sáez
+        game = self.get_game()
+        try:
+            last_id, n_removed = (int(n) for n in cursor.split('-'))
+        except ValueError:
+            last_id, n_removed = 0, -1
+
+        removed, n_removed = lobby.removed_since(
+            game.publicId, max(n_removed, 0))
+        reset = removed is None or last_id == 0
+        if reset:
+            last_id, removed = 0, []
+
+        joined = list(self.get_queryset().filter(id__gt=last_id)
+                      .order_by('id').values_list('id', 'alias'))
+        if joined:
+            last_id = joined[-1][0]
+
+        return {
+            'reset': reset,
+            'joined': [alias for _, alias in joined],
+            'removed': removed,
+            'cursor': f'{last_id}-{n_removed}',
+        }
+
 
 class GameCountdown(TemplateView):
     ''' View to control the whole game. It shows the different templates
@@ -409,12 +530,21 @@ class GameCountdown(TemplateView):
         # Author: Álvaro Zamanillo Sáez
         self.set_game()
 
+        shown = self.request.session.get('shown')
         if self.request.session['started']:
-            self.game.update_state()
+            if shown is None:
+                self.game.update_state()
+            # the game is only moved if it is still in the state shown to
+            # the host, as the server may have moved it already (see
+            # models/scheduler.py)
+            elif Game.advance(self.game.publicId, *shown):
+                self.set_game()
         # the first time GameCountdown is called, the game state must not be
         # updated.
         else:
             self.request.session['started'] = True
+        self.request.session['shown'] = [self.game.state,
+                                         self.game.questionNo]
 
         return super().dispatch(request, *args, **kwargs)
 
@@ -432,52 +562,54 @@ class GameCountdown(TemplateView):
         state = game.state
 
         if state not in (LEADERBOARD, WAITING):
-            question = game.questionnaire.question_set.all()[game.questionNo]
+            question = questionindex.questions(
+                game.questionnaire_id)[game.questionNo]
             context['question'] = question
 
-            num_answers = context['question'].answer_set.count()
-
+            answers = list(question.answers)
             context['answers'] = (
-                list(context['question'].answer_set.all())
-                + (MAX_ANSWERS - num_answers) * [None]
+                answers + (MAX_ANSWERS - len(answers)) * [None]
             )
 
         if state == ANSWER:
-            correct_answer = (
-                game.questionnaire.question_set
-                .all()[game.questionNo].answer_set
-                .filter(correct=True).first()
-            )
-
+            correct_answer = next(
+                (answer for answer in answers if answer.correct), None)
             context['correct_answer'] = correct_answer
 
-            all_guesses = Guess.objects.filter(game=game, question=question)
-            total_guesses = context['num_total_guesses'] = all_guesses.count()
+            # number of guesses of each answer, computed in a single query
+            distribution = game.guess_distribution(question.id)
+            total_guesses = context['num_total_guesses'] = sum(
+                distribution.values())
             context['num_correct_guesses'] = (
-                all_guesses.filter(answer=correct_answer).count())
-            context['participants'] = game.participant_set.all()
+                distribution.get(correct_answer.id, 0)
+                if correct_answer else 0
+            )
+            context['participants'] = leaderboard.top(
+                game.publicId, LEADERBOARD_SIZE)
 
-            all_answers = question.answer_set.all()
             answers_count = [
-                all_guesses.filter(answer=answer).count()
-                for answer in all_answers
+                distribution.get(answer.id, 0) for answer in answers
             ]
             context['answers_proportions'] = [
                 f"{answer_count/total_guesses if total_guesses else 0:.2%}"
                 for answer_count in answers_count
             ]
 
+        if state == LEADERBOARD:
+            context['leaderboard'] = leaderboard.top(
+                game.publicId, LEADERBOARD_SIZE)
+
         return context
 
 
+@condition(etag_func=session_game_etag)
 def checkAllAnswered(request):
     ''' Checks if all participants have answered the current question in the
     currently active game.
     Returns a string witih "True" if all have answered or "False" otherwise.'''
     # Author: Álvaro Zamanillo Sáez
 
-    game = Game.objects.filter(
-        publicId=request.session['publicId']).first()
+    game = livestate.get(request.session['publicId'])
 
     return HttpResponse(game.all_participants_answered() if game else "False")
 
@@ -496,5 +628,6 @@ def deleteParticipant(request, alias):
         game=game, alias=alias).first()
     if participant:
         participant.delete()
+        events.publish(game.publicId, 'leave', {'alias': alias})
 
     return HttpResponse("")